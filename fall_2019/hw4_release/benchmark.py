@@ -0,0 +1,132 @@
+"""
+Timing of the seam carving functions in seam_carving.py.
+
+Usage:
+    python benchmark.py [image] [n_seams]
+
+Reports the time spent per removed seam by `reduce` (full cost map for every
+seam) and `reduce_fast` (local energy and cost updates) for several widths of
+the same image, then the peak memory and number of image copies of `reduce`
+with and without the lazy index map, and finally the time and removed energy
+of `find_seams` when several seams are taken from each cost map, and the
+time per frame of `reduce_video` on a clip panning over the image.
+"""
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from skimage import io, util
+from skimage.transform import resize
+
+import seam_carving
+
+
+def time_per_seam(func, image, n_seams):
+    """Average time in seconds to remove one seam from image with func."""
+    start = time.perf_counter()
+    func(image, image.shape[1] - n_seams)
+    return (time.perf_counter() - start) / n_seams
+
+
+def benchmark_reduce(image, widths, n_seams=20):
+    """Prints the per-seam time of reduce and reduce_fast against image width."""
+    H, W, _ = image.shape
+    print('%8s %8s %12s %12s %8s' % ('height', 'width', 'reduce', 'reduce_fast', 'speedup'))
+    for width in widths:
+        height = int(round(H * width / W))
+        resized = resize(image, (height, width), anti_aliasing=True)
+        t_reduce = time_per_seam(seam_carving.reduce, resized, n_seams)
+        t_fast = time_per_seam(seam_carving.reduce_fast, resized, n_seams)
+        print('%8d %8d %10.2fms %10.2fms %7.1fx' % (
+            height, width, 1e3 * t_reduce, 1e3 * t_fast, t_reduce / t_fast))
+
+
+def peak_memory(func, *args, **kwargs):
+    """Runs func and returns its output and the peak of traced memory in bytes."""
+    tracemalloc.start()
+    try:
+        out = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return out, peak
+
+
+def benchmark_memory(image, size):
+    """Prints peak memory and image copies of reduce, copying and lazy."""
+    n_copies = [0]
+
+    def counting_remove_seam(image, seam):
+        n_copies[0] += 1
+        return seam_carving.remove_seam(image, seam)
+
+    _, peak_copy = peak_memory(seam_carving.reduce, image, size,
+                               rfunc=counting_remove_seam)
+    _, peak_lazy = peak_memory(seam_carving.reduce, image, size, lazy=True)
+
+    print('%8s %12s %12s' % ('mode', 'peak', 'image copies'))
+    print('%8s %10.1fMB %12d' % ('copy', peak_copy / 2**20, n_copies[0]))
+    # carve_lazy only builds the output image once, in take_columns
+    print('%8s %10.1fMB %12d' % ('lazy', peak_lazy / 2**20, 1))
+
+
+def evaluate_batch_seams(image, n_seams, seams_per_pass=(1, 2, 4, 8, 16)):
+    """Prints time and removed energy of find_seams for several batch sizes.
+
+    The removed energy is the sum of the energy of the original image over all
+    the removed pixels. It is compared to the exact result, where the seams are
+    removed one at a time (seams_per_pass=1).
+    """
+    energy = seam_carving.energy_function(image)
+    print('%8s %10s %14s %10s' % ('batch', 'time', 'removed energy', 'vs exact'))
+    exact = None
+    for k in seams_per_pass:
+        start = time.perf_counter()
+        seams = seam_carving.find_seams(image, n_seams, seams_per_pass=k)
+        elapsed = time.perf_counter() - start
+        removed = energy[seams > 0].sum()
+        if exact is None:
+            exact = removed
+        print('%8d %9.2fs %14.2f %9.1f%%' % (
+            k, elapsed, removed, 100 * (removed / exact - 1)))
+
+
+def pan(image, n_frames, width):
+    """Yields the frames of a clip panning one pixel per frame over image."""
+    for t in range(n_frames):
+        yield image[:, t:t + width]
+
+
+def benchmark_video(image, n_frames, n_seams):
+    """Prints the time per frame of reduce and reduce_video on a panning clip."""
+    width = image.shape[1] - n_frames
+    size = width - n_seams
+
+    start = time.perf_counter()
+    for frame in pan(image, n_frames, width):
+        seam_carving.reduce(frame, size, lazy=True)
+    t_reduce = (time.perf_counter() - start) / n_frames
+
+    start = time.perf_counter()
+    for _ in seam_carving.reduce_video(pan(image, n_frames, width), size):
+        pass
+    t_video = (time.perf_counter() - start) / n_frames
+
+    print('%12s %12s %8s' % ('reduce', 'reduce_video', 'speedup'))
+    print('%10.2fms %10.2fms %7.1fx' % (1e3 * t_reduce, 1e3 * t_video,
+                                        t_reduce / t_video))
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else 'imgs/broadway_tower.jpg'
+    n_seams = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    image = util.img_as_float(io.imread(path))
+    benchmark_reduce(image, widths=[200, 400, 800, 1600], n_seams=n_seams)
+    print()
+    benchmark_memory(image, image.shape[1] - n_seams)
+    print()
+    evaluate_batch_seams(image, n_seams)
+    print()
+    benchmark_video(image, 10, n_seams)
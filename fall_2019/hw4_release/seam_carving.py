@@ -8,7 +8,21 @@ Python Version: 3.5+
 """
 
 import numpy as np
-from skimage import color
+from skimage import util
+
+
+def _rgb2gray(image):
+    """Same as color.rgb2gray, computed one pixel at a time.
+
+    color.rgb2gray is a matrix product, which older numpy versions round
+    differently depending on the size and layout of the array. The energy of
+    the same pixels is computed from different crops of the image while
+    carving, so the product is written out to give every pixel the same
+    value each time, and ties between seams are always broken the same way.
+    """
+    image = util.img_as_float(image)
+    return (0.2125 * image[..., 0] + 0.7154 * image[..., 1]
+            + 0.0721 * image[..., 2])
 
 
 def energy_function(image):
@@ -27,7 +41,7 @@ def energy_function(image):
     """
     H, W, _ = image.shape
     out = np.zeros((H, W))
-    gray_image = color.rgb2gray(image)
+    gray_image = _rgb2gray(image)
 
     # YOUR CODE HERE
     gx = np.gradient(gray_image, axis=1)
@@ -38,6 +52,17 @@ def energy_function(image):
     return out
 
 
+def _choose_paths(left, middle, right):
+    """Returns -1, 0 or 1 for the smallest of three arrays, elementwise.
+
+    Ties are broken like np.argmin on np.stack([left, middle, right]): left
+    first, then middle.
+    """
+    paths = (middle < left).astype(int) - 1
+    paths[right < np.minimum(left, middle)] = 1
+    return paths
+
+
 def compute_cost(image, energy, axis=1):
     """Computes optimal cost map (vertical) and paths of the seams.
 
@@ -79,15 +104,21 @@ def compute_cost(image, energy, axis=1):
     paths[0] = 0  # we don't care about the first row of paths
 
     # YOUR CODE HERE
+    # The cost map is padded with inf on both sides so that the three upper
+    # neighbours of a row are shifted slices. Each row is then three ufunc
+    # calls writing into preallocated buffers, without temporaries.
+    padded = np.full((H, W + 2), np.inf)
+    padded[0, 1:-1] = energy[0]
+    best = np.empty(W)
     for i in range(1, H):
-        roll_left = np.roll(cost[i-1, :], -1)
-        roll_right = np.roll(cost[i-1, :], 1)
-        paths[i, 0] = np.argmin(cost[i-1, :2])
-        paths[i, W-1] = np.argmin(cost[i-1, W-2:W]) - 1
-        paths[i, 1:W-1] = np.argmin(np.vstack(
-            (roll_right[1:W-1], cost[i-1, 1:W-1], roll_left[1:W-1])), axis=0) - 1  # 注意这里的排序和滚动方向相反
-
-        cost[i, :] = energy[i, :] + cost[i-1, paths[i, :] + np.arange(W)]
+        np.minimum(padded[i-1, :-2], padded[i-1, 1:-1], out=best)
+        np.minimum(best, padded[i-1, 2:], out=best)
+        np.add(energy[i], best, out=padded[i, 1:-1])
+    cost = padded[:, 1:-1].copy()
+
+    # Once the cost is known, the paths of all rows are found at once
+    paths[1:] = _choose_paths(padded[:-1, :-2], padded[:-1, 1:-1],
+                              padded[:-1, 2:])
     # END YOUR CODE
 
     if axis == 0:
@@ -172,7 +203,108 @@ def remove_seam(image, seam):
     return out
 
 
-def reduce(image, size, axis=1, efunc=energy_function, cfunc=compute_cost, bfunc=backtrack_seam, rfunc=remove_seam):
+def remove_seams(image, seams):
+    """Remove several non-overlapping seams from the image at once.
+
+    Args:
+        image: numpy array of shape (H, W, C) or shape (H, W)
+        seams: list of n numpy arrays of shape (H,), the seams to remove, all
+            given in the coordinates of `image`
+
+    Returns:
+        out: numpy array of shape (H, W-n, C) or shape (H, W-n)
+    """
+    H, W = image.shape[:2]
+    keep = np.ones((H, W), dtype=bool)
+    for seam in seams:
+        keep[np.arange(H), seam] = False
+    return image[keep].reshape((H, W - len(seams)) + image.shape[2:])
+
+
+def _backtrack_in_corridor(cost, paths, end, lo, hi):
+    """Backtracks paths from (H-1, end) without leaving columns lo to hi.
+
+    The seam follows paths like backtrack_seam while the pixel they point to
+    is inside the corridor. Otherwise it moves to the upper neighbour of
+    lowest cost inside the corridor.
+
+    Args:
+        cost: numpy array of shape (H, W)
+        paths: numpy array of shape (H, W) containing values -1, 0 or 1
+        end: the seam ends at pixel (H-1, end)
+        lo, hi: numpy arrays of shape (H,), first and last allowed column of
+            each row
+
+    Returns:
+        seam: numpy array of shape (H,), or None if the corridor closes
+    """
+    H = cost.shape[0]
+    seam = np.empty(H, dtype=int)
+    seam[H - 1] = end
+    for i in range(H - 1, 0, -1):
+        j = seam[i] + paths[i, seam[i]]
+        if j < lo[i - 1] or j > hi[i - 1]:
+            a = max(seam[i] - 1, lo[i - 1])
+            b = min(seam[i] + 1, hi[i - 1])
+            if a > b:
+                return None
+            j = a + np.argmin(cost[i - 1, a:b + 1])
+        seam[i - 1] = j
+    return seam
+
+
+def find_non_crossing_seams(cost, paths, k, bfunc=backtrack_seam, oversample=4):
+    """Finds up to k low cost seams in one cost map that do not touch.
+
+    Seams are traced from the lowest entries of the last row of the cost map,
+    in increasing order. The first one is bfunc(paths, end), the optimal
+    seam. Every seam kept so far splits each row, so a new seam must stay
+    inside the corridor between its left and right neighbours: it follows
+    paths as long as they stay in that corridor (see _backtrack_in_corridor),
+    and is dropped if the corridor closes. The seams after the first are
+    approximations, and all the seams can be removed together.
+
+    Args:
+        cost: numpy array of shape (H, W)
+        paths: numpy array of shape (H, W) containing values -1, 0 or 1
+        k: maximum number of seams to return
+        bfunc: backtrack seam function to use for the first seam
+        oversample: number of candidate end points tried per requested seam
+
+    Returns:
+        seams: list of at most k numpy arrays of shape (H,), lowest cost first
+    """
+    H, W = cost.shape
+    n_candidates = min(W, k * oversample)
+    ends = np.argsort(cost[H - 1], kind='stable')[:n_candidates]
+
+    kept = []  # seams sorted from left to right
+    for end in ends.tolist():
+        if not kept:
+            kept.append(bfunc(paths, end))
+            if k == 1:
+                break
+            continue
+
+        # Neighbouring seams, found from the order of the seams in the last row
+        pos = 0
+        while pos < len(kept) and kept[pos][H - 1] < end:
+            pos += 1
+        if pos < len(kept) and kept[pos][H - 1] == end:
+            continue
+        lo = kept[pos - 1] + 1 if pos > 0 else np.zeros(H, dtype=int)
+        hi = kept[pos] - 1 if pos < len(kept) else np.full(H, W - 1)
+
+        seam = _backtrack_in_corridor(cost, paths, end, lo, hi)
+        if seam is not None:
+            kept.insert(pos, seam)
+            if len(kept) == k:
+                break
+
+    return sorted(kept, key=lambda seam: cost[H - 1, seam[H - 1]])
+
+
+def reduce(image, size, axis=1, efunc=energy_function, cfunc=compute_cost, bfunc=backtrack_seam, rfunc=remove_seam, lazy=False, seams_per_pass=1):
     """Reduces the size of the image using the seam carving process.
 
     At each step, we remove the lowest energy seam from the image. We repeat the process
@@ -192,12 +324,18 @@ def reduce(image, size, axis=1, efunc=energy_function, cfunc=compute_cost, bfunc
         cfunc: cost function to use
         bfunc: backtrack seam function to use
         rfunc: remove seam function to use
+        lazy: if True, remove the seams from an index map with carve_lazy and
+            build the output image only once (rfunc is not used)
+        seams_per_pass: remove up to this many non-crossing seams per cost
+            map (see find_seams). 1 is exact; larger values trade quality for
+            fewer cost computations. Must be 1 if lazy is True.
 
     Returns:
         out: numpy array of shape (size, W, 3) if axis=0, or (H, size, 3) if axis=1
     """
 
-    out = np.copy(image)
+    # The lazy carving never modifies the image, so it needs no copy
+    out = image if lazy else np.copy(image)
     if axis == 0:
         out = np.transpose(out, (1, 0, 2))
 
@@ -208,12 +346,24 @@ def reduce(image, size, axis=1, efunc=energy_function, cfunc=compute_cost, bfunc
 
     assert size > 0, "Size must be greater than zero"
 
+    assert not lazy or seams_per_pass == 1, \
+        "seams_per_pass must be 1 when lazy is True"
+
     # YOUR CODE HERE
-    while out.shape[1] > size:
-        vcost, vpaths = cfunc(out, efunc(out))
-        end = np.argmin(vcost[-1])
-        seam = bfunc(vpaths, end)
-        out = rfunc(out, seam)
+    if lazy:
+        indices = carve_lazy(out, W - size, efunc=efunc, cfunc=cfunc,
+                             bfunc=bfunc)
+        out = take_columns(out, indices)
+    elif seams_per_pass > 1:
+        seams = find_seams(out, W - size, efunc=efunc, cfunc=cfunc,
+                           bfunc=bfunc, seams_per_pass=seams_per_pass)
+        out = out[seams == 0].reshape((H, size) + out.shape[2:])
+    else:
+        while out.shape[1] > size:
+            vcost, vpaths = cfunc(out, efunc(out))
+            end = np.argmin(vcost[-1])
+            seam = bfunc(vpaths, end)
+            out = rfunc(out, seam)
     # END YOUR CODE
 
     print(out.shape[1], size)
@@ -298,7 +448,7 @@ def enlarge_naive(image, size, axis=1, efunc=energy_function, cfunc=compute_cost
     return out
 
 
-def find_seams(image, k, axis=1, efunc=energy_function, cfunc=compute_cost, bfunc=backtrack_seam, rfunc=remove_seam):
+def find_seams(image, k, axis=1, efunc=energy_function, cfunc=compute_cost, bfunc=backtrack_seam, rfunc=remove_seam, lazy=False, seams_per_pass=1):
     """Find the top k seams (with lowest energy) in the image.
 
     We act like if we remove k seams from the image iteratively, but we need to store their
@@ -322,17 +472,33 @@ def find_seams(image, k, axis=1, efunc=energy_function, cfunc=compute_cost, bfun
         cfunc: cost function to use
         bfunc: backtrack seam function to use
         rfunc: remove seam function to use
+        lazy: if True, track the seams with carve_lazy instead of removing
+            them from copies of the image (rfunc is not used)
+        seams_per_pass: number of seams taken from each cost map. With more
+            than one, find_non_crossing_seams picks them and they are removed
+            together, which is faster but only approximates removing the seams
+            one at a time (rfunc is not used). Must be 1 if lazy is True.
 
     Returns:
         seams: numpy array of shape (H, W)
     """
 
-    image = np.copy(image)
+    if not lazy:
+        image = np.copy(image)
     if axis == 0:
         image = np.transpose(image, (1, 0, 2))
 
     H, W, C = image.shape
     assert W > k, "k must be smaller than %d" % W
+    assert not lazy or seams_per_pass == 1, \
+        "seams_per_pass must be 1 when lazy is True"
+
+    if lazy:
+        _, seams = carve_lazy(image, k, efunc=efunc, cfunc=cfunc, bfunc=bfunc,
+                              return_seams=True)
+        if axis == 0:
+            seams = np.transpose(seams, (1, 0))
+        return seams
 
     # Create a map to remember original pixel indices
     # At each step, indices[row, col] will be the original column of current pixel
@@ -351,24 +517,35 @@ def find_seams(image, k, axis=1, efunc=energy_function, cfunc=compute_cost, bfun
     seams = np.zeros((H, W), dtype=int)
 
     # Iteratively find k seams for removal
-    for i in range(k):
-        # Get the current optimal seam
+    i = 0
+    while i < k:
+        # Get the current optimal seam(s)
         energy = efunc(image)
         cost, paths = cfunc(image, energy)
-        end = np.argmin(cost[H - 1])
-        seam = bfunc(paths, end)
-
-        # Remove that seam from the image
-        image = rfunc(image, seam)
+        if seams_per_pass == 1:
+            end = np.argmin(cost[H - 1])
+            batch = [bfunc(paths, end)]
+        else:
+            batch = find_non_crossing_seams(cost, paths,
+                                            min(seams_per_pass, k - i),
+                                            bfunc=bfunc)
 
-        # Store the new seam with value i+1 in the image
+        # Store the new seams with values i+1, i+2, ... in the image
         # We can assert here that we are only writing on zeros (not overwriting existing seams)
-        assert np.all(seams[np.arange(H), indices[np.arange(H), seam]] == 0), \
-            "we are overwriting seams"
-        seams[np.arange(H), indices[np.arange(H), seam]] = i + 1
-
-        # We remove the indices used by the seam, so that `indices` keep the same shape as `image`
-        indices = rfunc(indices, seam)
+        for seam in batch:
+            assert np.all(seams[np.arange(H), indices[np.arange(H), seam]] == 0), \
+                "we are overwriting seams"
+            seams[np.arange(H), indices[np.arange(H), seam]] = i + 1
+            i += 1
+
+        # Remove the seams from the image, and the indices used by the seams,
+        # so that `indices` keep the same shape as `image`
+        if len(batch) == 1:
+            image = rfunc(image, batch[0])
+            indices = rfunc(indices, batch[0])
+        else:
+            image = remove_seams(image, batch)
+            indices = remove_seams(indices, batch)
 
     if axis == 0:
         seams = np.transpose(seams, (1, 0))
@@ -376,7 +553,7 @@ def find_seams(image, k, axis=1, efunc=energy_function, cfunc=compute_cost, bfun
     return seams
 
 
-def enlarge(image, size, axis=1, efunc=energy_function, cfunc=compute_cost, dfunc=duplicate_seam, bfunc=backtrack_seam, rfunc=remove_seam):
+def enlarge(image, size, axis=1, efunc=energy_function, cfunc=compute_cost, dfunc=duplicate_seam, bfunc=backtrack_seam, rfunc=remove_seam, lazy=False):
     """Enlarges the size of the image by duplicating the low energy seams.
 
     We start by getting the k seams to duplicate through function find_seams.
@@ -399,12 +576,21 @@ def enlarge(image, size, axis=1, efunc=energy_function, cfunc=compute_cost, dfun
         dfunc: duplicate seam function to use
         bfunc: backtrack seam function to use
         rfunc: remove seam function to use
+        lazy: if True, find the seams with carve_lazy and duplicate all of
+            them at once with an index map (dfunc and rfunc are not used).
+            Every pixel of the K seams is then duplicated exactly once, and
+            the image keeps its dtype. The default path duplicates the
+            seams one after the other, shifting each one past the previous
+            seam only: in the rows where more seams were duplicated on its
+            left, it duplicates a pixel next to the seam instead, so the
+            two paths are only sure to agree for up to two seams. It
+            returns floats, like duplicate_seam.
 
     Returns:
         out: numpy array of shape (size, W, C) if axis=0, or (H, size, C) if axis=1
     """
 
-    out = np.copy(image)
+    out = image if lazy else np.copy(image)
     # Transpose for height resizing
     if axis == 0:
         out = np.transpose(out, (1, 0, 2))
@@ -417,15 +603,24 @@ def enlarge(image, size, axis=1, efunc=energy_function, cfunc=compute_cost, dfun
 
     # YOUR CODE HERE
     K = size-W
-    seams = find_seams(out, k=K, efunc=efunc,
-                       cfunc=cfunc, bfunc=bfunc, rfunc=rfunc)
-    last_seam = np.zeros((H,), dtype=int)
-    last_seam[:] = W
-    for k in range(K):
-        seam = np.where(seams == k+1)[1].astype(int)
-        seam[np.where(seam > last_seam)] += 1
-        out = dfunc(out, seam)
-        last_seam = seam
+    if lazy:
+        # Every pixel on a seam appears twice in the output: repeat the
+        # original columns of each row, then gather the image once
+        seams = find_seams(out, k=K, efunc=efunc, cfunc=cfunc, bfunc=bfunc,
+                           lazy=True)
+        counts = 1 + (seams > 0)
+        indices = np.repeat(np.tile(np.arange(W), H), counts.ravel())
+        out = take_columns(out, indices.reshape(H, size))
+    else:
+        seams = find_seams(out, k=K, efunc=efunc,
+                           cfunc=cfunc, bfunc=bfunc, rfunc=rfunc)
+        last_seam = np.zeros((H,), dtype=int)
+        last_seam[:] = W
+        for k in range(K):
+            seam = np.where(seams == k+1)[1].astype(int)
+            seam[np.where(seam > last_seam)] += 1
+            out = dfunc(out, seam)
+            last_seam = seam
 
     # END YOUR CODE
 
@@ -454,51 +649,53 @@ def compute_forward_cost(image, energy):
         paths: numpy array of shape (H, W) containing values -1, 0 or 1
     """
 
-    image = color.rgb2gray(image)
+    if image.ndim == 3:
+        image = _rgb2gray(image)
     H, W = image.shape
 
     cost = np.zeros((H, W))
     paths = np.zeros((H, W), dtype=int)
 
+    # Pixel values on the left I(i, j-1) and on the right I(i, j+1) of each
+    # pixel, zero outside the image
+    image_pad = np.pad(image, ((0, 0), (1, 1)))
+    I_left = image_pad[:, :-2]
+    I_right = image_pad[:, 2:]
+
+    # Cost of the new edges for the three possible moves, for all pixels
+    C_V = np.abs(I_left - I_right)
+    C_V[:, 0] = 0
+    C_V[:, -1] = 0
+    C_L = np.zeros((H, W))
+    C_R = np.zeros((H, W))
+    C_L[1:] = C_V[1:] + np.abs(image[:-1] - I_left[1:])
+    C_R[1:] = C_V[1:] + np.abs(image[:-1] - I_right[1:])
+    C_L[:, 0] = 0
+    C_R[:, -1] = 0
+
     # Initialization
-    cost[0] = energy[0]
-    for j in range(W):
-        if j > 0 and j < W - 1:
-            cost[0, j] += np.abs(image[0, j+1] - image[0, j-1])
+    cost[0] = energy[0] + C_V[0]
     paths[0] = 0  # we don't care about the first row of paths
 
     # YOUR CODE HERE
-    for row in range(1, H):
-        # 先获取之前的像素相邻三个能量值
-        upL = np.insert(cost[row - 1, 0:W - 1], 0, 1e10, axis=0)
-        upM = cost[row - 1, :]
-        upR = np.insert(cost[row - 1, 1:W], W - 1, 1e10, axis=0)
-        # 拼接可以使用np.concatenate，但是np.r_或np.c_更高效
-        # upchoices = np.r_[upL, upM, upR].reshape(3, -1)
-        # upchoices = np.concatenate((upL, upM, upR), axis=0).reshape(3, -1)
-
-        # I(i,j+1)
-        I_i_j_P = np.insert(image[row, 0:W-1], 0, 0, axis=0)
-        # I(i,j-1)
-        I_i_j_M = np.insert(image[row, 1:W], W-1, 0, axis=0)
-        # I(i-1.j)
-        I_M = image[row-1, :]
-
-        C_V = abs(I_i_j_P - I_i_j_M)
-        C_V[0] = 0
-        C_V[-1] = 0
-
-        C_L = C_V + abs(I_M - I_i_j_P)
-        C_L[0] = 0
-
-        C_R = C_V + abs(I_M - I_i_j_M)
-        C_R[-1] = 0
-
-        upchoices = np.concatenate(
-            (upL+C_L, upM+C_V, upR+C_R), axis=0).reshape(3, -1)
-
-        cost[row] = energy[row] + np.min(upchoices, axis=0)
-        paths[row] = np.argmin(upchoices, axis=0) - 1  # -1,0,1分别表示左中右
+    # Same layout as compute_cost: inf-padded cost map, preallocated buffers
+    padded = np.full((H, W + 2), np.inf)
+    padded[0, 1:-1] = cost[0]
+    left = np.empty(W)
+    middle = np.empty(W)
+    right = np.empty(W)
+    for i in range(1, H):
+        np.add(padded[i-1, :-2], C_L[i], out=left)
+        np.add(padded[i-1, 1:-1], C_V[i], out=middle)
+        np.add(padded[i-1, 2:], C_R[i], out=right)
+        np.minimum(left, middle, out=left)
+        np.minimum(left, right, out=left)
+        np.add(energy[i], left, out=padded[i, 1:-1])
+    cost = padded[:, 1:-1].copy()
+
+    paths[1:] = _choose_paths(padded[:-1, :-2] + C_L[1:],
+                              padded[:-1, 1:-1] + C_V[1:],
+                              padded[:-1, 2:] + C_R[1:])
     # END YOUR CODE
 
     # Check that paths only contains -1, 0 or 1
@@ -508,6 +705,114 @@ def compute_forward_cost(image, energy):
     return cost, paths
 
 
+def update_energy(image, energy, seam, efunc=energy_function):
+    """Updates the energy map after a seam was removed from the image.
+
+    The energy only changes next to the removed seam, so it is recomputed on a
+    vertical band around it and the rest is copied from the previous map.
+
+    Args:
+        image: numpy array of shape (H, W-1, C), image after removing `seam`
+        energy: numpy array of shape (H, W), energy before removing `seam`
+        seam: numpy array of shape (H,) of the removed seam
+        efunc: energy function to use
+
+    Returns:
+        out: numpy array of shape (H, W-1), equal to efunc(image)
+    """
+    l, r = np.min(seam), np.max(seam)
+    if l <= 3:
+        return np.concatenate([efunc(image[:, :r+3])[:, :-2],
+                               energy[:, r+2:]], axis=1)
+    if r >= image.shape[1]-4:
+        return np.concatenate([energy[:, :l-1],
+                               efunc(image[:, l-3:])[:, 2:]], axis=1)
+    return np.concatenate([energy[:, :l-1], efunc(image[:, l-3:r+3])[:, 2:-2],
+                           energy[:, r+2:]], axis=1)
+
+
+def update_cost(cost, paths, energy, new_energy, seam):
+    """Updates the output of compute_cost after a seam was removed.
+
+    Removing a seam only changes the energy close to it, and a change in the
+    cost at row i can only reach three columns of row i+1. Starting from the
+    previous cost map with the seam removed, each row is recomputed on the
+    columns that may differ (changed energy, neighbours of a changed cost in
+    the row above, and the columns next to the seam whose upper neighbours are
+    shifted), and the next row only looks at the columns whose cost actually
+    changed. The result is identical to compute_cost(None, new_energy).
+
+    Args:
+        cost: numpy array of shape (H, W), cost map before removing `seam`
+        paths: numpy array of shape (H, W), paths before removing `seam`
+        energy: numpy array of shape (H, W), energy before removing `seam`
+        new_energy: numpy array of shape (H, W-1), energy after removing `seam`
+        seam: numpy array of shape (H,) of the removed seam
+
+    Returns:
+        cost: numpy array of shape (H, W-1)
+        paths: numpy array of shape (H, W-1) containing values -1, 0 or 1
+    """
+    H, W = new_energy.shape
+
+    keep = np.ones(cost.shape, dtype=bool)
+    keep[np.arange(H), seam] = False
+    paths = paths[keep].reshape(H, W)
+
+    # Pad the cost with inf on both sides, so that the three upper neighbours
+    # of columns a..b are plain slices even at the image border
+    padded = np.full((H, W + 2), np.inf)
+    padded[:, 1:-1] = cost[keep].reshape(H, W)
+
+    # First and last column of each row where the energy changed
+    changed = new_energy != energy[keep].reshape(H, W)
+    has_changed = np.any(changed, axis=1).tolist()
+    first = np.argmax(changed, axis=1).tolist()
+    last = (W - 1 - np.argmax(changed[:, ::-1], axis=1)).tolist()
+    seam = seam.tolist()
+
+    best = np.empty(W)
+    left, right = W, -1  # columns where the cost changed in any row
+    lo, hi = W, -1  # columns of the previous row whose cost changed
+    for i in range(H):
+        a, b = lo - 1, hi + 1
+        if has_changed[i]:
+            a, b = min(a, first[i]), max(b, last[i])
+        if i > 0:
+            a = min(a, seam[i-1] - 2, seam[i] - 2)
+            b = max(b, seam[i-1] + 1, seam[i] + 1)
+        a, b = max(a, 0), min(b, W - 1)
+        if a > b:
+            lo, hi = W, -1
+            continue
+
+        new_cost = best[:b-a+1]
+        if i == 0:
+            new_cost[:] = new_energy[0, a:b+1]
+        else:
+            np.minimum(padded[i-1, a:b+1], padded[i-1, a+1:b+2], out=new_cost)
+            np.minimum(new_cost, padded[i-1, a+2:b+3], out=new_cost)
+            np.add(new_energy[i, a:b+1], new_cost, out=new_cost)
+
+        diff = np.flatnonzero(new_cost != padded[i, a+1:b+2])
+        if len(diff) > 0:
+            lo, hi = a + diff[0], a + diff[-1]
+            padded[i, lo+1:hi+2] = new_cost[diff[0]:diff[-1]+1]
+        else:
+            lo, hi = W, -1
+        left, right = min(left, a), max(right, b)
+
+    # Paths can only differ in the columns that were recomputed, and are
+    # derived from the final cost in one vectorized pass
+    if left <= right:
+        a, b = max(left - 1, 0), min(right + 1, W - 1)
+        paths[1:, a:b+1] = _choose_paths(padded[:-1, a:b+1],
+                                         padded[:-1, a+1:b+2],
+                                         padded[:-1, a+2:b+3])
+
+    return padded[:, 1:-1].copy(), paths
+
+
 def reduce_fast(image, size, axis=1, efunc=energy_function, cfunc=compute_cost):
     """Reduces the size of the image using the seam carving process. Faster than `reduce`.
 
@@ -538,26 +843,21 @@ def reduce_fast(image, size, axis=1, efunc=energy_function, cfunc=compute_cost):
 
     # YOUR CODE HERE
     energy = efunc(out)
+    cost, paths = cfunc(out, energy)
     while out.shape[1] > size:
-        cost, paths = cfunc(out, energy)
         end = np.argmin(cost[-1])
         seam = backtrack_seam(paths, end)
         out = remove_seam(out, seam)
+        new_energy = update_energy(out, energy, seam, efunc)
 
-        l, r = np.min(seam), np.max(seam)
-        if l <= 3:
-            energy = np.concatenate([efunc(
-                out[:, :r+3])[:, :-2], energy[:, r+2:]], axis=1)
-        elif r >= out.shape[1]-4:
-            energy = np.concatenate(
-                [energy[:, :l-1], efunc(out[:, l-3:])[:, 2:]], axis=1)
+        # The forward cost also depends on the image, so only the backward
+        # cost can be updated in place. Below ~512 columns the vectorized
+        # compute_cost is cheaper than the row loop of update_cost.
+        if cfunc is compute_cost and out.shape[1] >= 512:
+            cost, paths = update_cost(cost, paths, energy, new_energy, seam)
         else:
-            energy = np.concatenate([energy[:, :l-1], efunc(out[:, l-3:r+3])[:, 2:-2],
-                                    energy[:, r+2:]], axis=1)
-
-        # diff = np.where(np.abs(efunc(out) - energy) > 1e-16)
-        # print(diff[0].shape, diff[1].shape)
-        # energy = efunc(out)
+            cost, paths = cfunc(out, new_energy)
+        energy = new_energy
     # END YOUR CODE
 
     assert out.shape[1] == size, "Output doesn't have the right shape"
@@ -568,7 +868,7 @@ def reduce_fast(image, size, axis=1, efunc=energy_function, cfunc=compute_cost):
     return out
 
 
-def remove_object(image, mask):
+def remove_object(image, mask, lazy=False):
     """Remove the object present in the mask.
 
     Returns an output image with same shape as the input image, but without the object in the mask.
@@ -576,6 +876,8 @@ def remove_object(image, mask):
     Args:
         image: numpy array of shape (H, W, 3)
         mask: numpy boolean array of shape (H, W)
+        lazy: if True, remove and duplicate the seams with index maps
+            (see carve_lazy) instead of copying the image for every seam
 
     Returns:
         out: numpy array of shape (H, W, 3)
@@ -583,21 +885,375 @@ def remove_object(image, mask):
     assert image.shape[:2] == mask.shape
 
     H, W, _ = image.shape
-    out = np.copy(image)
+    out = image if lazy else np.copy(image)
 
     # YOUR CODE HERE
-    while np.sum(mask) > 0:
-        energy = energy_function(out)
-        weighted_energy = energy - 100 * mask
-        cost, paths = compute_forward_cost(out, weighted_energy)
-        end = np.argmin(cost[-1])
-        seam = backtrack_seam(paths, end)
-        out = remove_seam(out, seam)
-        mask = remove_seam(mask, seam)
-
-    out = enlarge(out, W)
+    if lazy:
+        indices = carve_lazy(out, mask=mask, cfunc=compute_forward_cost)
+        out = take_columns(out, indices)
+    else:
+        while np.sum(mask) > 0:
+            energy = energy_function(out)
+            weighted_energy = energy - 100 * mask
+            cost, paths = compute_forward_cost(out, weighted_energy)
+            end = np.argmin(cost[-1])
+            seam = backtrack_seam(paths, end)
+            out = remove_seam(out, seam)
+            mask = remove_seam(mask, seam)
+
+    out = enlarge(out, W, lazy=lazy)
     # END YOUR CODE
 
     assert out.shape == image.shape
 
     return out
+
+
+def remove_seam_inplace(arrays, seam, width):
+    """Removes a seam from several arrays in place.
+
+    The pixels off the seam are gathered with one boolean mask and written
+    back into the first `width - 1` columns of each array, so the arrays keep
+    their size. Only the first `width` columns of the arrays are valid, and
+    only the first `width - 1` are valid afterwards.
+
+    Args:
+        arrays: list of numpy arrays of shape (H, W) or (H, W, C)
+        seam: numpy array of shape (H,) containing indices of the seam to remove
+        width: current number of valid columns
+    """
+    H = seam.shape[0]
+    keep = np.ones((H, width), dtype=bool)
+    keep[np.arange(H), seam] = False
+    for array in arrays:
+        shape = (H, width - 1) + array.shape[2:]
+        array[:, :width-1] = array[:, :width][keep].reshape(shape)
+
+
+def take_columns(image, indices):
+    """Builds the image whose pixel (i, j) is image[i, indices[i, j]].
+
+    Args:
+        image: numpy array of shape (H, W, C) or (H, W)
+        indices: numpy array of shape (H, W') of column indices in image
+
+    Returns:
+        out: numpy array of shape (H, W', C) or (H, W'), same type as `image`
+    """
+    return image[np.arange(image.shape[0])[:, None], indices]
+
+
+def _cost_buffers(H, W):
+    """Allocates the arrays used by _compute_cost_into for widths up to W."""
+    return {'padded': np.full((H, W + 2), np.inf),
+            'best': np.empty(W),
+            'lowest': np.empty((H - 1, W)),
+            'less': np.empty((H - 1, W), dtype=bool),
+            'paths': np.zeros((H, W), dtype=np.int8)}
+
+
+def _compute_cost_into(energy, buffers):
+    """Same as compute_cost, but writes into buffers from _cost_buffers.
+
+    The cost and paths returned are views of the buffers, valid until the next
+    call. The operations are the ones of compute_cost, so the results are equal.
+
+    Args:
+        energy: numpy array of shape (H, W'), with W' at most the W of buffers
+        buffers: dictionary returned by _cost_buffers
+
+    Returns:
+        cost: numpy array of shape (H, W')
+        paths: numpy array of shape (H, W') containing values -1, 0 or 1
+    """
+    H, W = energy.shape
+    padded = buffers['padded'][:, :W + 2]
+    best = buffers['best'][:W]
+    padded[:, W + 1] = np.inf
+    padded[0, 1:-1] = energy[0]
+    for i in range(1, H):
+        np.minimum(padded[i-1, :-2], padded[i-1, 1:-1], out=best)
+        np.minimum(best, padded[i-1, 2:], out=best)
+        np.add(energy[i], best, out=padded[i, 1:-1])
+
+    # Same choice as _choose_paths
+    left, middle, right = padded[:-1, :-2], padded[:-1, 1:-1], padded[:-1, 2:]
+    lowest = buffers['lowest'][:, :W]
+    less = buffers['less'][:, :W]
+    paths = buffers['paths'][:, :W]
+    np.less(middle, left, out=less)
+    paths[1:] = less
+    paths[1:] -= 1
+    np.minimum(left, middle, out=lowest)
+    np.less(right, lowest, out=less)
+    np.copyto(paths[1:], 1, where=less)
+    return padded[:, 1:-1], paths
+
+
+def carve_lazy(image, k=None, mask=None, efunc=energy_function, cfunc=compute_cost, bfunc=backtrack_seam, return_seams=False):
+    """Removes vertical seams without copying the image.
+
+    The current image is described by an index map: indices[i, j] is the
+    column of the original image shown at (i, j). Removing a seam shifts the
+    index map and the energy in place, and the energy is only recomputed on a
+    band around the seam, gathered from the original image through the index
+    map. The image itself is never modified, so the caller materializes the
+    result once with take_columns. With compute_cost, the cost map is also
+    computed in buffers allocated once (see _compute_cost_into).
+
+    Stops after k seams, or when k is None, once no pixel of mask is left (the
+    energy of masked pixels is lowered by 100 like in remove_object).
+
+    Args:
+        image: numpy array of shape (H, W, C)
+        k: number of seams to remove
+        mask: numpy boolean array of shape (H, W) of pixels to remove
+        efunc: energy function to use
+        cfunc: cost function to use. Other than compute_cost, it is called
+            with the current grayscale image, kept up to date in place too.
+        bfunc: backtrack seam function to use
+        return_seams: also return the position of the removed seams
+
+    Returns:
+        indices: numpy array of shape (H, W') of original column indices
+        seams: only if return_seams, numpy array of shape (H, W) where seam
+            number i is stored as the path of value i+1, like find_seams
+    """
+    assert k is not None or mask is not None, "Either k or mask must be given"
+
+    H, W, _ = image.shape
+    rows = np.arange(H)
+
+    indices = np.tile(np.arange(W, dtype=np.int32), (H, 1))
+    energy = efunc(image)
+    buffers = [indices, energy]
+    gray = None
+    if cfunc is not compute_cost:
+        gray = _rgb2gray(image)
+        buffers.append(gray)
+    else:
+        cost_buffers = _cost_buffers(H, W)
+    if mask is not None:
+        mask = mask.astype(bool)
+        buffers.append(mask)
+    if return_seams:
+        seams = np.zeros((H, W), dtype=int)
+
+    width = W
+    n_removed = 0
+    while True:
+        if k is not None:
+            if n_removed == k:
+                break
+        elif not np.any(mask[:, :width]):
+            break
+
+        weighted_energy = energy[:, :width]
+        if mask is not None:
+            weighted_energy = weighted_energy - 100 * mask[:, :width]
+        if gray is None:
+            cost, paths = _compute_cost_into(weighted_energy, cost_buffers)
+        else:
+            cost, paths = cfunc(gray[:, :width], weighted_energy)
+        end = np.argmin(cost[H - 1])
+        seam = bfunc(paths, end)
+
+        if return_seams:
+            seams[rows, indices[rows, seam]] = n_removed + 1
+        remove_seam_inplace(buffers, seam, width)
+        width -= 1
+        n_removed += 1
+
+        # Recompute the energy on a band around the seam. The two outer
+        # columns of the band are off (one-sided gradient) unless the band
+        # touches the image border, so they are not copied back.
+        l, r = np.min(seam), np.max(seam)
+        start, stop = max(l - 3, 0), min(r + 3, width)
+        band = efunc(take_columns(image, indices[:, start:stop]))
+        a = start + 2 if start > 0 else 0
+        b = stop - 2 if stop < width else width
+        energy[:, a:b] = band[:, a-start:b-start]
+
+    indices = indices[:, :width]
+    if return_seams:
+        return indices, seams
+    return indices
+
+
+def _seams_to_paths(seams, k):
+    """Converts a seams map (as returned by find_seams) to an array of paths.
+
+    Args:
+        seams: numpy array of shape (H, W) where seam number i is stored as
+            the path of value i+1
+        k: number of seams in the map
+
+    Returns:
+        paths: numpy array of shape (k, H) with the column of each seam in each row
+    """
+    rows, cols = np.nonzero(seams)
+    paths = np.empty((k, seams.shape[0]), dtype=int)
+    paths[seams[rows, cols] - 1, rows] = cols
+    return paths
+
+
+def _order_seams(paths, W):
+    """Makes guides for band_seams from the seams removed from a key frame.
+
+    In the columns of the original frame, the seams removed one at a time by
+    carve_lazy can jump over the seams removed before them, and a band could
+    not follow them. The columns of each row are sorted, then spread so that
+    they are strictly increasing and fit in [0, W-1], which gives guides that
+    stay close to the removed seams but only move by one column per row.
+
+    Args:
+        paths: numpy array of shape (k, H) of seam columns
+        W: width of the image
+
+    Returns:
+        paths: numpy array of shape (k, H), strictly increasing along axis 0
+    """
+    k = paths.shape[0]
+    offsets = np.arange(k)[:, None]
+    shifted = np.maximum.accumulate(np.sort(paths, axis=0) - offsets, axis=0)
+    return offsets + np.minimum(shifted, W - k)
+
+
+def band_seams(energy, guides, band):
+    """Finds the lowest energy seam in a band around each guide seam.
+
+    The seam m may only go through the pixels (i, j) with
+    |j - guides[m, i]| <= band. Where two bands overlap, each pixel is left to
+    the closest guide, so the seams never share a pixel and can be removed
+    together. All the seams are found together: the cost of the k bands is
+    computed with a single loop over the rows, like compute_cost, on arrays of
+    shape (k, 2*band+1) instead of (W,). Ties are broken to the left like in
+    compute_cost.
+
+    Args:
+        energy: numpy array of shape (H, W)
+        guides: numpy array of shape (k, H) of guide seam columns, strictly
+            increasing along axis 0
+        band: half width of the band around each guide
+
+    Returns:
+        seams: numpy array of shape (k, H) of seam columns, strictly
+            increasing along axis 0, or None if one of the bands contains no
+            seam (the guide moves too fast between two rows)
+    """
+    H, W = energy.shape
+    k = guides.shape[0]
+    n = 2 * band + 1
+    rows = np.arange(H)
+
+    # First and last column of each band, split halfway between the guides
+    middle = (guides[:-1] + guides[1:] + 1) // 2
+    first = np.concatenate([np.zeros((1, H), dtype=int), middle])
+    last = np.concatenate([middle - 1, np.full((1, H), W - 1)])
+
+    # Energy of the bands, inf outside of the image and of the split
+    offsets = guides - band
+    cols = offsets[:, :, None] + np.arange(n)
+    outside = (cols < first[:, :, None]) | (cols > last[:, :, None])
+    band_energy = energy[rows[:, None], np.clip(cols, 0, W - 1)]
+    band_energy[outside] = np.inf
+
+    # Flat position, in the padded bands of the previous row, of the three
+    # pixels above each pixel of the band. Out of band positions are clipped
+    # on the inf padding.
+    shift = np.diff(offsets, axis=1).T[:, :, None]
+    above = np.empty((H - 1, 3, k, n), dtype=np.intp)
+    for step in range(3):
+        np.add(np.arange(n) + step, shift, out=above[:, step])
+    np.maximum(above, 0, out=above)
+    np.minimum(above, n + 1, out=above)
+    above += ((n + 2) * np.arange(k))[:, None]
+
+    cost = np.full((H, k, n + 2), np.inf)
+    cost[0, :, 1:-1] = band_energy[:, 0]
+    best = np.empty((k, n))
+    for i in range(1, H):
+        neighbours = cost[i - 1].take(above[i - 1])
+        np.minimum(neighbours[0], neighbours[1], out=best)
+        np.minimum(best, neighbours[2], out=best)
+        np.add(band_energy[:, i], best, out=cost[i, :, 1:-1])
+
+    ends = np.argmin(cost[H - 1, :, 1:-1], axis=1)
+    if not np.all(np.isfinite(cost[H - 1, np.arange(k), ends + 1])):
+        return None
+
+    # Once the cost is known, the paths of all rows are found at once
+    above += (k * (n + 2) * np.arange(H - 1))[:, None, None, None]
+    neighbours = cost.take(above)
+    paths = _choose_paths(neighbours[:, 0], neighbours[:, 1], neighbours[:, 2])
+
+    # Backtrack all the seams at once, in columns of the image
+    seams = np.empty((k, H), dtype=int)
+    seams[:, H - 1] = offsets[:, H - 1] + ends
+    seam_index = np.arange(k)
+    for i in range(H - 1, 0, -1):
+        j = seams[:, i] - offsets[:, i]
+        seams[:, i - 1] = seams[:, i] + paths[i - 1, seam_index, j]
+
+    return seams
+
+
+def reduce_video(frames, size, axis=1, band=4, efunc=energy_function):
+    """Reduces the size of the frames of a video with temporally coherent seams.
+
+    The first frame is reduced exactly, like reduce. Each next frame reuses
+    the seams of the previous frame: every seam is searched for again, but only
+    in a band of `band` pixels around its previous position (see band_seams),
+    and all the seams are removed at once. This keeps the seams from jumping
+    between frames, and costs about one compute_cost per frame instead of one
+    per seam. A frame is reduced exactly again if a band contains no seam.
+
+    Frames are read and yielded one at a time, so `frames` can be a generator
+    and the whole video is never held in memory.
+
+    Args:
+        frames: iterable of numpy arrays of shape (H, W, 3), all of the same
+            shape
+        size: size to reduce height or width to (depending on axis)
+        axis: reduce in width (axis=1) or height (axis=0)
+        band: half width of the band searched around each previous seam
+        efunc: energy function to use
+
+    Yields:
+        out: numpy array of shape (size, W, 3) if axis=0, or (H, size, 3) if axis=1
+    """
+    shape = None
+    guides = None
+    for frame in frames:
+        if shape is None:
+            shape = frame.shape
+        assert frame.shape == shape, \
+            "All frames must have shape %s, got %s" % (shape, frame.shape)
+        if axis == 0:
+            frame = np.transpose(frame, (1, 0, 2))
+
+        H, W, _ = frame.shape
+        k = W - size
+        assert k >= 0, "Size must be smaller than %d" % W
+
+        seams = None
+        if guides is not None and k > 0:
+            seams = band_seams(efunc(frame), guides, band)
+
+        if seams is None:
+            # Key frame
+            indices, seam_map = carve_lazy(frame, k, efunc=efunc,
+                                           return_seams=True)
+            out = take_columns(frame, indices)
+            guides = _order_seams(_seams_to_paths(seam_map, k), W)
+        else:
+            # The seams of band_seams never share a pixel, and are the guides
+            # of the next frame as they are
+            keep = np.ones((H, W), dtype=bool)
+            keep[np.arange(H), seams] = False
+            out = frame[keep].reshape(H, size, -1)
+            guides = seams
+
+        if axis == 0:
+            out = np.transpose(out, (1, 0, 2))
+        yield out
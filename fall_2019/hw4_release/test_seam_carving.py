@@ -0,0 +1,293 @@
+"""
+Checks of the faster paths of seam_carving.py against the plain ones.
+
+Usage:
+    python -m pytest test_seam_carving.py
+"""
+
+import numpy as np
+import pytest
+
+import seam_carving as sc
+
+
+def compute_cost_loop(energy):
+    """The original compute_cost: argmin over the three upper neighbours."""
+    H, W = energy.shape
+    cost = np.zeros((H, W))
+    paths = np.zeros((H, W), dtype=int)
+    cost[0] = energy[0]
+    for i in range(1, H):
+        roll_left = np.roll(cost[i-1, :], -1)
+        roll_right = np.roll(cost[i-1, :], 1)
+        paths[i, 0] = np.argmin(cost[i-1, :2])
+        paths[i, W-1] = np.argmin(cost[i-1, W-2:W]) - 1
+        paths[i, 1:W-1] = np.argmin(np.vstack(
+            (roll_right[1:W-1], cost[i-1, 1:W-1], roll_left[1:W-1])), axis=0) - 1
+        cost[i, :] = energy[i, :] + cost[i-1, paths[i, :] + np.arange(W)]
+    return cost, paths
+
+
+def compute_forward_cost_loop(gray, energy):
+    """The original compute_forward_cost, on a grayscale image."""
+    H, W = gray.shape
+    cost = np.zeros((H, W))
+    paths = np.zeros((H, W), dtype=int)
+    cost[0] = energy[0]
+    for j in range(1, W - 1):
+        cost[0, j] += np.abs(gray[0, j+1] - gray[0, j-1])
+    for row in range(1, H):
+        upL = np.insert(cost[row - 1, 0:W - 1], 0, 1e10, axis=0)
+        upM = cost[row - 1, :]
+        upR = np.insert(cost[row - 1, 1:W], W - 1, 1e10, axis=0)
+        I_i_j_P = np.insert(gray[row, 0:W-1], 0, 0, axis=0)
+        I_i_j_M = np.insert(gray[row, 1:W], W-1, 0, axis=0)
+        I_M = gray[row-1, :]
+        C_V = abs(I_i_j_P - I_i_j_M)
+        C_V[0] = 0
+        C_V[-1] = 0
+        C_L = C_V + abs(I_M - I_i_j_P)
+        C_L[0] = 0
+        C_R = C_V + abs(I_M - I_i_j_M)
+        C_R[-1] = 0
+        upchoices = np.concatenate(
+            (upL+C_L, upM+C_V, upR+C_R), axis=0).reshape(3, -1)
+        cost[row] = energy[row] + np.min(upchoices, axis=0)
+        paths[row] = np.argmin(upchoices, axis=0) - 1
+    return cost, paths
+
+
+@pytest.fixture(params=['random', 'flat'])
+def image(request):
+    rng = np.random.RandomState(0)
+    image = rng.rand(30, 40, 3)
+    if request.param == 'flat':
+        # Few gray levels, so that many costs are equal and ties are broken
+        image = np.round(3 * image) / 3
+        image[:, 10:25] = 0.5
+    return image
+
+
+def test_compute_cost_matches_loop(image):
+    energy = sc.energy_function(image)
+    for axis in (0, 1):
+        expected_cost, expected_paths = compute_cost_loop(
+            energy.T if axis == 0 else energy)
+        if axis == 0:
+            expected_cost, expected_paths = expected_cost.T, expected_paths.T
+        cost, paths = sc.compute_cost(None, energy, axis=axis)
+        np.testing.assert_array_equal(cost, expected_cost)
+        np.testing.assert_array_equal(paths, expected_paths)
+
+
+def test_compute_forward_cost_matches_loop(image):
+    gray = image.mean(axis=2)
+    energy = sc.energy_function(image)
+    expected_cost, expected_paths = compute_forward_cost_loop(gray, energy)
+    cost, paths = sc.compute_forward_cost(gray, energy)
+    np.testing.assert_array_equal(cost, expected_cost)
+    np.testing.assert_array_equal(paths, expected_paths)
+
+
+@pytest.mark.parametrize('axis', [0, 1])
+def test_lazy_reduce_matches_eager(image, axis):
+    size = image.shape[axis] - 7
+    for cfunc in (sc.compute_cost, sc.compute_forward_cost):
+        np.testing.assert_array_equal(
+            sc.reduce(image, size, axis=axis, cfunc=cfunc, lazy=True),
+            sc.reduce(image, size, axis=axis, cfunc=cfunc))
+
+
+@pytest.mark.parametrize('axis', [0, 1])
+def test_lazy_find_seams_matches_eager(image, axis):
+    np.testing.assert_array_equal(sc.find_seams(image, 7, axis=axis, lazy=True),
+                                  sc.find_seams(image, 7, axis=axis))
+
+
+def enlarge_loop(image, k):
+    """Duplicates the k seams of find_seams one at a time, in place.
+
+    Each seam is shifted by the number of seams duplicated before it on its
+    left in every row.
+    """
+    seams = sc.find_seams(image, k)
+    columns = [np.where(seams == i+1)[1] for i in range(k)]
+    out = image
+    for i in range(k):
+        seam = columns[i] + np.sum([c < columns[i] for c in columns[:i]],
+                                   axis=0, dtype=int)
+        out = np.stack([np.insert(row, j, row[j], axis=0)
+                        for row, j in zip(out, seam)])
+    return out
+
+
+@pytest.mark.parametrize('axis', [0, 1])
+def test_lazy_enlarge_duplicates_each_seam(image, axis):
+    for k in (1, 9, image.shape[axis] - 2):
+        size = image.shape[axis] + k
+        out = sc.enlarge(image, size, axis=axis, lazy=True)
+        if axis == 0:
+            expected = enlarge_loop(image.transpose(1, 0, 2), k)
+            expected = expected.transpose(1, 0, 2)
+        else:
+            expected = enlarge_loop(image, k)
+        np.testing.assert_array_equal(out, expected)
+
+
+def test_enlarge_of_few_seams(image):
+    # The eager path shifts each seam past the previous one only, which is
+    # the shift of the lazy path for up to two seams
+    for size in (image.shape[1] + 1, image.shape[1] + 2):
+        np.testing.assert_array_equal(sc.enlarge(image, size, lazy=True),
+                                      sc.enlarge(image, size))
+    # The lazy path keeps the type of the image, the eager path gives floats
+    image = (255 * image).astype(np.uint8)
+    assert sc.enlarge(image, image.shape[1] + 3, lazy=True).dtype == np.uint8
+    assert sc.enlarge(image, image.shape[1] + 3).dtype == np.float64
+
+
+def test_lazy_enlarge_duplicates_each_seam_once(image):
+    # Removing the duplicated seams again gives back the image
+    seams = sc.find_seams(image, 9)
+    out = sc.enlarge(image, image.shape[1] + 9, lazy=True)
+    assert sorted(map(tuple, out.reshape(-1, 3))) == sorted(
+        map(tuple, np.concatenate([image.reshape(-1, 3),
+                                   image[seams > 0]])))
+
+
+def test_lazy_remove_object_matches_eager(image):
+    # An object two columns wide: the image is enlarged back by two seams,
+    # for which the eager and lazy enlarge agree
+    mask = np.zeros(image.shape[:2], dtype=bool)
+    mask[10:20, 12:14] = True
+    np.testing.assert_array_equal(sc.remove_object(image, mask, lazy=True),
+                                  sc.remove_object(image, mask))
+
+
+def test_compute_cost_into_matches_compute_cost(image):
+    energy = sc.energy_function(image)
+    buffers = sc._cost_buffers(*energy.shape)
+    for width in (40, 33, 2):
+        cost, paths = sc._compute_cost_into(energy[:, :width], buffers)
+        expected_cost, expected_paths = sc.compute_cost(None, energy[:, :width])
+        np.testing.assert_array_equal(cost, expected_cost)
+        np.testing.assert_array_equal(paths, expected_paths)
+
+
+def test_remove_seam_inplace(image):
+    seam = sc.backtrack_seam(sc.compute_cost(None, sc.energy_function(image))[1], 5)
+    arrays = [image.copy(), image[..., 0].copy()]
+    sc.remove_seam_inplace(arrays, seam, 40)
+    np.testing.assert_array_equal(arrays[0][:, :39], sc.remove_seam(image, seam))
+    np.testing.assert_array_equal(arrays[1][:, :39],
+                                  sc.remove_seam(image[..., 0], seam))
+
+
+def random_seam(rng, H, W, start):
+    """A connected seam starting at column start, kept inside [0, W-1]."""
+    return np.clip(start + np.cumsum(rng.randint(-1, 2, size=H)), 0, W - 1)
+
+
+@pytest.mark.parametrize('axis', [0, 1])
+def test_reduce_fast_matches_reduce(image, axis):
+    size = image.shape[axis] - 7
+    for cfunc in (sc.compute_cost, sc.compute_forward_cost):
+        np.testing.assert_array_equal(
+            sc.reduce_fast(image, size, axis=axis, cfunc=cfunc),
+            sc.reduce(image, size, axis=axis, cfunc=cfunc))
+
+
+def test_reduce_fast_matches_reduce_with_update_cost():
+    # reduce_fast only updates the cost map from 512 columns
+    rng = np.random.RandomState(2)
+    image = rng.rand(12, 520, 3)
+    image[:, 100:300] = 0.5
+    np.testing.assert_array_equal(sc.reduce_fast(image, 510),
+                                  sc.reduce(image, 510))
+
+
+def test_update_energy_and_cost(image):
+    rng = np.random.RandomState(3)
+    H, W, _ = image.shape
+    energy = sc.energy_function(image)
+    cost, paths = sc.compute_cost(None, energy)
+    # Seams along both borders and in the middle
+    for start in (0, 2, W // 2, W - 3, W - 1):
+        seam = random_seam(rng, H, W, start)
+        out = sc.remove_seam(image, seam)
+        new_energy = sc.update_energy(out, energy, seam)
+        np.testing.assert_array_equal(new_energy, sc.energy_function(out))
+
+        new_cost, new_paths = sc.update_cost(cost, paths, energy, new_energy,
+                                             seam)
+        expected_cost, expected_paths = sc.compute_cost(None, new_energy)
+        np.testing.assert_array_equal(new_cost, expected_cost)
+        np.testing.assert_array_equal(new_paths, expected_paths)
+
+
+@pytest.mark.parametrize('cfunc', [sc.compute_cost, sc.compute_forward_cost])
+def test_non_crossing_seams(image, cfunc):
+    cost, paths = cfunc(image, sc.energy_function(image))
+    seams = sc.find_non_crossing_seams(cost, paths, 5)
+    assert len(seams) == 5
+    # The first seam is the optimal seam, for the forward cost too
+    np.testing.assert_array_equal(
+        seams[0], sc.backtrack_seam(paths, np.argmin(cost[-1])))
+    seams = np.array(seams)
+    assert np.all(np.abs(np.diff(seams, axis=1)) <= 1)
+    assert np.all(np.diff(np.sort(seams, axis=0), axis=0) > 0)
+
+
+def test_find_seams_per_pass(image):
+    seams = sc.find_seams(image, 9, seams_per_pass=4)
+    assert np.all(np.sort(seams, axis=1)[:, -9:] == np.arange(1, 10))
+    np.testing.assert_array_equal(sc.find_seams(image, 9, seams_per_pass=1),
+                                  sc.find_seams(image, 9))
+
+
+def test_lazy_rejects_seams_per_pass(image):
+    with pytest.raises(AssertionError):
+        sc.find_seams(image, 9, lazy=True, seams_per_pass=4)
+    with pytest.raises(AssertionError):
+        sc.reduce(image, 31, lazy=True, seams_per_pass=4)
+
+
+def test_band_seams_are_optimal_in_their_band(image):
+    energy = sc.energy_function(image)
+    H, W = energy.shape
+    guides = sc._order_seams(sc._seams_to_paths(sc.find_seams(image, 6), 6), W)
+    band = 3
+    seams = sc.band_seams(energy, guides, band)
+    assert np.all(np.diff(seams, axis=0) > 0)
+
+    # Each seam is the seam of compute_cost over the pixels of its band that
+    # are closer to its guide than to the other guides
+    cols = np.arange(W)
+    for m in range(len(guides)):
+        allowed = np.abs(cols - guides[m][:, None]) <= band
+        if m > 0:
+            allowed &= 2 * cols >= guides[m - 1][:, None] + guides[m][:, None]
+        if m < len(guides) - 1:
+            allowed &= 2 * cols < guides[m][:, None] + guides[m + 1][:, None]
+        cost, paths = sc.compute_cost(None, np.where(allowed, energy, np.inf))
+        np.testing.assert_array_equal(
+            seams[m], sc.backtrack_seam(paths, np.argmin(cost[-1])))
+
+
+@pytest.mark.parametrize('axis', [0, 1])
+def test_reduce_video(image, axis):
+    rng = np.random.RandomState(4)
+    frames = [image, image, np.clip(image + 0.01 * rng.rand(*image.shape), 0, 1)]
+    size = image.shape[axis] - 5
+    outs = list(sc.reduce_video(frames, size, axis=axis))
+    # The first frame is a key frame, reduced exactly
+    np.testing.assert_array_equal(outs[0], sc.reduce(image, size, axis=axis))
+    for frame, out in zip(frames, outs):
+        shape = list(frame.shape)
+        shape[axis] = size
+        assert out.shape == tuple(shape)
+
+
+def test_reduce_video_rejects_frames_of_another_shape(image):
+    with pytest.raises(AssertionError):
+        list(sc.reduce_video([image, image[:, 1:]], 30))
@@ -1,4 +1,5 @@
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from skimage import feature, data, color, exposure, io
 from skimage.transform import rescale, resize, downscale_local_mean
 from skimage.filters import gaussian
@@ -30,7 +31,98 @@ def hog_feature(image, pixel_per_cell=8):
     return (hogFeature, hogImage)
 
 
-def sliding_window(image, base_score, stepSize, windowSize, pixel_per_cell=8):
+def hog_integrals(image, orientations=8):
+    """
+    Integral histogram of the gradient orientations of a whole image.
+
+    The gradients (central differences) and orientation bins are those of
+    skimage's hog: bin i holds the orientations in [180/n * i, 180/n * (i+1))
+    degrees. integral[r, c, i] is the sum of the gradient magnitudes of bin i
+    over image[:r, :c], so the cell histograms of any window take 4 lookups
+    per cell (see hog_windows).
+
+    Args:
+        image: an np array of size (h,w).
+        orientations: number of orientation bins.
+
+    Returns:
+        integral: np array of size (h+1,w+1,orientations).
+    """
+    image = image.astype(float)
+    H, W = image.shape
+    g_row = np.zeros_like(image)
+    g_row[1:-1, :] = image[2:, :] - image[:-2, :]
+    g_col = np.zeros_like(image)
+    g_col[:, 1:-1] = image[:, 2:] - image[:, :-2]
+    magnitude = np.hypot(g_col, g_row)
+    orientation = np.rad2deg(np.arctan2(g_row, g_col)) % 180
+
+    upper = 180. / orientations * np.arange(1, orientations + 1)
+    bins = np.searchsorted(upper, orientation, side='right')
+    # An orientation rounded to 180 is in no bin
+    magnitude[bins == orientations] = 0
+    bins = np.minimum(bins, orientations - 1)
+
+    integral = np.zeros((H + 1, W + 1, orientations))
+    integral[1:, 1:][np.arange(H)[:, None], np.arange(W), bins] = magnitude
+    np.cumsum(integral, axis=0, out=integral)
+    np.cumsum(integral, axis=1, out=integral)
+    return integral
+
+
+def hog_windows(integral, corners, windowSize, pixel_per_cell=8,
+                cells_per_block=(3, 3), eps=1e-5):
+    """
+    hog_feature of many windows of an image from its integral histogram.
+
+    The cell histograms are read from the integral histogram, then normalized
+    by blocks with L2-Hys like skimage's hog, and each feature is normalized
+    by its L2 norm like hog_feature. The gradients are those of the whole
+    image, so the features only differ from hog_feature of the windows on
+    their border pixels, where hog sets the gradients to zero.
+
+    Args:
+        integral: integral histogram of the image, see hog_integrals.
+        corners: np array of size (k,2), top-left (row, column) of k windows.
+        windowSize: a pair of ints that is the height and width of a window.
+        pixel_per_cell: number of pixels in each cell.
+        cells_per_block: number of cells in each block.
+        eps: constant of the block normalization.
+
+    Returns:
+        features: np array of size (k,m), the hog feature of each window.
+    """
+    corners = np.asarray(corners).reshape(-1, 2)
+    n_rows = windowSize[0] // pixel_per_cell
+    n_cols = windowSize[1] // pixel_per_cell
+    rows = corners[:, :1] + pixel_per_cell * np.arange(n_rows + 1)
+    cols = corners[:, 1:] + pixel_per_cell * np.arange(n_cols + 1)
+    vertices = integral[rows[:, :, None], cols[:, None, :]]
+    cells = (vertices[:, 1:, 1:] - vertices[:, :-1, 1:]
+             - vertices[:, 1:, :-1] + vertices[:, :-1, :-1])
+    cells /= pixel_per_cell ** 2
+
+    # (k, block row, block column, cell row, cell column, orientation), the
+    # order of the blocks of hog
+    b_rows, b_cols = cells_per_block
+    blocks = as_strided(cells, writeable=False,
+                        shape=(len(corners), n_rows - b_rows + 1,
+                               n_cols - b_cols + 1, b_rows, b_cols,
+                               cells.shape[-1]),
+                        strides=cells.strides[:3] + cells.strides[1:])
+    axes = (3, 4, 5)
+    blocks = blocks / np.sqrt(np.sum(blocks ** 2, axis=axes, keepdims=True)
+                              + eps ** 2)
+    blocks = np.minimum(blocks, 0.2)
+    blocks = blocks / np.sqrt(np.sum(blocks ** 2, axis=axes, keepdims=True)
+                              + eps ** 2)
+
+    features = blocks.reshape(len(corners), -1)
+    return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+
+def sliding_window(image, base_score, stepSize, windowSize, pixel_per_cell=8,
+                   dense=False, chunk_size=256):
     """ A sliding window that checks each different location in the image,
         and finds which location has the highest hog score. The hog score is computed
         as the dot product between the hog feature of the sliding window and the hog feature
@@ -45,6 +137,11 @@ def sliding_window(image, base_score, stepSize, windowSize, pixel_per_cell=8):
         base_score: hog representation of the object you want to find, an array of size (m,).
         stepSize: an int of the step size to move the window.
         windowSize: a pair of ints that is the height and width of the window.
+        dense: compute the hog features of all the windows from the gradients
+            of the whole image at once (see hog_windows) instead of calling
+            hog_feature on every window.
+        chunk_size: number of windows whose features are computed together
+            when dense.
     Returns:
         max_score: float of the highest hog score.
         maxr: int of row where the max_score is found (top-left of window).
@@ -55,7 +152,7 @@ def sliding_window(image, base_score, stepSize, windowSize, pixel_per_cell=8):
     (max_score, maxr, maxc) = (0, 0, 0)
     winH, winW = windowSize
     H, W = image.shape
-    pad_image = np.lib.pad(
+    pad_image = np.pad(
         image,
         ((winH // 2,
           winH - winH // 2),
@@ -64,6 +161,24 @@ def sliding_window(image, base_score, stepSize, windowSize, pixel_per_cell=8):
         mode='constant')
     response_map = np.zeros((H // stepSize + 1, W // stepSize + 1))
     # YOUR CODE HERE
+    if dense:
+        integral = hog_integrals(pad_image)
+        rr, cc = np.meshgrid(np.arange(0, H+1, stepSize),
+                             np.arange(0, W+1, stepSize), indexing='ij')
+        corners = np.stack([rr.ravel(), cc.ravel()], axis=1)
+        scores = np.concatenate([
+            hog_windows(integral, corners[i:i+chunk_size], windowSize,
+                        pixel_per_cell).dot(base_score)
+            for i in range(0, len(corners), chunk_size)])
+        response_map[:] = scores.reshape(response_map.shape)
+        # First maximum in the order of the loops below
+        best = np.argmax(scores)
+        if scores[best] > max_score:
+            max_score = scores[best]
+            maxr = int(corners[best, 0])-winH//2
+            maxc = int(corners[best, 1])-winW//2
+        return (max_score, maxr, maxc, resize(response_map, (H, W)))
+
     for r in range(0, H+1, stepSize):
         for c in range(0, W+1, stepSize):
             window = pad_image[r:r+winH, c:c+winW]
@@ -124,7 +239,7 @@ def pyramid(image, scale=0.9, minSize=(200, 100)):
 
 
 def pyramid_score(image, base_score, shape, stepSize=20,
-                  scale=0.9, pixel_per_cell=8):
+                  scale=0.9, pixel_per_cell=8, dense=False):
     """
     Calculate the maximum score found in the image pyramid using sliding window.
 
@@ -132,6 +247,7 @@ def pyramid_score(image, base_score, shape, stepSize=20,
         image: np array of (h,w).
         base_score: the hog representation of the object you want to detect.
         shape: shape of window you want to use for the sliding_window.
+        dense: see sliding_window.
 
     Returns:
         max_score: float of the highest hog score.
@@ -150,7 +266,8 @@ def pyramid_score(image, base_score, shape, stepSize=20,
     # YOUR CODE HERE
     for current_scale, img in images:
         score, r, c, response_map = sliding_window(
-            img, base_score, stepSize, shape, pixel_per_cell=pixel_per_cell)
+            img, base_score, stepSize, shape, pixel_per_cell=pixel_per_cell,
+            dense=dense)
         print("score: ", score)
         print("scale: ", current_scale)
         if score > max_score:
@@ -0,0 +1,52 @@
+"""
+Checks of the dense HOG features of detection.py against hog_feature.
+
+Usage:
+    python -m pytest test_detection.py
+"""
+
+import numpy as np
+import pytest
+from skimage import io
+
+import detection
+
+
+@pytest.fixture(scope='module')
+def image():
+    return io.imread('image_0001.jpg', as_gray=True)[50:170, 100:260]
+
+
+@pytest.mark.parametrize('window_size, pixel_per_cell', [
+    ((96, 80), 8), ((64, 64), 8), ((60, 90), 6)])
+def test_hog_windows_match_hog_feature(image, window_size, pixel_per_cell):
+    # With the gradients of each window, hog_windows is hog_feature
+    winH, winW = window_size
+    for r, c in ((0, 0), (7, 31), (image.shape[0] - winH, image.shape[1] - winW)):
+        window = image[r:r + winH, c:c + winW]
+        expected, _ = detection.hog_feature(window, pixel_per_cell)
+        features = detection.hog_windows(detection.hog_integrals(window),
+                                         [[0, 0]], window_size, pixel_per_cell)
+        assert features.shape == (1, len(expected))
+        np.testing.assert_allclose(features[0], expected, atol=1e-7)
+
+
+def test_hog_windows_of_many_windows(image):
+    integral = detection.hog_integrals(image)
+    corners = np.array([[0, 0], [3, 5], [20, 64], [24, 80]])
+    features = detection.hog_windows(integral, corners, (96, 80))
+    for corner, feature in zip(corners, features):
+        np.testing.assert_array_equal(
+            feature, detection.hog_windows(integral, corner, (96, 80))[0])
+
+
+def test_dense_sliding_window_finds_the_same_window(image):
+    base_score, _ = detection.hog_feature(image[20:116, 40:120])
+    max_score, maxr, maxc, response_map = detection.sliding_window(
+        image, base_score, 20, (96, 80))
+    dense = detection.sliding_window(image, base_score, 20, (96, 80),
+                                     dense=True)
+    # The gradients of the windows only differ on their border pixels
+    assert dense[1:3] == (maxr, maxc)
+    assert abs(dense[0] - max_score) < 1e-2
+    np.testing.assert_allclose(dense[3], response_map, atol=0.05)
@@ -0,0 +1,81 @@
+"""
+Checks of the feature cache of util.py.
+
+Usage:
+    python -m pytest test_util.py
+"""
+
+import numpy as np
+import pytest
+from skimage import io
+
+import detection
+import util
+
+
+# Calls of the feature function below
+calls = []
+
+
+def smooth(image, sigma=1):
+    calls.append(sigma)
+    return image * sigma, image.sum()
+
+
+@pytest.fixture(scope='module')
+def image():
+    return io.imread('image_0001.jpg', as_gray=True)[50:170, 100:260]
+
+
+def test_feature_cache_hits(image, tmp_path):
+    cache = util.FeatureCache(str(tmp_path))
+    del calls[:]
+    cached = cache(smooth)
+    for hit in (False, True):
+        result = cached(image)
+        assert isinstance(result, tuple)
+        np.testing.assert_array_equal(result[0], image)
+        assert isinstance(result[0], np.memmap) == hit
+    # Same arguments, passed otherwise, then other arguments
+    cached(image.copy(), 1)
+    cached(image, sigma=2)
+    cached(image.astype(np.float32))
+    assert calls == [1, 2, 1]
+
+
+def test_feature_cache_evicts_least_recently_used(tmp_path):
+    image = np.zeros((100, 100))
+    # Room for two entries of 80KB
+    cache = util.FeatureCache(str(tmp_path), max_bytes=170000)
+    del calls[:]
+    cached = cache(smooth)
+    for sigma in (1, 2, 1, 3, 1, 2):
+        cached(image, sigma)
+    assert calls == [1, 2, 3, 2]
+    assert len(cache.entries()) == 2
+    cache.clear()
+    assert cache.entries() == []
+
+
+def test_cache_hog_feature(image, tmp_path, monkeypatch):
+    # Put the original function back after the test
+    monkeypatch.setattr(detection, 'hog_feature', detection.hog_feature)
+    base_score, _ = detection.hog_feature(image[20:116, 40:120])
+    expected = detection.sliding_window(image, base_score, 30, (96, 80))
+
+    hog_feature = util.cache_hog_feature(str(tmp_path))
+    assert detection.hog_feature is hog_feature
+    feature, hog_image = hog_feature(image)
+    np.testing.assert_array_equal(feature, detection.hog_feature(image)[0])
+    for hit in (False, True):
+        result = detection.sliding_window(image, base_score, 30, (96, 80))
+        assert result[:3] == expected[:3]
+        np.testing.assert_array_equal(result[3], expected[3])
+        if not hit:
+            n_entries = len(util.FeatureCache(str(tmp_path)).entries())
+    # The windows were read from the cache
+    assert len(util.FeatureCache(str(tmp_path)).entries()) == n_entries
+
+    # Caching again does not cache the cached function
+    assert util.cache_hog_feature(str(tmp_path)).__wrapped__ is \
+        hog_feature.__wrapped__
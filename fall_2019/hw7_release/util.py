@@ -1,4 +1,15 @@
+import functools
+import hashlib
+import inspect
+import os
+import re
+import shutil
+import tempfile
+import time
+import types
+
 import numpy as np
+import detection
 from detection import *
 from skimage.transform import rescale, resize, downscale_local_mean
 from skimage.filters import gaussian
@@ -133,3 +144,197 @@ def intersection_over_union(boxA, boxB):
 
     # return the intersection over union value
     return iou
+
+
+class FeatureCache(object):
+    """On-disk cache of the arrays returned by feature functions.
+
+    The cache is a directory with one entry per call, named after a hash of
+    the function name and of its arguments, where array arguments (images)
+    are hashed by content. An entry holds one .npy file per returned array,
+    so that hits are memory-mapped instead of read in memory (the members of
+    a .npz file cannot be memory-mapped). When the entries take more than
+    max_bytes, the least recently used ones are removed.
+
+    Wrap a function with the cache to use it, for instance while tuning the
+    detectors on the same images:
+
+        cache = FeatureCache('features')
+        hog_feature = cache(hog_feature)
+
+    The wrapped functions must be deterministic and return an array, a tuple
+    of arrays or None. Cached arrays are read-only. The arguments are
+    identified by value, and functions by their module and name, so calls
+    with a lambda, a nested function, or an object without a stable repr
+    (like a RandomState) raise a TypeError.
+    """
+
+    def __init__(self, directory, max_bytes=2**30):
+        """
+        Args:
+            directory: directory of the cache, created if needed
+            max_bytes: maximum total size of the cached arrays
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, func):
+        """Wrap func so that its results are read from and saved to the cache."""
+        signature = inspect.signature(func)
+        name = '%s.%s' % (func.__module__, func.__qualname__)
+
+        @functools.wraps(func)
+        def cached(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = self.key(name, bound.arguments)
+            result = self.load(key)
+            if result is _MISSING:
+                result = func(*args, **kwargs)
+                self.save(key, result)
+            return result
+        return cached
+
+    def key(self, name, arguments):
+        """Hash of a function name and of the values of its arguments."""
+        digest = hashlib.sha1(name.encode())
+        for arg, value in arguments.items():
+            digest.update(arg.encode())
+            digest.update(_hash_value(value))
+        return digest.hexdigest()
+
+    def load(self, key):
+        """Cached result of key, memory-mapped, or _MISSING if not cached."""
+        path = os.path.join(self.directory, key)
+        try:
+            names = sorted(os.listdir(path))
+            arrays = [np.load(os.path.join(path, name), mmap_mode='r')
+                      for name in names if name.endswith('.npy')]
+            # Mark the entry as recently used
+            _touch(path)
+        except (FileNotFoundError, ValueError):
+            return _MISSING
+        if 'none' in names:
+            return None
+        if 'tuple' in names:
+            return tuple(arrays)
+        return arrays[0]
+
+    def save(self, key, result):
+        """Write result to the cache, then evict old entries if needed."""
+        if result is None:
+            arrays = ()
+        else:
+            arrays = result if isinstance(result, tuple) else (result,)
+        # The entry is written aside and renamed, so that processes sharing the
+        # cache never read a partial entry
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        for i, array in enumerate(arrays):
+            np.save(os.path.join(tmp, '%03d.npy' % i), np.asarray(array))
+        # Marker files of the results that are not a single array
+        if result is None:
+            open(os.path.join(tmp, 'none'), 'w').close()
+        elif isinstance(result, tuple):
+            open(os.path.join(tmp, 'tuple'), 'w').close()
+        _touch(tmp)
+        try:
+            os.rename(tmp, os.path.join(self.directory, key))
+        except OSError:
+            # Already saved by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """List of (last use, size in bytes, path) of the cached entries."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries until max_bytes is met."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Remove all the cached entries."""
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _touch(path):
+    """Set the modification time of path to now, to the nanosecond.
+
+    The times set by the file system are only as precise as its clock tick,
+    which leaves the entries used within a few milliseconds tied for eviction.
+    """
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+# Result of FeatureCache.load for the keys that are not cached, as None is a
+# result that can be cached
+_MISSING = object()
+
+def _hash_value(value):
+    """Bytes identifying an argument of a cached function.
+
+    Raises a TypeError for the values that are not identified across calls:
+    lambdas and nested functions, whose names are not unique, and objects
+    whose repr holds their address.
+    """
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        header = '%s%s' % (value.dtype.str, value.shape)
+        return header.encode() + hashlib.sha1(value.view(np.uint8)).digest()
+    if isinstance(value, functools.partial):
+        return b'partial' + _hash_value((value.func, value.args,
+                                         value.keywords))
+    if callable(value) and hasattr(value, '__qualname__'):
+        name = '%s.%s' % (getattr(value, '__module__', None), value.__qualname__)
+        if '<' in name:
+            raise TypeError('Cannot identify %s: only module-level functions '
+                            'can be arguments of cached functions' % name)
+        # Methods are bound to an object that is part of the argument
+        owner = getattr(value, '__self__', None)
+        if owner is None or isinstance(owner, (type, types.ModuleType)):
+            return name.encode()
+        return name.encode() + _hash_value(owner)
+    if isinstance(value, (tuple, list)):
+        return b'(' + b','.join(_hash_value(v) for v in value) + b')'
+    if isinstance(value, dict):
+        return _hash_value(sorted(value.items()))
+    text = repr(value)
+    if re.search(r' at 0x[0-9a-fA-F]+', text):
+        raise TypeError('Cannot identify %s: its repr changes between runs'
+                        % text)
+    return text.encode()
+
+
+def cache_hog_feature(directory='features', max_bytes=2**30):
+    """Cache hog_feature on disk for the experiments of the notebook.
+
+    detection.hog_feature is replaced by its cached version, so that
+    sliding_window, pyramid_score and get_heatmap read the features of the
+    windows already seen from the cache too.
+
+    Args:
+        directory: directory of the cache, created if needed
+        max_bytes: maximum total size of the cached features
+
+    Returns:
+        hog_feature: the cached hog_feature
+    """
+    # The original function, if it is already cached
+    func = getattr(detection.hog_feature, '__wrapped__', detection.hog_feature)
+    detection.hog_feature = FeatureCache(directory, max_bytes)(func)
+    return detection.hog_feature
@@ -0,0 +1,161 @@
+"""
+Timing of the blending functions in panorama.py.
+
+Usage:
+    python benchmark.py [image1] [image2]
+
+Matches the two images with simple descriptors and RANSAC, warps them in the
+output space, and reports the time and peak memory of `linear_blend` and of
+`blend_images` (feathering and multi-band), with the fraction of the output
+space covered by the overlap of the two images. Then runs the whole pipeline
+in float32 and float64 and compares the time of each stage, the keypoints,
+matches and transformations found, and the panoramas.
+"""
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from skimage import color, io
+from skimage.feature import corner_peaks
+
+import panorama
+from utils import get_output_space, warp_image, pad
+
+
+def peak_memory(func, *args, **kwargs):
+    """Runs func and returns its output, the elapsed seconds and peak bytes."""
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return out, elapsed, peak
+
+
+def warp_pair(img1, img2, patch_size=5):
+    """Warps img1 and img2 in their output space, zero outside of the images."""
+    keypoints = []
+    descriptors = []
+    for img in (img1, img2):
+        kp = corner_peaks(panorama.harris_corners(img, window_size=3),
+                          threshold_rel=0.05, exclude_border=8)
+        keypoints.append(kp)
+        descriptors.append(panorama.describe_keypoints(
+            img, kp, desc_func=panorama.simple_descriptor,
+            patch_size=patch_size))
+    matches = panorama.match_descriptors(*descriptors, 0.7)
+    np.random.seed(131)
+    H, _ = panorama.ransac(keypoints[0], keypoints[1], matches)
+
+    output_shape, offset = get_output_space(img1, [img2], [H])
+    img1_warped = warp_image(img1, np.eye(3), output_shape, offset)
+    img1_warped[img1_warped == -1] = 0
+    img2_warped = warp_image(img2, H, output_shape, offset)
+    img2_warped[img2_warped == -1] = 0
+    return img1_warped, img2_warped
+
+
+def benchmark_blend(img1_warped, img2_warped):
+    """Prints time and peak memory of linear_blend and blend_images."""
+    overlap = (img1_warped != 0) & (img2_warped != 0)
+    print('output %dx%d, overlap %.1f%%' % (
+        img1_warped.shape + (100 * overlap.mean(),)))
+
+    print('%10s %10s %10s' % ('blending', 'time', 'peak'))
+    _, elapsed, peak = peak_memory(panorama.linear_blend,
+                                   img1_warped, img2_warped)
+    print('%10s %8.1fms %8.1fMB' % ('linear', 1e3 * elapsed, peak / 2**20))
+    for mode in ('feather', 'multiband'):
+        _, elapsed, peak = peak_memory(panorama.blend_images,
+                                       img1_warped, img2_warped, mode)
+        print('%10s %8.1fms %8.1fMB' % (mode, 1e3 * elapsed, peak / 2**20))
+
+
+def run_pipeline(img1, img2, dtype, patch_size=5):
+    """Stitches two images in dtype, returning its results and stage times."""
+    times = {}
+    start = time.perf_counter()
+    img1, img2 = img1.astype(dtype), img2.astype(dtype)
+    keypoints = [corner_peaks(panorama.harris_corners(img, window_size=3),
+                              threshold_rel=0.05, exclude_border=8)
+                 for img in (img1, img2)]
+    times['harris'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    descriptors = [panorama.describe_keypoints(
+        img, kp, desc_func=panorama.simple_descriptor, patch_size=patch_size)
+        for img, kp in zip((img1, img2), keypoints)]
+    times['describe'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matches = panorama.match_descriptors(*descriptors, 0.7)
+    times['match'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    np.random.seed(131)
+    H, _ = panorama.ransac(keypoints[0], keypoints[1], matches)
+    times['ransac'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output_shape, offset = get_output_space(img1, [img2], [H])
+    warped = []
+    for img, transform in ((img1, np.eye(3)), (img2, H)):
+        img_warped = warp_image(img, transform, output_shape, offset,
+                                dtype=dtype)
+        img_warped[img_warped == -1] = 0
+        warped.append(img_warped)
+    merged = panorama.linear_blend(*warped)
+    times['warp+blend'] = time.perf_counter() - start
+
+    return keypoints, descriptors, matches, H, merged, times
+
+
+def compare_precision(img1, img2):
+    """Prints stage times and the differences of float32 against float64."""
+    ref = run_pipeline(img1, img2, np.float64)
+    low = run_pipeline(img1, img2, np.float32)
+
+    print('%10s %10s %10s' % ('stage', 'float64', 'float32'))
+    for stage in ref[-1]:
+        print('%10s %8.1fms %8.1fms' % (stage, 1e3 * ref[-1][stage],
+                                         1e3 * low[-1][stage]))
+
+    n_keypoints = [(len(k64), len(k32),
+                    len(set(map(tuple, k64)) & set(map(tuple, k32))))
+                   for k64, k32 in zip(ref[0], low[0])]
+    matches64 = set(map(tuple, ref[2]))
+    matches32 = set(map(tuple, low[2]))
+    jaccard = len(matches64 & matches32) / max(len(matches64 | matches32), 1)
+    # Displacement of the corners of image 2 between the two transformations
+    r, c = img2.shape
+    corners = pad(np.array([[0, 0], [r, 0], [0, c], [r, c]], dtype=float))
+    shift = np.abs(corners.dot(ref[3]) - corners.dot(low[3])).max()
+    same_shape = ref[4].shape == low[4].shape
+    print('descriptor type %s, panorama type %s' % (low[1][0].dtype,
+                                                    low[4].dtype))
+    for i, counts in enumerate(n_keypoints):
+        print('keypoints of image %d: %d vs %d, %d in common' % ((i + 1,)
+                                                                + counts))
+    print('matches: %d vs %d, Jaccard index %.3f' % (
+        len(matches64), len(matches32), jaccard))
+    print('transformation: corners moved by at most %.2g pixels' % shift)
+    if same_shape:
+        print('panorama: max difference %.2g' % np.abs(ref[4] - low[4]).max())
+    else:
+        print('panorama: shapes differ, %s vs %s' % (ref[4].shape,
+                                                     low[4].shape))
+
+
+if __name__ == "__main__":
+    path1 = sys.argv[1] if len(sys.argv) > 1 else 'yosemite1.jpg'
+    path2 = sys.argv[2] if len(sys.argv) > 2 else 'yosemite2.jpg'
+    img1 = color.rgb2gray(io.imread(path1))
+    img2 = color.rgb2gray(io.imread(path2))
+    benchmark_blend(*warp_pair(img1, img2))
+    print()
+    compare_precision(img1, img2)
@@ -7,14 +7,23 @@ Last modified: 09/27/2018
 Python Version: 3.5+
 """
 
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
-from skimage import filters
+from numpy.lib.stride_tricks import as_strided
+from skimage import filters, img_as_float
 from skimage.feature import corner_peaks
-from skimage.util.shape import view_as_blocks
+from scipy.optimize import least_squares
+from scipy.sparse import lil_matrix
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
+from scipy.ndimage import gaussian_filter
 from scipy.ndimage.filters import convolve
 
-from utils import pad, unpad, get_output_space, warp_image
+from utils import pad, unpad, get_output_space, warp_image, box_filter, \
+    composite_images, composite_warped, warp_box, feather_weights, \
+    FLOAT_DTYPE, float_type
 
 
 def harris_corners(img, window_size=3, k=0.04):
@@ -44,7 +53,6 @@ def harris_corners(img, window_size=3, k=0.04):
     """
 
     H, W = img.shape
-    window = np.ones((window_size, window_size))
 
     response = np.zeros((H, W))
 
@@ -53,10 +61,12 @@ def harris_corners(img, window_size=3, k=0.04):
     dy = filters.sobel_h(img)
 
     # YOUR CODE HERE
-    Ix2 = convolve(dx**2, window)
-    Iy2 = convolve(dy**2, window)
-    Ixy = convolve(dx*dy, window)
-    M = np.zeros((H, W, 2, 2))
+    # Window sums through a summed-area table: same as convolving with
+    # np.ones((window_size, window_size)), at a cost independent of its size
+    Ix2 = box_filter(dx**2, window_size)
+    Iy2 = box_filter(dy**2, window_size)
+    Ixy = box_filter(dx*dy, window_size)
+    M = np.zeros((H, W, 2, 2), dtype=Ix2.dtype)
     M[:, :, 0, 0] = Ix2
     M[:, :, 0, 1] = Ixy
     M[:, :, 1, 0] = Ixy
@@ -81,25 +91,59 @@ def simple_descriptor(patch):
         In this case of normalization, if a denominator is zero, divide by 1 instead.
 
     Args:
-        patch: grayscale image patch of shape (H, W)
+        patch: grayscale image patch of shape (H, W), or a stack of N patches
+            of shape (N, H, W) which are described at once
 
     Returns:
-        feature: 1D array of shape (H * W)
+        feature: 1D array of shape (H * W), or array of shape (N, H * W)
     """
     feature = []
     # YOUR CODE HERE
-    feature = ((patch - np.mean(patch)) / np.std(patch)).flatten().tolist()
+    mean = np.mean(patch, axis=(-2, -1), keepdims=True)
+    std = np.std(patch, axis=(-2, -1), keepdims=True)
+    feature = ((patch - mean) / std).reshape(patch.shape[:-2] + (-1,))
     # END YOUR CODE
     return feature
 
 
+def extract_patches(image, keypoints, patch_size):
+    """
+    Gather the square patches around keypoints into one array.
+
+    The patch of keypoint (y, x) is the same as in describe_keypoints. The
+    patches are read from a strided view of all the windows of the image, so
+    the only copy is the output itself.
+
+    Args:
+        image: grayscale image of shape (H, W)
+        keypoints: 2D array containing a keypoint (y, x) in each row
+        patch_size: size of a square patch at each keypoint
+
+    Returns:
+        patches: array of shape (N, patch_size, patch_size), or None if a patch
+            does not fit in the image
+    """
+    image = np.asarray(image)
+    H, W = image.shape
+    corners = np.asarray(keypoints).reshape(-1, 2) - patch_size // 2
+    if (np.any(corners < 0)
+            or np.any(corners > [H - patch_size, W - patch_size])):
+        return None
+    windows = as_strided(image, writeable=False,
+                         shape=(H - patch_size + 1, W - patch_size + 1,
+                                patch_size, patch_size),
+                         strides=image.strides * 2)
+    return windows[corners[:, 0], corners[:, 1]]
+
+
 def describe_keypoints(image, keypoints, desc_func, patch_size=16):
     """
     Args:
         image: grayscale image of shape (H, W)
         keypoints: 2D array containing a keypoint (y, x) in each row
         desc_func: function that takes in an image patch and outputs
-            a 1D feature vector describing the patch
+            a 1D feature vector describing the patch, or a function of
+            IMAGE_DESCRIPTORS
         patch_size: size of a square patch at each keypoint
 
     Returns:
@@ -109,6 +153,15 @@ def describe_keypoints(image, keypoints, desc_func, patch_size=16):
     image.astype(np.float32)
     desc = []
 
+    if desc_func in IMAGE_DESCRIPTORS:
+        return desc_func(image, keypoints, patch_size)
+
+    # Describe all the patches at once if desc_func supports it
+    if desc_func in STACK_DESCRIPTORS and len(keypoints) > 0:
+        patches = extract_patches(image, keypoints, patch_size)
+        if patches is not None:
+            return np.asarray(desc_func(patches))
+
     for i, kp in enumerate(keypoints):
         y, x = kp
         patch = image[y-(patch_size//2):y+((patch_size+1)//2),
@@ -117,7 +170,117 @@ def describe_keypoints(image, keypoints, desc_func, patch_size=16):
     return np.array(desc)
 
 
-def match_descriptors(desc1, desc2, threshold=0.5):
+def pairwise_distances(desc1, desc2):
+    """
+    Euclidean distances between all pairs of descriptors, in their type.
+
+    Same as cdist for float64 descriptors. cdist computes in float64, so
+    other descriptors use |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, a matrix product
+    in their own type.
+    """
+    dtype = np.result_type(desc1, desc2)
+    if dtype == np.float64 or not np.issubdtype(dtype, np.floating):
+        return cdist(desc1, desc2)
+    squared = ((desc1 * desc1).sum(axis=1)[:, None]
+               + (desc2 * desc2).sum(axis=1) - 2 * desc1 @ desc2.T)
+    return np.sqrt(np.maximum(squared, 0, out=squared), out=squared)
+
+
+def _two_nearest_exact(queries, desc2, chunk_size):
+    """Exact two nearest neighbours from the distances to every descriptor."""
+    rows = np.arange(chunk_size)
+    for start in range(0, len(queries), chunk_size):
+        dists = pairwise_distances(queries[start:start + chunk_size], desc2)
+        n = len(dists)
+        nearest = np.argmin(dists, axis=1)
+        # The second smallest distance, without sorting the rows
+        second = np.partition(dists, 1, axis=1)[:, 1]
+        yield np.stack([dists[rows[:n], nearest], second], axis=1), nearest
+
+
+def _two_nearest_kdtree(queries, desc2, chunk_size):
+    """Exact two nearest neighbours from a KD-tree over desc2."""
+    tree = cKDTree(desc2)
+    for start in range(0, len(queries), chunk_size):
+        dists, indices = tree.query(queries[start:start + chunk_size], k=2)
+        yield dists, indices[:, 0]
+
+
+def _two_nearest_projection(queries, desc2, chunk_size, n_candidates=32,
+                            n_dims=8, seed=0):
+    """Approximate two nearest neighbours through a random projection.
+
+    The descriptors are projected on n_dims random directions, which roughly
+    preserves the distances between them, and a KD-tree over the projected
+    desc2 gives n_candidates neighbours for each query. The candidates are
+    then ranked by their exact distance to the query.
+    """
+    rng = np.random.RandomState(seed)
+    projection = rng.randn(desc2.shape[1], n_dims) / np.sqrt(n_dims)
+    projection = projection.astype(float_type(desc2), copy=False)
+    tree = cKDTree(desc2 @ projection)
+    n_candidates = min(n_candidates, len(desc2))
+    for start in range(0, len(queries), chunk_size):
+        block = queries[start:start + chunk_size]
+        _, candidates = tree.query(block @ projection, k=n_candidates)
+        dists = np.linalg.norm(desc2[candidates] - block[:, None], axis=2)
+        best = np.argpartition(dists, 1, axis=1)[:, :2]
+        best_dists = np.take_along_axis(dists, best, axis=1)
+        # argpartition does not order the two nearest
+        swap = best_dists[:, 0] > best_dists[:, 1]
+        best[swap] = best[swap, ::-1]
+        best_dists[swap] = best_dists[swap, ::-1]
+        yield best_dists, np.take_along_axis(candidates, best[:, :1], axis=1)[:, 0]
+
+
+NEAREST_NEIGHBOURS = {
+    'exact': _two_nearest_exact,
+    'kdtree': _two_nearest_kdtree,
+    'projection': _two_nearest_projection,
+}
+
+
+def two_nearest(desc1, desc2, method='exact', chunk_size=1024, **kwargs):
+    """
+    Find the two nearest neighbours in desc2 of each descriptor of desc1.
+
+    The queries are processed in blocks of chunk_size descriptors, so the
+    memory used does not grow with the number of queries. Methods:
+        'exact': distances to all of desc2 (see pairwise_distances),
+            np.partition for the second nearest. Same results as sorting the
+            rows of cdist(desc1, desc2) for float64 descriptors.
+        'kdtree': KD-tree over desc2. Exact too, faster for low dimensional
+            descriptors.
+        'projection': approximate; KD-tree over a random projection of desc2,
+            see _two_nearest_projection for its kwargs (n_candidates, n_dims,
+            seed).
+
+    Args:
+        desc1: an array of shape (M, P) holding descriptors of size P about M keypoints
+        desc2: an array of shape (N, P) holding descriptors of size P about N keypoints,
+            with N >= 2
+        method: one of the keys of NEAREST_NEIGHBOURS
+        chunk_size: number of descriptors of desc1 queried at once
+
+    Returns:
+        dists: array of shape (M, 2), distances to the nearest and second
+            nearest descriptor of desc2
+        nearest: array of shape (M,), index in desc2 of the nearest descriptor
+    """
+    assert len(desc2) >= 2, 'Need at least two descriptors to match against'
+    search = NEAREST_NEIGHBOURS[method]
+    desc1, desc2 = np.asarray(desc1), np.asarray(desc2)
+    dists = [np.zeros((0, 2), dtype=float_type(desc1))]
+    nearest = [np.zeros(0, dtype=int)]
+    for block_dists, block_nearest in search(desc1, desc2, chunk_size,
+                                             **kwargs):
+        dists.append(block_dists)
+        nearest.append(block_nearest)
+    return np.concatenate(dists), np.concatenate(nearest)
+
+
+def match_descriptors(desc1, desc2, threshold=0.5, method='exact',
+                      return_ratios=False, **kwargs):
     """
     Match the feature descriptors by finding distances between them. A match is formed
     when the distance to the closest vector is much smaller than the distance to the
@@ -132,25 +295,33 @@ def match_descriptors(desc1, desc2, threshold=0.5):
     Args:
         desc1: an array of shape (M, P) holding descriptors of size P about M keypoints
         desc2: an array of shape (N, P) holding descriptors of size P about N keypoints
+        method: nearest neighbour search of two_nearest. 'exact' gives the
+            same matches as the full cdist matrix.
+        return_ratios: also return the distance ratio of each match
+        kwargs: other arguments of two_nearest (chunk_size, ...)
 
     Returns:
         matches: an array of shape (Q, 2) where each row holds the indices of one pair
         of matching descriptors
+        ratios: only if return_ratios, array of shape (Q,) of the ratios of the
+        distances to the closest and second-closest vectors (lower is better)
     """
     matches = []
 
     M = desc1.shape[0]
-    dists = cdist(desc1, desc2)
 
     # YOUR CODE HERE
-    for i in range(M):
-        d = dists[i, :]
-        d_sorted = np.sort(d)
-        if d_sorted[0]/d_sorted[1] < threshold:
-            matches.append([i, np.argmin(d)])
-    matches = np.asarray(matches).reshape(-1, 2)
+    # The two nearest neighbours are found block by block, instead of
+    # building and sorting the whole (M, N) distance matrix
+    dists, nearest = two_nearest(desc1, desc2, method, **kwargs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = dists[:, 0] / dists[:, 1]
+    is_match = ratios < threshold
+    matches = np.stack([np.arange(M)[is_match], nearest[is_match]], axis=1)
     # END YOUR CODE
 
+    if return_ratios:
+        return matches, ratios[is_match]
     return matches
 
 
@@ -190,7 +361,223 @@ def fit_affine_matrix(p1, p2):
     return H
 
 
-def ransac(keypoints1, keypoints2, matches, n_iters=200, threshold=20):
+def _normalizing_transforms(p):
+    """
+    Similarity transforms of Hartley's normalization for sets of points.
+
+    Args:
+        p: array of shape (B, M, 3) of points in homogeneous coordinates
+
+    Returns:
+        T: array of shape (B, 3, 3) such that the points p[b] @ T[b] have
+        their centroid at the origin and a mean distance of sqrt(2) to it
+    """
+    centroid = np.mean(p[..., :2], axis=1)
+    dist = np.mean(np.linalg.norm(p[..., :2] - centroid[:, None], axis=2),
+                   axis=1)
+    scale = np.sqrt(2) / np.maximum(dist, np.finfo(float).eps)
+    T = np.zeros((len(p), 3, 3))
+    T[:, 0, 0] = scale
+    T[:, 1, 1] = scale
+    T[:, 2, :2] = -centroid * scale[:, None]
+    T[:, 2, 2] = 1
+    return T
+
+
+def fit_homography_batch(p1, p2):
+    """
+    Normalized DLT homographies of a batch of samples.
+
+    Like the affine matrices, the homographies act on row vectors:
+    p1[b] ~ p2[b] @ H[b], up to the scale of each point.
+
+    Args:
+        p1: array of shape (B, M, 3) of points in homogeneous coordinates, M >= 4
+        p2: array of shape (B, M, 3) of points in homogeneous coordinates
+
+    Returns:
+        H: array of shape (B, 3, 3), normalized so that H[b, 2, 2] == 1
+    """
+    T1 = _normalizing_transforms(p1)
+    T2 = _normalizing_transforms(p2)
+    q1 = p1 @ T1
+    q2 = p2 @ T2
+
+    # Two equations per point for the 9 entries of G = Hn.T, where Hn is the
+    # homography between the normalized points: q1.T ~ G @ q2.T
+    x, y = q2[..., 0], q2[..., 1]
+    u, v = q1[..., 0], q1[..., 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+    A = np.concatenate([
+        np.stack([-x, -y, -ones, zeros, zeros, zeros, u * x, u * y, u], -1),
+        np.stack([zeros, zeros, zeros, -x, -y, -ones, v * x, v * y, v], -1),
+    ], axis=1)
+    _, _, Vt = np.linalg.svd(A)
+    Hn = np.transpose(Vt[:, -1].reshape(-1, 3, 3), (0, 2, 1))
+
+    H = T2 @ Hn @ np.linalg.inv(T1)
+    return H / H[:, 2:, 2:]
+
+
+def fit_homography(p1, p2):
+    """
+    Fit a homography H such that p2 * H = p1 (up to scale), like fit_affine_matrix.
+
+    Args:
+        p1: an array of shape (M, 2) of points, M >= 4
+        p2: an array of shape (M, 2) of points
+
+    Return:
+        H: a matrix of shape (3, 3) that transforms p2 to p1 in homogeneous
+        coordinates, with H[2, 2] == 1
+    """
+    assert (p1.shape[0] == p2.shape[0]),\
+        'Different number of points in p1 and p2'
+    return fit_homography_batch(pad(p1)[None], pad(p2)[None])[0]
+
+
+def sample_matches(N, n_samples, n_iters, rng=None):
+    """
+    Draw the random samples of all RANSAC iterations at once.
+
+    Without rng, the samples are those of the loop
+
+        for i in range(n_iters):
+            np.random.shuffle(matches)
+            samples = matches[:n_samples]
+
+    used by the auto-grader: the same calls are made to the global numpy
+    random state, but on an array of indices instead of the matches.
+    Otherwise each sample is drawn independently from rng.
+
+    Args:
+        N: number of matches
+        n_samples: number of matches in each sample
+        n_iters: number of samples
+        rng: None, or a np.random.RandomState / np.random.Generator
+
+    Returns:
+        samples: array of shape (n_iters, n_samples) of indices of matches
+    """
+    if rng is None:
+        order = np.arange(N)
+        samples = np.empty((n_iters, n_samples), dtype=int)
+        for i in range(n_iters):
+            np.random.shuffle(order)
+            samples[i] = order[:n_samples]
+        return samples
+    keys = rng.random_sample((n_iters, N)) if isinstance(
+        rng, np.random.RandomState) else rng.random((n_iters, N))
+    return np.argpartition(keys, n_samples - 1, axis=1)[:, :n_samples]
+
+
+def fit_affine_batch(p1, p2):
+    """
+    Least-squares affine matrices of a batch of samples, like fit_affine_matrix.
+
+    Args:
+        p1: array of shape (B, M, 3) of points in homogeneous coordinates
+        p2: array of shape (B, M, 3) of points in homogeneous coordinates
+
+    Returns:
+        H: array of shape (B, 3, 3), H[b] transforms p2[b] to p1[b]
+    """
+    # The pseudo-inverse also gives the minimum norm solution of lstsq for
+    # degenerate samples, and works on stacks of matrices
+    return np.linalg.pinv(p2) @ p1
+
+
+def _refit_affine(p1, p2):
+    """Least-squares affine matrix of all the inliers, as ransac always did."""
+    H, _, _, _ = np.linalg.lstsq(p2, p1, rcond=None)
+    return H
+
+
+def _affine_residuals(H, p1, p2):
+    """Distances between p1 and the points p2 @ H[b] (shape (B, N))."""
+    return np.linalg.norm(p2 @ H - p1, axis=-1)
+
+
+def _projective_residuals(H, p1, p2):
+    """Distances between p1 and the points p2 @ H[b] in the image (shape (B, N))."""
+    projected = p2 @ H
+    with np.errstate(divide='ignore', invalid='ignore'):
+        projected = projected[..., :2] / projected[..., 2:]
+    return np.linalg.norm(projected - p1[..., :2], axis=-1)
+
+
+# Models ransac can estimate. For each model:
+#   fit: least-squares models of a batch of samples (B, M, 3) -> (B, 3, 3)
+#   refit: final model of all the inliers, (M, 3) -> (3, 3)
+#   residuals: errors of a batch of models on every match, -> (B, N)
+#   min_samples: number of matches that determine a model
+MODELS = {
+    'affine': {
+        'fit': fit_affine_batch,
+        'refit': _refit_affine,
+        'residuals': _affine_residuals,
+        'min_samples': 3,
+    },
+    'homography': {
+        'fit': fit_homography_batch,
+        'refit': lambda p1, p2: fit_homography_batch(p1[None], p2[None])[0],
+        'residuals': _projective_residuals,
+        'min_samples': 4,
+    },
+}
+
+
+def sample_prosac(scores, n_samples, n_iters, rng=None):
+    """
+    Draw the samples of all RANSAC iterations with PROSAC.
+
+    PROSAC (Chum and Matas, 2005) samples from the best matches first: the
+    matches are ordered by score, and sample t is drawn from the n(t) best
+    ones, where n(t) grows from n_samples towards N along the schedule of the
+    paper. The rounding of the schedule makes it reach N a little after
+    n_iters samples, so the last samples are drawn from most of the matches.
+    Each sample contains the n(t)-th match and n_samples - 1 of the matches
+    before it.
+
+    Args:
+        scores: array of shape (N,), lower is better (e.g. distance ratios)
+        n_samples: number of matches in each sample
+        n_iters: number of samples
+        rng: np.random.RandomState or np.random.Generator (default: global
+            numpy random state)
+
+    Returns:
+        samples: array of shape (n_iters, n_samples) of indices of matches
+    """
+    if rng is None:
+        rng = np.random
+    N = len(scores)
+    m = n_samples
+
+    # Growth schedule: T[n] is the average number of samples drawn from the
+    # n best matches, out of n_iters samples drawn from all of them
+    # (T[n+1] = T[n] * (n+1) / (n+1-m), and T[N] = n_iters), and the sample
+    # t is drawn from the n best matches once t >= T_prime[n]
+    n = np.arange(m, N + 1)
+    log_T = np.concatenate([[0], np.cumsum(np.log(n[1:] / (n[1:] - m)))])
+    T = n_iters * np.exp(log_T - log_T[-1])
+    T_prime = 1 + np.cumsum(np.concatenate([[0], np.ceil(np.diff(T))]))
+    pool = np.minimum(n[np.searchsorted(T_prime, np.arange(1, n_iters + 1),
+                                        side='right') - 1], N)
+
+    # m - 1 random matches among the pool[t] - 1 best, then match pool[t]
+    keys = rng.random_sample((n_iters, N)) if isinstance(
+        rng, np.random.RandomState) else rng.random((n_iters, N))
+    keys[np.arange(N) >= pool[:, None] - 1] = np.inf
+    samples = np.empty((n_iters, m), dtype=int)
+    samples[:, :m - 1] = np.argpartition(keys, m - 2, axis=1)[:, :m - 1]
+    samples[:, m - 1] = pool - 1
+    return np.argsort(scores, kind='stable')[samples]
+
+
+def ransac(keypoints1, keypoints2, matches, n_iters=200, threshold=20,
+           n_samples=None, batch_size=64, confidence=None, rng=None,
+           model='affine', scores=None, local_optimization=False):
     """
     Use RANSAC to find a robust affine transformation:
 
@@ -220,6 +607,25 @@ def ransac(keypoints1, keypoints2, matches, n_iters=200, threshold=20):
             [index of keypoint1, index of keypoint 2]
         n_iters: the number of iterations RANSAC will run
         threshold: the number of threshold to find inliers
+        n_samples: number of matches in each sample (default: 20% of the
+            matches, as expected by the auto-grader, or the minimum number for
+            the model with PROSAC)
+        batch_size: number of hypotheses fitted and scored together
+        confidence: if given, in [0, 1], stop once the probability of having
+            drawn at least one sample free of outliers reaches confidence,
+            estimated from the best inlier ratio so far (at most n_iters
+            iterations, and always n_iters for a confidence of 1)
+        rng: random generator of the samples, see sample_matches. None draws
+            the same samples as np.random.shuffle on the matches, so results
+            are reproducible with np.random.seed.
+        model: transformation to estimate, a key of MODELS ('affine' or
+            'homography')
+        scores: if given, array of shape (N,) of match qualities (lower is
+            better, like the ratios of match_descriptors). The samples are then
+            drawn with PROSAC (see sample_prosac), best matches first.
+        local_optimization: LO-RANSAC. Every time a hypothesis has more inliers
+            than all the previous ones, the model is refitted on its inliers
+            until their number stops growing.
 
     Returns:
         H: a robust estimation of affine transformation from keypoints2 to
@@ -229,8 +635,14 @@ def ransac(keypoints1, keypoints2, matches, n_iters=200, threshold=20):
     orig_matches = matches.copy()
     matches = matches.copy()
 
+    assert confidence is None or 0 <= confidence <= 1, \
+        'confidence must be between 0 and 1'
+
     N = matches.shape[0]
-    n_samples = int(N * 0.2)
+    estimator = MODELS[model]
+    if n_samples is None:
+        n_samples = int(N * 0.2) if scores is None \
+            else estimator['min_samples']
 
     matched1 = pad(keypoints1[matches[:, 0]])
     matched2 = pad(keypoints2[matches[:, 1]])
@@ -252,23 +664,74 @@ def ransac(keypoints1, keypoints2, matches, n_iters=200, threshold=20):
     '''
 
     # YOUR CODE HERE
-    for i in range(n_iters):
-        np.random.shuffle(matches)
-        samples = matches[:n_samples]
-        sample1 = pad(keypoints1[samples[:, 0]])
-        sample2 = pad(keypoints2[samples[:, 1]])
-        h, _, _, _ = np.linalg.lstsq(sample2, sample1, rcond=None)
-        inliers = np.linalg.norm(matched2.dot(
-            h) - matched1, axis=1) < threshold  # 主要错误就是这里的dist算错了
-        if np.sum(inliers) > n_inliers:
-            n_inliers = np.sum(inliers)
-            max_inliers = inliers
-            H, _, _, _ = np.linalg.lstsq(
-                matched2[max_inliers], matched1[max_inliers], rcond=None)
+    # All the samples are drawn up front (sample_matches reproduces the
+    # shuffles above), then the hypotheses are fitted and scored by batches
+    if scores is None:
+        samples = sample_matches(N, n_samples, n_iters, rng)
+    else:
+        samples = sample_prosac(scores, n_samples, n_iters, rng)
+        ranks = np.empty(N, dtype=int)
+        ranks[np.argsort(scores, kind='stable')] = np.arange(N)
+    n_needed = n_iters
+    done = 0
+    while done < n_needed:
+        batch = samples[done:min(done + batch_size, n_needed)]
+        h = estimator['fit'](matched1[batch], matched2[batch])
+        inliers = estimator['residuals'](h, matched1, matched2) < threshold
+        counts = inliers.sum(axis=1)
+        best = np.argmax(counts)
+        if counts[best] > n_inliers:
+            n_inliers = counts[best]
+            max_inliers = inliers[best]
+            if local_optimization:
+                n_inliers, max_inliers = _local_optimization(
+                    estimator, matched1, matched2, max_inliers, threshold)
+        done += len(batch)
+
+        if confidence is not None and confidence < 1 and n_inliers > 0:
+            # Number of iterations to draw one outlier free sample with
+            # probability confidence, for the current inlier ratio. With
+            # PROSAC, the samples come from the best matches, so the ratio is
+            # that of the matches sampled from so far.
+            if scores is None:
+                inlier_ratio = n_inliers / N
+            else:
+                pool = ranks[samples[done - 1, -1]] + 1
+                inlier_ratio = np.sum(max_inliers[ranks < pool]) / pool
+            # p_good is kept away from 0, where inlier_ratio ** n_samples
+            # underflows for large samples, and from 1
+            eps = np.finfo(float).eps
+            p_good = np.clip(inlier_ratio ** n_samples, eps, 1 - eps)
+            needed = np.log1p(-confidence) / np.log1p(-p_good)
+            n_needed = min(n_iters, int(np.ceil(needed)))
+
+    H = estimator['refit'](matched1[max_inliers], matched2[max_inliers])
     # END YOUR CODE
     return H, orig_matches[max_inliers]
 
 
+def _local_optimization(estimator, matched1, matched2, inliers, threshold,
+                        max_steps=10):
+    """
+    Refit a model on its inliers until their number stops growing (LO-RANSAC).
+
+    Returns:
+        n_inliers: number of inliers of the best refitted model
+        inliers: boolean array of shape (N,) of its inliers
+    """
+    n_inliers = inliers.sum()
+    for _ in range(max_steps):
+        if n_inliers < estimator['min_samples']:
+            break
+        h = estimator['refit'](matched1[inliers], matched2[inliers])
+        new_inliers = estimator['residuals'](h[None], matched1,
+                                             matched2)[0] < threshold
+        if new_inliers.sum() <= n_inliers:
+            break
+        n_inliers, inliers = new_inliers.sum(), new_inliers
+    return n_inliers, inliers
+
+
 def hog_descriptor(patch, pixels_per_cell=(8, 8)):
     """
     Generating hog descriptor by the following steps:
@@ -281,51 +744,140 @@ def hog_descriptor(patch, pixels_per_cell=(8, 8)):
         Normalization makes the descriptor more robust to lighting variations
 
     Args:
-        patch: grayscale image patch of shape (H, W)
+        patch: grayscale image patch of shape (H, W), or a stack of N patches
+            of shape (N, H, W) which are described at once
         pixels_per_cell: size of a cell with shape (M, N)
 
     Returns:
-        block: 1D patch descriptor array of shape ((H*W*n_bins)/(M*N))
+        block: 1D patch descriptor array of shape ((H*W*n_bins)/(M*N)), or
+            array of shape (N, (H*W*n_bins)/(M*N))
     """
-    assert (patch.shape[0] % pixels_per_cell[0] == 0),\
+    assert (patch.shape[-2] % pixels_per_cell[0] == 0),\
         'Heights of patch and cell do not match'
-    assert (patch.shape[1] % pixels_per_cell[1] == 0),\
+    assert (patch.shape[-1] % pixels_per_cell[1] == 0),\
         'Widths of patch and cell do not match'
 
-    n_bins = 9
+    # Each patch has its own gradients, as with filters.sobel_v and sobel_h
+    G, bins = _gradient_bins(patch)
+
+    # Compute histogram per cell
+    # YOUR CODE HERE
+    block = _hog_blocks(G.reshape((-1,) + G.shape[-2:]),
+                        bins.reshape((-1,) + G.shape[-2:]), pixels_per_cell)
+    if patch.ndim == 2:
+        block = block[0]
+    # YOUR CODE HERE
+
+    return block
+
+
+# Sobel kernels of skimage.filters.sobel_v and sobel_h
+SOBEL_V = np.outer([1, 2, 1], [1, 0, -1]) / 4
+SOBEL_H = SOBEL_V.T
+
+
+def _gradient_bins(images, n_bins=9):
+    """
+    Gradient magnitudes and orientation bins of an image or a stack of images.
+
+    The gradients are computed with the kernels of sobel_v and sobel_h for
+    each image of the last two axes separately, in the type sobel_v and
+    sobel_h of the installed scikit-image return: the same gradients as
+    filters.sobel_v and sobel_h of each image.
+
+    Returns:
+        G: gradient magnitudes, of the shape of images
+        bins: orientation bin of each pixel, over [0, 180) degrees
+    """
     degrees_per_bin = 180 // n_bins
 
-    Gx = filters.sobel_v(patch)
-    Gy = filters.sobel_h(patch)
+    images = img_as_float(images)
+    # Older scikit-image versions, like the 0.17 of requirements.txt, return
+    # float64 gradients of float32 images
+    gradient_type = filters.sobel_v(np.zeros((3, 3), images.dtype)).dtype
+    kernel_shape = (1,) * (images.ndim - 2) + (3, 3)
+    Gx = convolve(images, SOBEL_V.reshape(kernel_shape), mode='reflect')
+    Gy = convolve(images, SOBEL_H.reshape(kernel_shape), mode='reflect')
+    Gx = Gx.astype(gradient_type, copy=False)
+    Gy = Gy.astype(gradient_type, copy=False)
 
     # Unsigned gradients
     G = np.sqrt(Gx**2 + Gy**2)
     theta = (np.arctan2(Gy, Gx) * 180 / np.pi) % 180
+    bins = (theta // degrees_per_bin).astype(int) % n_bins
+    return G, bins
 
-    # Group entries of G and theta into cells of shape pixels_per_cell, (M, N)
-    #   G_cells.shape = theta_cells.shape = (H//M, W//N)
-    #   G_cells[0, 0].shape = theta_cells[0, 0].shape = (M, N)
-    G_cells = view_as_blocks(G, block_shape=pixels_per_cell)
-    theta_cells = view_as_blocks(theta, block_shape=pixels_per_cell)
-    rows = G_cells.shape[0]
-    cols = G_cells.shape[1]
 
-    # For each cell, keep track of gradient histrogram of size n_bins
-    cells = np.zeros((rows, cols, n_bins))
+def _hog_blocks(G, bins, pixels_per_cell=(8, 8), n_bins=9):
+    """
+    Normalized HOG blocks of a stack of N patches of gradients, see _gradient_bins.
 
-    # Compute histogram per cell
-    # YOUR CODE HERE
-    for i in range(rows):
-        for j in range(cols):
-            for k in range(pixels_per_cell[0]):
-                for l in range(pixels_per_cell[1]):
-                    cells[i, j, int(theta_cells[i, j, k, l] //
-                                    degrees_per_bin) % 9] += G_cells[i, j, k, l]
-    block = cells.flatten()
-    block = block / np.linalg.norm(block)
-    # YOUR CODE HERE
+    Every pixel is added to the histogram of its cell with a single
+    np.bincount, which adds the pixels of each cell in row-major order, like
+    a loop over them.
 
-    return block
+    Returns:
+        block: array of shape (N, (H*W*n_bins)/(M*N))
+    """
+    N, H, W = G.shape
+    M, P = pixels_per_cell
+
+    # Index of the histogram bin of each pixel, in cells ordered (patch, cell
+    # row, cell column, bin)
+    rows, cols = H // M, W // P
+    cell = (np.arange(H) // M)[:, None] * cols + np.arange(W) // P
+    index = ((np.arange(N)[:, None, None] * (rows * cols) + cell) * n_bins
+             + bins)
+    cells = np.bincount(index.ravel(), weights=G.ravel(),
+                        minlength=N * rows * cols * n_bins)
+
+    block = cells.astype(G.dtype, copy=False).reshape(N, -1)
+    # Row norms as dot products, which round like np.linalg.norm of each row
+    norm = np.sqrt(block[:, None, :] @ block[:, :, None]).reshape(N, 1)
+    return block / norm
+
+
+# Descriptor functions that also accept a stack of patches of shape (N, H, W)
+STACK_DESCRIPTORS = (simple_descriptor, hog_descriptor)
+
+
+def dense_hog_descriptor(image, keypoints, patch_size=16,
+                         pixels_per_cell=(8, 8)):
+    """
+    HOG descriptors of all the keypoints of an image from shared gradients.
+
+    Same descriptor as hog_descriptor of the patches of describe_keypoints,
+    but the gradients are those of the whole image, computed once. They only
+    differ on the border pixels of the patches, where hog_descriptor reflects
+    the patch. The patches may cross the border of the image, whose outside
+    has no gradients.
+
+    Args:
+        image: grayscale image of shape (H, W)
+        keypoints: 2D array containing a keypoint (y, x) in each row
+        patch_size: size of a square patch at each keypoint
+        pixels_per_cell: size of a cell with shape (M, N)
+
+    Returns:
+        desc: array of shape (N, (patch_size**2 * n_bins)/(M*N))
+    """
+    assert (patch_size % pixels_per_cell[0] == 0),\
+        'Heights of patch and cell do not match'
+    assert (patch_size % pixels_per_cell[1] == 0),\
+        'Widths of patch and cell do not match'
+
+    G, bins = _gradient_bins(image)
+    G = np.pad(G, patch_size, mode='constant')
+    bins = np.pad(bins, patch_size, mode='constant')
+    keypoints = np.asarray(keypoints).reshape(-1, 2) + patch_size
+    return _hog_blocks(extract_patches(G, keypoints, patch_size),
+                       extract_patches(bins, keypoints, patch_size),
+                       pixels_per_cell)
+
+
+# Descriptor functions that describe all the keypoints of a whole image, called
+# as desc_func(image, keypoints, patch_size)
+IMAGE_DESCRIPTORS = (dense_hog_descriptor,)
 
 
 def linear_blend(img1_warped, img2_warped):
@@ -359,11 +911,11 @@ def linear_blend(img1_warped, img2_warped):
     left_margin = np.argmax(img2_mask[out_H//2, :].reshape(1, out_W), 1)[0]
 
     # YOUR CODE HERE
-    liner_weights = [
-        (i-left_margin)/(right_margin-left_margin) for i in range(left_margin, right_margin)]
-    left_weight_mat = np.zeros_like(img1_warped, dtype=float)
+    liner_weights = (np.arange(left_margin, right_margin) - left_margin) / \
+        (right_margin - left_margin)
+    left_weight_mat = np.zeros_like(img1_warped, dtype=float_type(img1_warped))
     left_weight_mat[:, :left_margin] = 1.
-    left_weight_mat[:, left_margin:right_margin] = [1-w for w in liner_weights]
+    left_weight_mat[:, left_margin:right_margin] = 1 - liner_weights
     right_weighted_mat = np.zeros_like(left_weight_mat)
     right_weighted_mat[:, right_margin:] = 1.
     right_weighted_mat[:, left_margin:right_margin] = liner_weights
@@ -374,7 +926,203 @@ def linear_blend(img1_warped, img2_warped):
     return merged
 
 
-def stitch_multiple_images(imgs, desc_func=simple_descriptor, patch_size=5):
+def _tile_slices(shape, tile_size, halo, box=None):
+    """Splits box into tiles extended by a halo, in an array of given shape.
+
+    Args:
+        shape: shape (H, W) of the array
+        tile_size: size of the tiles, without their halo
+        halo: width of the halo around the tiles
+        box: (top, left, bottom, right) part of the array to split (default:
+            the whole array)
+
+    Returns:
+        tiles: list of (outer, inner) pairs. outer is the (row, col) slice
+            pair of the tile with its halo, clipped to the array, and inner the
+            slice pair of the tile itself inside outer.
+    """
+    H, W = shape
+    top0, left0, bottom0, right0 = box if box is not None else (0, 0, H, W)
+    tiles = []
+    for top in range(top0, bottom0, tile_size):
+        for left in range(left0, right0, tile_size):
+            bottom = min(top + tile_size, bottom0)
+            right = min(left + tile_size, right0)
+            y0, x0 = max(top - halo, 0), max(left - halo, 0)
+            y1, x1 = min(bottom + halo, H), min(right + halo, W)
+            outer = (slice(y0, y1), slice(x0, x1))
+            inner = (slice(top - y0, bottom - y0), slice(left - x0, right - x0))
+            tiles.append((outer, inner))
+    return tiles
+
+
+def _pyramid_reduce(image):
+    return gaussian_filter(image, 1)[::2, ::2]
+
+
+def _pyramid_expand(image, shape):
+    up = np.zeros(shape, dtype=image.dtype)
+    up[::2, ::2] = image
+    return 4 * gaussian_filter(up, 1)
+
+
+def laplacian_pyramid(image, levels):
+    """Laplacian pyramid of image, the last level being the residual low-pass."""
+    pyramid = []
+    for _ in range(levels - 1):
+        reduced = _pyramid_reduce(image)
+        pyramid.append(image - _pyramid_expand(reduced, image.shape))
+        image = reduced
+    pyramid.append(image)
+    return pyramid
+
+
+def collapse_pyramid(pyramid):
+    """Image of a Laplacian pyramid built by laplacian_pyramid."""
+    image = pyramid[-1]
+    for level in pyramid[-2::-1]:
+        image = level + _pyramid_expand(image, level.shape)
+    return image
+
+
+def _blend_tile(img1, img2, mask1, mask2, mode, radius, levels):
+    """Blend two tiles of warped images, see blend_images."""
+    w1 = (feather_weights(mask1, radius) * mask1).astype(img1.dtype)
+    w2 = (feather_weights(mask2, radius) * mask2).astype(img1.dtype)
+    if mode == 'feather':
+        total = w1 + w2
+        return (w1 * img1 + w2 * img2) / np.where(total > 0, total, 1)
+
+    # Multi-band: each image is first completed with the other one, so that
+    # the pixels outside of it do not bleed in the low frequencies. The
+    # frequency bands are then blended with the Gaussian pyramid of the mask of
+    # the pixels closer to the inside of image 1 than of image 2.
+    img1 = np.where(mask1, img1, img2)
+    img2 = np.where(mask2, img2, img1)
+    weight = (w1 >= w2).astype(img1.dtype)
+    blended = []
+    for band1, band2 in zip(laplacian_pyramid(img1, levels),
+                            laplacian_pyramid(img2, levels)):
+        blended.append(weight * band1 + (1 - weight) * band2)
+        weight = _pyramid_reduce(weight)
+    return collapse_pyramid(blended)
+
+
+def blend_images(img1_warped, img2_warped, mode='feather', radius=32,
+                 levels=4, tile_size=256):
+    """
+    Blend two images warped in the same output space, like linear_blend.
+
+    Only the bounding box of the overlap of the two images is blended, tile
+    by tile, so the cost grows with the overlap and not with the output
+    space. Elsewhere, each pixel comes from the image covering it. Modes:
+        'feather': each image is weighted by the distance to its border,
+            capped at radius pixels.
+        'multiband': the images are split in levels frequency bands
+            (Laplacian pyramid), and each band is blended over a transition
+            as wide as its wavelength, across the line where the two
+            feathering weights are equal.
+
+    Args:
+        img1_warped: Refernce image warped into output space
+        img2_warped: Transformed image warped into output space
+        mode: 'feather' or 'multiband'
+        radius: maximum feathering distance
+        levels: number of levels of the pyramids in 'multiband' mode
+        tile_size: size of the tiles blended at once
+
+    Returns:
+        merged: Merged image in output space
+    """
+    assert mode in ('feather', 'multiband'), 'Unknown blending mode %s' % mode
+    img1_mask = (img1_warped != 0)  # Mask == 1 inside the image
+    img2_mask = (img2_warped != 0)  # Mask == 1 inside the image
+
+    # Outside of the overlap, the images are 0 where they are not defined
+    merged = img1_warped + img2_warped * ~img1_mask
+
+    overlap = img1_mask & img2_mask
+    rows, cols = np.nonzero(overlap)
+    if len(rows) == 0:
+        return merged
+    top, left = rows.min(), cols.min()
+
+    # The halo of the tiles covers the feathering distance, and in multiband
+    # mode the support of the pyramid filters
+    halo = radius + 1
+    if mode == 'multiband':
+        halo += 4 * 2 ** levels
+        # The tiles start on the grid of the coarsest level, so that they are
+        # subsampled like the whole output space
+        step = 2 ** (levels - 1)
+        top, left = top - top % step, left - left % step
+        halo += -halo % step
+        tile_size += -tile_size % step
+    box = (top, left, rows.max() + 1, cols.max() + 1)
+    for outer, inner in _tile_slices(merged.shape, tile_size, halo, box):
+        tile = _blend_tile(img1_warped[outer], img2_warped[outer],
+                           img1_mask[outer], img2_mask[outer],
+                           mode, radius, levels)
+        window = merged[outer][inner]
+        window[overlap[outer][inner]] = tile[inner][overlap[outer][inner]]
+
+    return merged
+
+
+def render_panorama(imgs, transforms, blending=None, out_of_core=False):
+    """
+    Warp images in the frame of the first one and combine them.
+
+    Args:
+        imgs: list of m images
+        transforms: list of m 3x3 transformation matrices, transforms[i] maps
+            the points of imgs[i] to the frame of imgs[0]
+        blending: None to average the overlaps, or a mode of blend_images
+            ('feather' or 'multiband'; only 'feather' with out_of_core)
+        out_of_core: composite the images one at a time in a memory-mapped
+            canvas (see composite_images) instead of warping them all in memory
+
+    Returns:
+        panorama: panorama in the frame of imgs[0], in the floating point type
+            of imgs[0]
+    """
+    output_shape, offset = get_output_space(imgs[0], imgs[1:], transforms[1:])
+    if out_of_core:
+        assert blending in (None, 'feather'), \
+            'Only feathering is supported out of core'
+        radius = 32 if blending == 'feather' else None
+        return composite_images(imgs, transforms, output_shape, offset,
+                                radius=radius, dtype=float_type(imgs[0]))
+
+    img_wraped_vec = [warp_image(
+        imgs[i], transforms[i], output_shape, offset, dtype=float_type(imgs[0]))
+        for i in range(len(imgs))]
+    img_mask_vec = [img_wraped != -1 for img_wraped in img_wraped_vec]
+    for i in range(len(imgs)):
+        img_wraped_vec[i][~img_mask_vec[i]] = 0
+
+    if blending is not None:
+        # Each image is blended in the panorama of the previous ones
+        panorama = img_wraped_vec[0]
+        for i in range(1, len(imgs)):
+            panorama = blend_images(panorama, img_wraped_vec[i], blending)
+        return panorama
+
+    overlap = np.zeros_like(img_wraped_vec[0])
+    for i in range(len(imgs)):
+        overlap += img_mask_vec[i]*1.0
+
+    panorama = np.zeros_like(img_wraped_vec[0])
+    for i in range(len(imgs)):
+        panorama += img_wraped_vec[i]
+    panorama /= np.maximum(overlap, 1)
+
+    return panorama
+
+
+def stitch_multiple_images(imgs, desc_func=simple_descriptor, patch_size=5,
+                           model='affine', prosac=False, out_of_core=False,
+                           blending=None, dtype=FLOAT_DTYPE, **ransac_kwargs):
     """
     Stitch an ordered chain of images together.
 
@@ -383,10 +1131,19 @@ def stitch_multiple_images(imgs, desc_func=simple_descriptor, patch_size=5):
         desc_func: Function that takes in an image patch and outputs
             a 1D feature vector describing the patch
         patch_size: Size of square patch at each keypoint
+        model: transformation between neighbouring images, a key of MODELS
+        prosac: sample the matches with PROSAC, ordered by distance ratio
+        out_of_core: composite the images one at a time in a memory-mapped
+            canvas (see composite_images) instead of warping them all in memory
+        blending: None to average the overlaps, or a mode of blend_images
+            ('feather' or 'multiband'; only 'feather' with out_of_core)
+        dtype: floating point type of the images, features and panorama
+        ransac_kwargs: other arguments of ransac (n_iters, threshold, ...)
 
     Returns:
         panorama: Final panorma image in coordinate frame of reference image
     """
+    imgs = [img.astype(dtype, copy=False) for img in imgs]
     # Detect keypoints in each image
     keypoints = []  # keypoints[i] corresponds to imgs[i]
     for img in imgs:
@@ -404,31 +1161,421 @@ def stitch_multiple_images(imgs, desc_func=simple_descriptor, patch_size=5):
     # Match keypoints in neighboring images
     matches = []  # matches[i] corresponds to matches between
     # descriptors[i] and descriptors[i+1]
+    ratios = []
     for i in range(len(imgs)-1):
-        mtchs = match_descriptors(descriptors[i], descriptors[i+1], 0.7)
+        mtchs, rtios = match_descriptors(descriptors[i], descriptors[i+1], 0.7,
+                                         return_ratios=True)
         matches.append(mtchs)
+        ratios.append(rtios)
 
     # YOUR CODE HERE
     H_vec = [np.eye(3)]
     for i in range(len(imgs)-1):
-        H, _ = ransac(keypoints[i], keypoints[i+1], matches[i])
+        H, _ = ransac(keypoints[i], keypoints[i+1], matches[i], model=model,
+                      scores=ratios[i] if prosac else None, **ransac_kwargs)
         H_vec.append(H@H_vec[-1])
 
-    output_shape, offset = get_output_space(imgs[0], imgs[1:], H_vec[1:])
-    img_wraped_vec = [warp_image(
-        imgs[i], H_vec[i], output_shape, offset) for i in range(len(imgs))]
-    img_mask_vec = [img_wraped != -1 for img_wraped in img_wraped_vec]
-    for i in range(len(imgs)):
-        img_wraped_vec[i][~img_mask_vec[i]] = 0
-
-    overlap = np.zeros_like(img_wraped_vec[0], dtype=float)
-    for i in range(len(imgs)):
-        overlap += img_mask_vec[i]*1.0
-
-    panorama = np.zeros_like(img_wraped_vec[0])
-    for i in range(len(imgs)):
-        panorama += img_wraped_vec[i]
-    panorama /= np.maximum(overlap, 1)
+    panorama = render_panorama(imgs, H_vec, blending, out_of_core)
     # END YOUR CODE
 
     return panorama
+
+
+def _detect_and_describe(img, desc_func, patch_size):
+    """Keypoints and descriptors of one image, as in stitch_multiple_images."""
+    keypoints = corner_peaks(harris_corners(img, window_size=3),
+                             threshold_rel=0.05,
+                             exclude_border=8)
+    descriptors = describe_keypoints(img, keypoints, desc_func=desc_func,
+                                     patch_size=patch_size)
+    return keypoints, descriptors
+
+
+def _estimate_pair(features1, features2, seed, model, prosac, ransac_kwargs):
+    """Transformation from an image to the previous one in the chain.
+
+    The global numpy random state is seeded first, so the result does not
+    depend on the worker process, nor on the other pairs.
+    """
+    (keypoints1, desc1), (keypoints2, desc2) = features1, features2
+    matches, ratios = match_descriptors(desc1, desc2, 0.7, return_ratios=True)
+    np.random.seed(seed)
+    H, _ = ransac(keypoints1, keypoints2, matches, model=model,
+                  scores=ratios if prosac else None, **ransac_kwargs)
+    return H
+
+
+def stitch_parallel(imgs, desc_func=simple_descriptor, patch_size=5,
+                    n_jobs=None, seed=0, model='affine', prosac=False,
+                    dtype=FLOAT_DTYPE, **ransac_kwargs):
+    """
+    Stitch an ordered chain of images together with a pool of processes.
+
+    The work of stitch_multiple_images is pipelined in a process pool:
+        1. features: keypoints and descriptors of every image are computed in
+           parallel;
+        2. estimation: matching and RANSAC of the pair (i, i+1) start as soon
+           as the features of both images are ready (the global random state
+           is seeded with seed + i for the pair, so results are reproducible);
+        3. warping: once the output space is known, i.e. all the transforms,
+           the images are warped in parallel inside their bounding boxes, while
+           the ones already warped are added to the canvas in order (see
+           composite_warped).
+
+    Args:
+        imgs: List of length m containing the ordered chain of m images
+        desc_func: Function that takes in an image patch and outputs
+            a 1D feature vector describing the patch (must be picklable)
+        patch_size: Size of square patch at each keypoint
+        n_jobs: number of worker processes (default: number of CPUs)
+        seed: seed of the RANSAC of the first pair
+        model: transformation between neighbouring images, a key of MODELS
+        prosac: sample the matches with PROSAC, ordered by distance ratio
+        dtype: floating point type of the images, features and panorama
+        ransac_kwargs: other arguments of ransac (n_iters, threshold, ...)
+
+    Returns:
+        panorama: Final panorma image in coordinate frame of reference image,
+            a np.memmap
+        timings: dict of the wall time in seconds of each stage, from the
+            start of its first task to the end of its last one ('features',
+            'estimation', 'warping'), and of the whole stitching ('total')
+    """
+    imgs = [img.astype(dtype, copy=False) for img in imgs]
+    m = len(imgs)
+    start = time.perf_counter()
+    ends = {}
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        # Features, then each pair as soon as its two images are ready
+        features = [None] * m
+        pairs = {}
+        estimation_start = None
+        feature_futures = {
+            pool.submit(_detect_and_describe, img, desc_func, patch_size): i
+            for i, img in enumerate(imgs)}
+        for future in as_completed(feature_futures):
+            i = feature_futures[future]
+            features[i] = future.result()
+            for j in (i - 1, i):
+                if 0 <= j < m - 1 and features[j] is not None \
+                        and features[j + 1] is not None:
+                    if estimation_start is None:
+                        estimation_start = time.perf_counter()
+                    pairs[pool.submit(_estimate_pair, features[j],
+                                      features[j + 1], seed + j, model,
+                                      prosac, ransac_kwargs)] = j
+        ends['features'] = time.perf_counter()
+
+        pair_transforms = [None] * (m - 1)
+        for future in as_completed(pairs):
+            pair_transforms[pairs[future]] = future.result()
+        ends['estimation'] = time.perf_counter()
+        if estimation_start is None:
+            estimation_start = ends['estimation']
+
+        H_vec = [np.eye(3)]
+        for H in pair_transforms:
+            H_vec.append(H@H_vec[-1])
+        output_shape, offset = get_output_space(imgs[0], imgs[1:], H_vec[1:])
+
+        # pool.map yields the warped boxes in order, while the next ones are
+        # still being warped
+        warping_start = time.perf_counter()
+        warped_boxes = pool.map(warp_box, imgs, H_vec,
+                                [output_shape] * m, [offset] * m, [dtype] * m)
+        panorama = composite_warped(warped_boxes, output_shape, dtype=dtype)
+        ends['warping'] = time.perf_counter()
+
+    timings = {
+        'features': ends['features'] - start,
+        'estimation': ends['estimation'] - estimation_start,
+        'warping': ends['warping'] - warping_start,
+        'total': ends['warping'] - start,
+    }
+    return panorama, timings
+
+
+def _transform_points(p, H):
+    """Points p (N x 3, padded) transformed by H, as N x 2 coordinates."""
+    q = p.dot(H)
+    return q[:, :2] / q[:, 2:]
+
+
+def _canvas_box(shape, H):
+    """Bounding box [top, left, bottom, right] of an image transformed by H."""
+    r, c = shape
+    corners = _transform_points(pad(np.array([[0, 0], [r, 0], [0, c], [r, c]],
+                                             dtype=float)), H)
+    return np.concatenate([corners.min(axis=0), corners.max(axis=0)])
+
+
+class PoseGraph(object):
+    """Panorama built incrementally from a graph of pairwise alignments.
+
+    Each image is a node with a global transform to the frame of the first
+    image. Each edge holds the inlier correspondences found by RANSAC between
+    two overlapping images. Instead of chaining the pairwise transforms, whose
+    errors add up along the chain, the global transforms are refined so that
+    all the correspondences agree (a sparse least squares problem: each edge
+    only involves the transforms of its two images).
+
+    Steps to build a panorama:
+        1. Add the images one at a time with `add`. A new image is only
+           matched against the images whose box in the panorama overlaps its
+           predicted box, and only the transforms of the new image and of these
+           neighbours are refined, so the cost of adding an image depends on
+           the number of its neighbours and not on the number of images.
+        2. Optionally refine all the transforms together with `refine`.
+        3. Warp and combine the images with `render`.
+    """
+
+    def __init__(self, desc_func=simple_descriptor, patch_size=5,
+                 model='affine', max_neighbours=4, margin=0.5, min_inliers=8,
+                 max_points=100, dtype=FLOAT_DTYPE, **ransac_kwargs):
+        """
+        Args:
+            desc_func: Function that takes in an image patch and outputs
+                a 1D feature vector describing the patch
+            patch_size: Size of square patch at each keypoint
+            model: transformation between images, a key of MODELS
+            max_neighbours: maximum number of images a new image is matched to
+            margin: the predicted box of a new image is grown by this fraction
+                of the image size on each side before looking for overlaps
+            min_inliers: minimum number of RANSAC inliers to keep an edge
+            max_points: maximum number of correspondences kept per edge
+            dtype: floating point type of the images and features
+            ransac_kwargs: other arguments of ransac (n_iters, threshold, ...)
+        """
+        self.desc_func = desc_func
+        self.patch_size = patch_size
+        self.model = model
+        self.max_neighbours = max_neighbours
+        self.margin = margin
+        self.min_inliers = min_inliers
+        self.max_points = max_points
+        self.dtype = dtype
+        self.ransac_kwargs = ransac_kwargs
+
+        self.images = []
+        self.features = []    # (keypoints, descriptors) of each image
+        self.transforms = []  # global 3x3 transform of each image
+        self.boxes = np.zeros((0, 4))  # box of each image in the panorama
+        self.edges = {}       # (i, j) -> (points of i, points of j), padded
+        self.neighbours = []  # set of the nodes linked to each node
+        self.node_edges = []  # keys (i, j) of the edges of each node
+
+    def __len__(self):
+        return len(self.images)
+
+    def _predict(self):
+        """Predicted transform of the next image, by constant motion."""
+        if len(self) == 1:
+            return self.transforms[0]
+        motion = self.transforms[-1].dot(np.linalg.inv(self.transforms[-2]))
+        return motion.dot(self.transforms[-1])
+
+    def candidates(self, shape, H):
+        """
+        Images whose box in the panorama overlaps that of a new image.
+
+        Args:
+            shape: shape of the new image
+            H: predicted transform of the new image
+
+        Returns:
+            nodes: indices of at most max_neighbours images, by decreasing area
+                of overlap with the (grown) box of the new image
+        """
+        grow = self.margin * np.array(shape, dtype=float)
+        box = _canvas_box(shape, H) + np.concatenate([-grow, grow])
+        top_left = np.maximum(self.boxes[:, :2], box[:2])
+        bottom_right = np.minimum(self.boxes[:, 2:], box[2:])
+        overlap = np.prod(np.maximum(bottom_right - top_left, 0), axis=1)
+        nodes = np.argsort(-overlap, kind='stable')[:self.max_neighbours]
+        return nodes[overlap[nodes] > 0]
+
+    def add(self, img, H=None):
+        """
+        Add an image to the panorama.
+
+        Args:
+            img: image to add
+            H: predicted transform of the image, used to find its neighbours
+                (default: the motion between the last two images is repeated)
+
+        Returns:
+            node: index of the new image
+        """
+        node = len(self)
+        img = img.astype(self.dtype, copy=False)
+        features = _detect_and_describe(img, self.desc_func, self.patch_size)
+        if node == 0:
+            self._add_node(img, features, np.eye(3))
+            return node
+
+        if H is None:
+            H = self._predict()
+        nodes = self.candidates(img.shape, H)
+        if node - 1 not in nodes:
+            # The images are expected to come in a chain
+            nodes = np.append(nodes, node - 1)
+
+        edges = {}
+        best = None
+        for i in nodes.tolist():
+            edge = self._match(self.features[i], features)
+            if edge is None:
+                continue
+            edges[i] = edge
+            if best is None or len(edge[0]) > len(edges[best][0]):
+                best = i
+        if best is None:
+            raise ValueError('The image does not overlap the panorama')
+
+        # Initial transform through the best neighbour, then local refinement
+        points, new_points = edges[best]
+        H_pair = MODELS[self.model]['refit'](points, new_points)
+        self._add_node(img, features, H_pair.dot(self.transforms[best]))
+        for i, (points, new_points) in edges.items():
+            self.edges[(i, node)] = (points, new_points)
+            self.neighbours[i].add(node)
+            self.neighbours[node].add(i)
+            self.node_edges[i].append((i, node))
+            self.node_edges[node].append((i, node))
+        self.refine([node] + list(edges))
+        return node
+
+    def _add_node(self, img, features, H):
+        self.images.append(img)
+        self.features.append(features)
+        self.transforms.append(H)
+        self.boxes = np.vstack([self.boxes, _canvas_box(img.shape, H)])
+        self.neighbours.append(set())
+        self.node_edges.append([])
+
+    def _match(self, features1, features2):
+        """Inlier correspondences between two images, or None if too few."""
+        (keypoints1, desc1), (keypoints2, desc2) = features1, features2
+        matches = match_descriptors(desc1, desc2, 0.7)
+        if len(matches) < max(self.min_inliers, 5 * MODELS[self.model]['min_samples']):
+            return None
+        _, inliers = ransac(keypoints1, keypoints2, matches, model=self.model,
+                            **self.ransac_kwargs)
+        if len(inliers) < self.min_inliers:
+            return None
+        if len(inliers) > self.max_points:
+            keep = np.linspace(0, len(inliers) - 1, self.max_points).astype(int)
+            inliers = inliers[keep]
+        return (pad(keypoints1[inliers[:, 0]].astype(float)),
+                pad(keypoints2[inliers[:, 1]].astype(float)))
+
+    def _parameters(self, H):
+        """Free parameters of a transform of the model."""
+        if self.model == 'affine':
+            return H[:, :2].ravel()
+        return (H / H[2, 2]).ravel()[:8]
+
+    def _transform(self, params):
+        """Transform of the model from its free parameters."""
+        if self.model == 'affine':
+            H = np.zeros((3, 3))
+            H[:, :2] = params.reshape(3, 2)
+            H[2, 2] = 1
+            return H
+        return np.append(params, 1).reshape(3, 3)
+
+    def refine(self, nodes=None):
+        """
+        Refine global transforms so that the correspondences of the edges agree.
+
+        Minimizes the sum of squared distances, in the panorama, between the
+        corresponding points of all the edges touching the refined nodes. The
+        other transforms are fixed, as is the one of the first image.
+
+        Args:
+            nodes: indices of the images to refine (default: all of them)
+
+        Returns:
+            rms: root mean square distance between corresponding points after
+                the refinement, over the edges touching the refined nodes
+        """
+        if nodes is None:
+            nodes = range(len(self))
+        free = sorted(set(nodes) - {0})
+        # Only the edges of the refined nodes, so that refining the neighbours
+        # of a new image does not depend on the size of the graph
+        edges = sorted({edge for node in free
+                        for edge in self.node_edges[node]})
+        if not edges:
+            return 0.0
+
+        n_params = len(self._parameters(self.transforms[0]))
+        column = {node: n_params * k for k, node in enumerate(free)}
+        x0 = np.concatenate([self._parameters(self.transforms[node])
+                             for node in free])
+
+        def transforms(x):
+            return {node: self._transform(x[c:c + n_params])
+                    for node, c in column.items()}
+
+        def residuals(x):
+            H = transforms(x)
+            res = []
+            for i, j in edges:
+                points_i, points_j = self.edges[(i, j)]
+                res.append(_transform_points(points_i, H.get(i, self.transforms[i]))
+                           - _transform_points(points_j, H.get(j, self.transforms[j])))
+            return np.concatenate(res).ravel()
+
+        # Each residual only depends on the transforms of its edge
+        n_residuals = 2 * sum(len(self.edges[edge][0]) for edge in edges)
+        sparsity = lil_matrix((n_residuals, len(x0)), dtype=int)
+        row = 0
+        for i, j in edges:
+            n = 2 * len(self.edges[(i, j)][0])
+            for node in (i, j):
+                if node in column:
+                    sparsity[row:row + n, column[node]:column[node] + n_params] = 1
+            row += n
+
+        result = least_squares(residuals, x0, jac_sparsity=sparsity,
+                               x_scale='jac')
+        for node, H in transforms(result.x).items():
+            self.transforms[node] = H
+            self.boxes[node] = _canvas_box(self.images[node].shape, H)
+        return np.sqrt(np.mean(result.fun ** 2))
+
+    def render(self, blending=None, out_of_core=False):
+        """Panorama of all the images, see render_panorama."""
+        return render_panorama(self.images, self.transforms, blending,
+                               out_of_core)
+
+
+def stitch_incremental(imgs, desc_func=simple_descriptor, patch_size=5,
+                       model='affine', blending=None, out_of_core=False,
+                       **kwargs):
+    """
+    Stitch images together with a PoseGraph.
+
+    The images are added one at a time, then all the transforms are refined
+    together before the panorama is rendered.
+
+    Args:
+        imgs: List of length m of images, each overlapping the previous one
+        desc_func: Function that takes in an image patch and outputs
+            a 1D feature vector describing the patch
+        patch_size: Size of square patch at each keypoint
+        model: transformation between images, a key of MODELS
+        blending: see render_panorama
+        out_of_core: see render_panorama
+        kwargs: other arguments of PoseGraph
+
+    Returns:
+        panorama: Final panorma image in coordinate frame of reference image
+    """
+    graph = PoseGraph(desc_func, patch_size, model, **kwargs)
+    for img in imgs:
+        graph.add(img)
+    graph.refine()
+    return graph.render(blending, out_of_core)
@@ -0,0 +1,518 @@
+"""
+Checks of the vectorized paths of panorama.py against the loops they replaced.
+
+Usage:
+    python -m pytest test_panorama.py
+"""
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+from skimage import filters, io
+from skimage.feature import corner_peaks
+from skimage.util.shape import view_as_blocks
+
+import panorama as pn
+from utils import get_output_space, pad, warp_image
+
+
+def match_descriptors_loop(desc1, desc2, threshold=0.5):
+    """The original match_descriptors: full cdist, one sorted row at a time."""
+    dists = cdist(desc1, desc2)
+    matches = []
+    for i in range(desc1.shape[0]):
+        d_sorted = np.sort(dists[i, :])
+        if d_sorted[0] / d_sorted[1] < threshold:
+            matches.append([i, np.argmin(dists[i, :])])
+    return np.asarray(matches).reshape(-1, 2)
+
+
+def loop_patches(image, keypoints, patch_size):
+    """The patches of describe_keypoints, cut one at a time."""
+    return np.array([image[y - patch_size // 2:y + (patch_size + 1) // 2,
+                           x - patch_size // 2:x + (patch_size + 1) // 2]
+                     for y, x in keypoints])
+
+
+def hog_descriptor_loop(patch, pixels_per_cell=(8, 8)):
+    """The original hog_descriptor: one loop iteration per pixel."""
+    Gx = filters.sobel_v(patch)
+    Gy = filters.sobel_h(patch)
+    G = np.sqrt(Gx**2 + Gy**2)
+    theta = (np.arctan2(Gy, Gx) * 180 / np.pi) % 180
+    G_cells = view_as_blocks(G, block_shape=pixels_per_cell)
+    theta_cells = view_as_blocks(theta, block_shape=pixels_per_cell)
+    rows = G_cells.shape[0]
+    cols = G_cells.shape[1]
+    cells = np.zeros((rows, cols, 9))
+    for i in range(rows):
+        for j in range(cols):
+            for k in range(pixels_per_cell[0]):
+                for l in range(pixels_per_cell[1]):
+                    cells[i, j, int(theta_cells[i, j, k, l] //
+                                    20) % 9] += G_cells[i, j, k, l]
+    block = cells.flatten()
+    return block / np.linalg.norm(block)
+
+
+def dense_hog_loop(image, keypoints, patch_size=16, pixels_per_cell=(8, 8)):
+    """hog_descriptor_loop of the patches, with the gradients of the image.
+
+    The pixels of the patches outside of the image are skipped.
+    """
+    Gx = filters.sobel_v(image)
+    Gy = filters.sobel_h(image)
+    G = np.sqrt(Gx**2 + Gy**2)
+    theta = (np.arctan2(Gy, Gx) * 180 / np.pi) % 180
+    H, W = image.shape
+    M, P = pixels_per_cell
+    desc = []
+    for y, x in keypoints:
+        cells = np.zeros((patch_size // M, patch_size // P, 9))
+        for k in range(patch_size):
+            for l in range(patch_size):
+                r, c = y - patch_size // 2 + k, x - patch_size // 2 + l
+                if 0 <= r < H and 0 <= c < W:
+                    cells[k // M, l // P, int(theta[r, c] // 20) % 9] += G[r, c]
+        block = cells.flatten()
+        desc.append(block / np.linalg.norm(block))
+    return np.array(desc)
+
+
+def ransac_loop(keypoints1, keypoints2, matches, n_iters=200, threshold=20):
+    """The original ransac: one np.random.shuffle and lstsq per iteration."""
+    orig_matches = matches.copy()
+    matches = matches.copy()
+    N = matches.shape[0]
+    n_samples = int(N * 0.2)
+    matched1 = pad(keypoints1[matches[:, 0]])
+    matched2 = pad(keypoints2[matches[:, 1]])
+    max_inliers = np.zeros(N, dtype=bool)
+    n_inliers = 0
+    for i in range(n_iters):
+        np.random.shuffle(matches)
+        samples = matches[:n_samples]
+        sample1 = pad(keypoints1[samples[:, 0]])
+        sample2 = pad(keypoints2[samples[:, 1]])
+        h, _, _, _ = np.linalg.lstsq(sample2, sample1, rcond=None)
+        inliers = np.linalg.norm(matched2.dot(h) - matched1, axis=1) < threshold
+        if np.sum(inliers) > n_inliers:
+            n_inliers = np.sum(inliers)
+            max_inliers = inliers
+            H, _, _, _ = np.linalg.lstsq(
+                matched2[max_inliers], matched1[max_inliers], rcond=None)
+    return H, orig_matches[max_inliers]
+
+
+def linear_blend_loop(img1_warped, img2_warped):
+    """The original linear_blend: ramp weights built in a list."""
+    out_H, out_W = img1_warped.shape
+    img1_mask = (img1_warped != 0)
+    img2_mask = (img2_warped != 0)
+    right_margin = out_W - \
+        np.argmax(np.fliplr(img1_mask)[out_H//2, :].reshape(1, out_W), 1)[0]
+    left_margin = np.argmax(img2_mask[out_H//2, :].reshape(1, out_W), 1)[0]
+    liner_weights = [
+        (i-left_margin)/(right_margin-left_margin) for i in range(left_margin, right_margin)]
+    left_weight_mat = np.zeros_like(img1_warped, dtype=float)
+    left_weight_mat[:, :left_margin] = 1.
+    left_weight_mat[:, left_margin:right_margin] = [1-w for w in liner_weights]
+    right_weighted_mat = np.zeros_like(left_weight_mat)
+    right_weighted_mat[:, right_margin:] = 1.
+    right_weighted_mat[:, left_margin:right_margin] = liner_weights
+    return img1_warped*left_weight_mat+img2_warped*right_weighted_mat
+
+
+def render_loop(imgs, transforms, output_shape, offset):
+    """The compositing tail of the original stitch_multiple_images."""
+    img_wraped_vec = [warp_image(imgs[i], transforms[i], output_shape, offset)
+                      for i in range(len(imgs))]
+    img_mask_vec = [img_wraped != -1 for img_wraped in img_wraped_vec]
+    for i in range(len(imgs)):
+        img_wraped_vec[i][~img_mask_vec[i]] = 0
+    overlap = np.zeros_like(img_wraped_vec[0], dtype=float)
+    for i in range(len(imgs)):
+        overlap += img_mask_vec[i]*1.0
+    panorama = np.zeros_like(img_wraped_vec[0])
+    for i in range(len(imgs)):
+        panorama += img_wraped_vec[i]
+    panorama /= np.maximum(overlap, 1)
+    return panorama
+
+
+def affine_matches(N, inlier_ratio, seed=0):
+    """N matches of keypoints related by an affine transform, or outliers."""
+    rng = np.random.RandomState(seed)
+    points2 = 500 * rng.rand(N, 2)
+    points1 = points2 @ [[0.9, -0.05], [0.1, 1.1]] + [40, -25] + rng.randn(N, 2)
+    outliers = rng.rand(N) >= inlier_ratio
+    points1[outliers] = 500 * rng.rand(outliers.sum(), 2)
+    # Match i is (i, order[i])
+    order = rng.permutation(N)
+    keypoints2 = np.empty_like(points2)
+    keypoints2[order] = points2
+    return points1, keypoints2, np.stack([np.arange(N), order], axis=1)
+
+
+@pytest.fixture(scope='module')
+def img():
+    return io.imread('uttower1.jpg', as_gray=True)
+
+
+@pytest.fixture(scope='module')
+def keypoints(img):
+    rng = np.random.RandomState(0)
+    return np.stack([rng.randint(8, img.shape[0] - 8, 200),
+                     rng.randint(8, img.shape[1] - 8, 200)], axis=1)
+
+
+def test_extract_patches(img, keypoints):
+    for patch_size in (5, 16):
+        np.testing.assert_array_equal(
+            pn.extract_patches(img, keypoints, patch_size),
+            loop_patches(img, keypoints, patch_size))
+    # Patches crossing the border
+    H, W = img.shape
+    assert pn.extract_patches(img, [[7, 20]], 16) is None
+    assert pn.extract_patches(img, [[H - 7, 20]], 16) is None
+    assert pn.extract_patches(img, [[H - 8, W - 8]], 16).shape == (1, 16, 16)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.uint8])
+def test_hog_matches_loop(img, keypoints, dtype):
+    image = (255 * img).astype(dtype) if dtype == np.uint8 else img.astype(dtype)
+    patches = loop_patches(image, keypoints, 16)
+    expected = np.array([hog_descriptor_loop(patch) for patch in patches])
+    # The histograms are the same, but the blocks of float32 patches are
+    # normalized in float32
+    rtol = 1e-6 if dtype == np.float32 else 1e-15
+    desc = pn.hog_descriptor(patches)
+    np.testing.assert_allclose(desc, expected, rtol=rtol)
+    for patch, expected_block in zip(patches[:10], expected):
+        np.testing.assert_allclose(pn.hog_descriptor(patch), expected_block,
+                                   rtol=rtol)
+    np.testing.assert_array_equal(
+        pn.describe_keypoints(image, keypoints, pn.hog_descriptor, 16), desc)
+    if dtype != np.float32:
+        np.testing.assert_array_equal(desc, expected)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_dense_hog_matches_loop(img, keypoints, dtype):
+    image = img.astype(dtype)
+    H, W = image.shape
+    # And patches crossing the border of the image
+    keypoints = np.concatenate([keypoints[:50], [[0, 0], [3, W - 5],
+                                                 [H - 1, 100], [H - 9, W - 8]]])
+    for patch_size in (16, 32):
+        expected = dense_hog_loop(image, keypoints, patch_size)
+        np.testing.assert_allclose(
+            pn.describe_keypoints(image, keypoints, pn.dense_hog_descriptor,
+                                  patch_size),
+            expected, rtol=1e-6 if dtype == np.float32 else 1e-12)
+
+
+@pytest.fixture(scope='module')
+def descriptors():
+    # Half of desc1 are noisy copies of descriptors of desc2
+    rng = np.random.RandomState(1)
+    desc2 = rng.rand(300, 32)
+    desc1 = rng.rand(200, 32)
+    desc1[::2] = desc2[rng.permutation(300)[:100]] + 0.05 * rng.rand(100, 32)
+    return desc1, desc2
+
+
+def test_exact_matches_match_loop(descriptors):
+    expected = match_descriptors_loop(*descriptors, threshold=0.8)
+    assert len(expected) >= 100
+    for method in ('exact', 'kdtree'):
+        for chunk_size in (7, 1024):
+            np.testing.assert_array_equal(
+                pn.match_descriptors(*descriptors, threshold=0.8,
+                                     method=method, chunk_size=chunk_size),
+                expected)
+
+
+def test_two_nearest(descriptors):
+    desc1, desc2 = descriptors
+    dists = cdist(desc1, desc2)
+    expected = np.sort(dists, axis=1)[:, :2]
+    for method in ('exact', 'kdtree'):
+        two, nearest = pn.two_nearest(desc1, desc2, method, chunk_size=64)
+        np.testing.assert_allclose(two, expected, rtol=1e-12)
+        np.testing.assert_array_equal(nearest, np.argmin(dists, axis=1))
+
+
+def test_pairwise_distances_of_duplicates(descriptors):
+    # |a|^2 + |b|^2 - 2ab rounds to small negative numbers for equal
+    # descriptors, which are clamped to 0 instead of giving NaN distances.
+    # Elsewhere the rounding errors are those of float32 squared distances.
+    desc1 = descriptors[0].astype(np.float32)
+    for desc2 in (desc1, desc1 + 1e-4):
+        dists = pn.pairwise_distances(desc1, desc2)
+        assert dists.dtype == np.float32
+        assert not np.any(np.isnan(dists))
+        np.testing.assert_allclose(dists, cdist(desc1, desc2), atol=5e-3)
+    np.testing.assert_array_equal(
+        pn.pairwise_distances(*descriptors), cdist(*descriptors))
+
+
+def test_projection_matches_are_close_to_exact(descriptors):
+    expected = set(map(tuple, match_descriptors_loop(*descriptors, 0.8)))
+    matches = set(map(tuple, pn.match_descriptors(*descriptors, threshold=0.8,
+                                                  method='projection')))
+    # Approximate, but the ratio test keeps the clear matches
+    assert len(matches & expected) >= 0.9 * len(expected)
+    assert len(matches - expected) <= 0.05 * len(expected)
+
+
+def test_ransac_matches_seeded_loop():
+    keypoints1, keypoints2, matches = affine_matches(200, 0.6)
+    np.random.seed(131)
+    expected_H, expected_matches = ransac_loop(keypoints1, keypoints2, matches)
+    for batch_size in (1, 64):
+        np.random.seed(131)
+        H, robust_matches = pn.ransac(keypoints1, keypoints2, matches,
+                                      batch_size=batch_size)
+        np.testing.assert_array_equal(robust_matches, expected_matches)
+        np.testing.assert_allclose(H, expected_H, rtol=1e-9, atol=1e-9)
+
+
+def test_ransac_rng_is_reproducible():
+    keypoints1, keypoints2, matches = affine_matches(200, 0.6)
+    for make_rng in (np.random.RandomState, getattr(np.random, 'default_rng')):
+        results = [pn.ransac(keypoints1, keypoints2, matches, n_iters=50,
+                             n_samples=3, rng=make_rng(5))[1]
+                   for _ in range(2)]
+        np.testing.assert_array_equal(results[0], results[1])
+        assert len(results[0]) >= 100
+
+
+def test_ransac_confidence_with_low_inlier_ratio():
+    # inlier_ratio ** n_samples underflows to 0 with 60 samples: RANSAC must
+    # run all the iterations instead of failing
+    keypoints1, keypoints2, matches = affine_matches(300, 0.17)
+    results = [pn.ransac(keypoints1, keypoints2, matches, n_iters=100,
+                         confidence=confidence, rng=np.random.RandomState(0))
+               for confidence in (None, 0.99, 1)]
+    for H, robust_matches in results[1:]:
+        np.testing.assert_array_equal(H, results[0][0])
+        np.testing.assert_array_equal(robust_matches, results[0][1])
+
+
+def test_ransac_confidence_stops_early():
+    keypoints1, keypoints2, matches = affine_matches(200, 0.9)
+    calls = []
+    fit = pn.MODELS['affine']['fit']
+
+    def counting_fit(p1, p2):
+        calls.append(len(p1))
+        return fit(p1, p2)
+
+    pn.MODELS['affine']['fit'] = counting_fit
+    try:
+        _, robust_matches = pn.ransac(keypoints1, keypoints2, matches,
+                                      n_samples=3, batch_size=1,
+                                      confidence=0.99,
+                                      rng=np.random.RandomState(0))
+    finally:
+        pn.MODELS['affine']['fit'] = fit
+    assert len(calls) < 10
+    assert len(robust_matches) >= 170
+    with pytest.raises(AssertionError):
+        pn.ransac(keypoints1, keypoints2, matches, confidence=1.5)
+
+
+def test_prosac_samples():
+    rng = np.random.RandomState(2)
+    scores = rng.rand(100)
+    order = np.argsort(scores)
+    for make_rng in (np.random.RandomState, getattr(np.random, 'default_rng')):
+        samples = pn.sample_prosac(scores, 4, 300, rng=make_rng(0))
+        np.testing.assert_array_equal(
+            samples, pn.sample_prosac(scores, 4, 300, rng=make_rng(0)))
+        assert samples.shape == (300, 4)
+        assert np.all(np.sort(samples, axis=1)[:, 1:]
+                      != np.sort(samples, axis=1)[:, :-1])
+        # The first samples come from the best matches, the last ones from
+        # most of them
+        ranks = np.argsort(order)[samples]
+        assert np.all(ranks[0] < 4)
+        assert np.all(np.diff(ranks.max(axis=1)) >= 0)
+        assert ranks.max() >= 90
+
+    np.random.seed(3)
+    global_samples = pn.sample_prosac(scores, 4, 300)
+    np.random.seed(3)
+    np.testing.assert_array_equal(pn.sample_prosac(scores, 4, 300),
+                                  global_samples)
+
+
+def test_prosac_ransac_with_generator():
+    keypoints1, keypoints2, matches = affine_matches(200, 0.5)
+    # Inliers get better scores on average
+    inlier = np.linalg.norm(
+        keypoints1[matches[:, 0]]
+        - keypoints2[matches[:, 1]] @ [[0.9, -0.05], [0.1, 1.1]] - [40, -25],
+        axis=1) < 5
+    scores = np.where(inlier, 0.3, 0.6) + 0.2 * np.random.RandomState(0).rand(200)
+    _, robust_matches = pn.ransac(keypoints1, keypoints2, matches, n_iters=50,
+                                  scores=scores,
+                                  rng=getattr(np.random, 'default_rng')(0))
+    np.testing.assert_array_equal(np.sort(robust_matches[:, 0]),
+                                  np.flatnonzero(inlier))
+
+
+def stitch_pair(img1, img2, dtype):
+    """Matches and RANSAC transform of two images, and their blend, in dtype."""
+    imgs = [img1.astype(dtype), img2.astype(dtype)]
+    keypoints = [corner_peaks(pn.harris_corners(img, window_size=3),
+                              threshold_rel=0.05, exclude_border=8)
+                 for img in imgs]
+    descriptors = [pn.describe_keypoints(img, kp, pn.simple_descriptor,
+                                         patch_size=5)
+                   for img, kp in zip(imgs, keypoints)]
+    matches = pn.match_descriptors(*descriptors, 0.7)
+    H, robust_matches = pn.ransac(keypoints[0], keypoints[1], matches,
+                                  rng=np.random.RandomState(131))
+    output_shape, offset = get_output_space(imgs[0], [imgs[1]], [H])
+    warped = []
+    for img, transform in zip(imgs, (np.eye(3), H)):
+        img_warped = warp_image(img, transform, output_shape, offset,
+                                dtype=dtype)
+        img_warped[img_warped == -1] = 0
+        warped.append(img_warped)
+    return matches, H, robust_matches, pn.linear_blend(*warped)
+
+
+def test_float32_pipeline_matches_float64():
+    img1 = io.imread('yosemite1.jpg', as_gray=True)
+    img2 = io.imread('yosemite2.jpg', as_gray=True)
+    matches64, H64, robust64, merged64 = stitch_pair(img1, img2, np.float64)
+    matches32, H32, robust32, merged32 = stitch_pair(img1, img2, np.float32)
+    assert merged64.dtype == np.float64
+    assert merged32.dtype == np.float32
+
+    # The same matches, and the same inliers of the same RANSAC samples
+    assert len(matches64) > 50
+    np.testing.assert_array_equal(matches32, matches64)
+    np.testing.assert_array_equal(robust32, robust64)
+    # The transforms move the corners of image 2 by less than 0.1 pixel
+    r, c = img2.shape
+    corners = pad(np.array([[0, 0], [r, 0], [0, c], [r, c]], dtype=float))
+    np.testing.assert_allclose(corners.dot(H32), corners.dot(H64), atol=0.1)
+    # and the panoramas differ by the rounding of float32
+    assert merged32.shape == merged64.shape
+    np.testing.assert_allclose(merged32, merged64, atol=1e-5)
+
+
+@pytest.fixture(scope='module')
+def warped_pair():
+    # Two images warped in a 200x400 output space, overlapping on a skewed band
+    # wider than the halo of the tiles
+    rng = np.random.RandomState(6)
+    rows, cols = np.indices((200, 400))
+    img1 = np.where((cols < 260 + rows // 3) & (rows < 190),
+                    0.1 + rng.rand(200, 400), 0)
+    img2 = np.where((cols >= 90 + rows // 4) & (rows >= 5),
+                    0.1 + rng.rand(200, 400), 0)
+    return img1, img2
+
+
+def test_linear_blend_matches_loop(warped_pair):
+    np.testing.assert_allclose(pn.linear_blend(*warped_pair),
+                               linear_blend_loop(*warped_pair),
+                               rtol=1e-12, atol=1e-12)
+
+
+def test_laplacian_pyramid_collapses_to_image(img):
+    image = img[:100, :150]
+    np.testing.assert_allclose(
+        pn.collapse_pyramid(pn.laplacian_pyramid(image, 4)), image,
+        rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('mode', ['feather', 'multiband'])
+def test_tiled_blend_matches_untiled(warped_pair, mode):
+    img1, img2 = warped_pair
+    mask1, mask2 = img1 != 0, img2 != 0
+    for levels, tile_size in ((4, 50), (3, 256)):
+        # Untiled: the whole output space in one tile
+        expected = pn._blend_tile(img1, img2, mask1, mask2, mode, 16, levels)
+        merged = pn.blend_images(img1, img2, mode, radius=16, levels=levels,
+                                 tile_size=tile_size)
+        # Each pixel outside of the overlap comes from the image covering it
+        only1, only2 = mask1 & ~mask2, mask2 & ~mask1
+        np.testing.assert_array_equal(merged[only1], img1[only1])
+        np.testing.assert_array_equal(merged[only2], img2[only2])
+        assert np.all(merged[~mask1 & ~mask2] == 0)
+        overlap = mask1 & mask2
+        np.testing.assert_allclose(merged[overlap], expected[overlap],
+                                   rtol=1e-12, atol=1e-12)
+
+
+@pytest.fixture(scope='module')
+def crops():
+    # Overlapping crops of one image, and their transforms to the first one
+    image = io.imread('yosemite1.jpg', as_gray=True)
+    crops = [image[20 * i:20 * i + 200, 70 * i:70 * i + 220] for i in range(4)]
+    transforms = [np.array([[1, 0, 0], [0, 1, 0], [20 * i, 70 * i, 1]],
+                           dtype=float) for i in range(4)]
+    return crops, transforms
+
+
+def test_render_panorama_matches_loop(crops):
+    imgs, transforms = crops
+    output_shape, offset = pn.get_output_space(imgs[0], imgs[1:],
+                                               transforms[1:])
+    np.testing.assert_allclose(
+        pn.render_panorama(imgs, transforms),
+        render_loop(imgs, transforms, output_shape, offset), rtol=1e-6)
+
+
+def test_pose_graph_recovers_transforms(crops):
+    imgs, transforms = crops
+    graph = pn.PoseGraph(rng=np.random.RandomState(0))
+    for img in imgs:
+        graph.add(img)
+    # Crop 3 does not overlap crop 0, whose box is not a candidate
+    assert graph.neighbours == [{1, 2}, {0, 2, 3}, {0, 1, 3}, {1, 2}]
+    assert [sorted(edges) for edges in graph.node_edges] == [
+        [(0, 1), (0, 2)], [(0, 1), (1, 2), (1, 3)], [(0, 2), (1, 2), (2, 3)],
+        [(1, 3), (2, 3)]]
+    assert graph.refine() < 2
+    corners = pad(np.array([[0, 0], [200, 0], [0, 220], [200, 220]], dtype=float))
+    for H, expected in zip(graph.transforms, transforms):
+        np.testing.assert_allclose(pn._transform_points(corners, H),
+                                   pn._transform_points(corners, expected),
+                                   atol=3)
+    np.testing.assert_array_equal(graph.render(),
+                                  pn.render_panorama(graph.images,
+                                                     graph.transforms))
+
+
+class UnscannableDict(dict):
+    """Dictionary of edges that fails when all its items are read."""
+
+    def __iter__(self):
+        raise AssertionError('all the edges of the graph were scanned')
+
+    keys = values = items = __iter__
+
+
+def test_pose_graph_refines_locally(crops):
+    imgs, _ = crops
+    graph = pn.PoseGraph(rng=np.random.RandomState(0))
+    graph.edges = UnscannableDict()
+    for img in imgs:
+        graph.add(img)
+    # Adding the images and refining one of them only reads its own edges
+    assert graph.refine([3]) < 3
+
+
+def test_pose_graph_rejects_unrelated_image(crops):
+    imgs, _ = crops
+    graph = pn.PoseGraph(rng=np.random.RandomState(0))
+    graph.add(imgs[0])
+    with pytest.raises(ValueError):
+        graph.add(np.random.RandomState(1).rand(200, 220))
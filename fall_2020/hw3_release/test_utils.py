@@ -0,0 +1,200 @@
+"""
+Checks of the compositing and caching helpers of utils.py.
+
+Usage:
+    python -m pytest test_utils.py
+"""
+
+import functools
+
+import numpy as np
+import pytest
+from scipy.ndimage import affine_transform
+
+import utils
+
+
+def warp_image_full(img, H, output_shape, offset):
+    """The original warp_image: the whole output space, in float32."""
+    Hinv = np.linalg.inv(H)
+    m = Hinv.T[:2,:2]
+    b = Hinv.T[:2,2]
+    return affine_transform(img.astype(np.float32), m, b+offset, output_shape,
+                            cval=-1)
+
+
+def average_loop(imgs, transforms, output_shape, offset):
+    """The original panorama of stitch_multiple_images: full warps, averaged."""
+    img_wraped_vec = [warp_image_full(img, H, output_shape, offset)
+                      for img, H in zip(imgs, transforms)]
+    img_mask_vec = [img_wraped != -1 for img_wraped in img_wraped_vec]
+    for i in range(len(imgs)):
+        img_wraped_vec[i][~img_mask_vec[i]] = 0
+    overlap = np.zeros_like(img_wraped_vec[0], dtype=float)
+    for i in range(len(imgs)):
+        overlap += img_mask_vec[i]*1.0
+    panorama = np.zeros_like(img_wraped_vec[0])
+    for i in range(len(imgs)):
+        panorama += img_wraped_vec[i]
+    panorama /= np.maximum(overlap, 1)
+    return panorama
+
+
+def translation(dy, dx):
+    """Transformation matrix (acting on row vectors) of a translation."""
+    return np.array([[1, 0, 0], [0, 1, 0], [dy, dx, 1]], dtype=float)
+
+
+@pytest.fixture(scope='module')
+def imgs():
+    rng = np.random.RandomState(0)
+    return [rng.rand(30, 40), rng.rand(25, 35), rng.rand(30, 30)]
+
+
+@pytest.fixture(scope='module')
+def transforms():
+    angle = 0.2
+    rotation = np.array([[np.cos(angle), np.sin(angle), 0],
+                         [-np.sin(angle), np.cos(angle), 0],
+                         [12.5, -6, 1]])
+    return [np.eye(3), translation(10, 20.5), rotation]
+
+
+def test_composite_images_matches_full_warps(imgs, transforms, tmp_path):
+    output_shape, offset = utils.get_output_space(imgs[0], imgs[1:],
+                                                  transforms[1:])
+    expected = average_loop(imgs, transforms, output_shape, offset)
+    for chunk_rows in (7, 1024):
+        panorama = utils.composite_images(
+            iter(imgs), iter(transforms), output_shape, offset,
+            filename=str(tmp_path / 'canvas.dat'), chunk_rows=chunk_rows,
+            dtype=np.float32)
+        assert isinstance(panorama, np.memmap)
+        assert panorama.dtype == np.float32
+        np.testing.assert_allclose(panorama, expected, rtol=1e-6, atol=1e-6)
+
+
+def test_warp_box_matches_full_warp(imgs, transforms):
+    output_shape, offset = utils.get_output_space(imgs[0], imgs[1:],
+                                                  transforms[1:])
+    for img, H in zip(imgs, transforms):
+        full = warp_image_full(img, H, output_shape, offset)
+        (top, left, bottom, right), warped = utils.warp_box(
+            img, H, output_shape, offset)
+        np.testing.assert_allclose(warped, full[top:bottom, left:right],
+                                   rtol=1e-6, atol=1e-6)
+        # All the pixels outside of the box are -1
+        full[top:bottom, left:right] = -1
+        assert np.all(full == -1)
+
+
+def test_warp_image_type(imgs, transforms):
+    img = imgs[2]
+    output_shape, offset = utils.get_output_space(img, [img], transforms[2:])
+    # float32 by default, like the original warp_image
+    for image in (img, img.astype(np.float32), (255 * img).astype(np.uint8)):
+        np.testing.assert_array_equal(
+            utils.warp_image(image, transforms[2], output_shape, offset),
+            warp_image_full(image, transforms[2], output_shape, offset))
+    warped = utils.warp_image(img, transforms[2], output_shape, offset,
+                              dtype=np.float64)
+    assert warped.dtype == np.float64
+    np.testing.assert_allclose(
+        warped, warp_image_full(img, transforms[2], output_shape, offset),
+        rtol=1e-6, atol=1e-6)
+
+    projective = transforms[2] + [[0, 0, 1e-4], [0, 0, 2e-4], [0, 0, 0]]
+    for dtype in (np.float32, np.float64):
+        assert utils.warp_image(img, projective, output_shape, offset,
+                                dtype=dtype).dtype == dtype
+        assert utils.warp_box(img, projective, output_shape, offset,
+                              dtype)[1].dtype == dtype
+
+
+def test_warp_box_skips_images_outside_of_the_output_space(imgs, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('warp_image called on an empty box')
+
+    monkeypatch.setattr(utils, 'warp_image', fail)
+    for H in (translation(100, 0), translation(0, -200)):
+        box, warped = utils.warp_box(imgs[0], H, (40, 50), np.zeros(2))
+        assert warped.size == 0
+        assert warped.dtype == np.float32
+
+    monkeypatch.undo()
+    transforms = [np.eye(3), translation(5, 10), translation(500, 500)]
+    np.testing.assert_array_equal(
+        utils.composite_images(imgs, transforms, (40, 50), np.zeros(2)),
+        utils.composite_images(imgs[:2], transforms[:2], (40, 50), np.zeros(2)))
+
+
+# Calls of the feature functions below
+calls = []
+
+
+def smooth(image, sigma=1):
+    calls.append(sigma)
+    return image * sigma, image.sum()
+
+
+def nothing(image):
+    calls.append(None)
+
+
+def test_feature_cache_hits(imgs, tmp_path):
+    cache = utils.FeatureCache(str(tmp_path))
+    del calls[:]
+    cached = cache(smooth)
+    for hit in (False, True):
+        result = cached(imgs[0])
+        assert isinstance(result, tuple)
+        np.testing.assert_array_equal(result[0], imgs[0])
+        assert isinstance(result[0], np.memmap) == hit
+    # Same arguments, passed otherwise
+    cached(imgs[0].copy(), 1)
+    assert calls == [1]
+    # Another image, another parameter
+    cached(imgs[1])
+    cached(imgs[0], sigma=2)
+    cached(imgs[0].astype(np.float32))
+    assert calls == [1, 1, 2, 1]
+
+    # None is cached too
+    cached = cache(nothing)
+    assert cached(imgs[0]) is None
+    assert cached(imgs[0]) is None
+    assert calls == [1, 1, 2, 1, None]
+
+
+def test_feature_cache_keys_of_functions(tmp_path):
+    key = utils.FeatureCache(str(tmp_path)).key
+
+    def nested(x):
+        return x
+
+    for func in (lambda x: x, lambda x: 2 * x, nested):
+        with pytest.raises(TypeError):
+            key('f', {'func': func})
+    with pytest.raises(TypeError):
+        key('f', {'rng': np.random.RandomState(0)})
+
+    keys = [key('f', {'func': func}) for func in (
+        np.mean, np.median, functools.partial(np.mean, axis=0),
+        functools.partial(np.mean, axis=1), functools.partial(smooth, sigma=2),
+        utils.warp_image, [1, 2].append, [1, 3].append)]
+    assert len(set(keys)) == len(keys)
+    assert keys[2] == key('f', {'func': functools.partial(np.mean, axis=0)})
+
+
+def test_feature_cache_evicts_least_recently_used(tmp_path):
+    image = np.zeros((100, 100))
+    # Room for two entries of 80KB
+    cache = utils.FeatureCache(str(tmp_path), max_bytes=170000)
+    del calls[:]
+    cached = cache(smooth)
+    for sigma in (1, 2, 1, 3, 1, 2):
+        cached(image, sigma)
+    assert calls == [1, 2, 3, 2]
+    assert len(cache.entries()) == 2
+    cache.clear()
+    assert cache.entries() == []
@@ -1,10 +1,67 @@
+import functools
+import hashlib
+import inspect
+import os
+import re
+import shutil
+import tempfile
+import time
+import types
+
 import numpy as np
-from scipy.ndimage import affine_transform
+from scipy.ndimage import affine_transform, distance_transform_edt, \
+    map_coordinates
 
 # Functions to convert points to homogeneous coordinates and back
 pad = lambda x: np.hstack([x, np.ones((x.shape[0], 1))])
 unpad = lambda x: x[:,:-1]
 
+# Floating point type of the images and features in the stitching functions.
+# float32 halves the memory traffic of the pixel-wise stages; pass
+# dtype=np.float64 to them for reference results. The other functions keep
+# the floating point type of their input, and the geometry (keypoint
+# coordinates, transformations) is always computed in float64.
+FLOAT_DTYPE = np.float32
+
+def float_type(array):
+    """Type of computations on array: its own if floating point, else float64."""
+    dtype = np.asarray(array).dtype
+    if np.issubdtype(dtype, np.floating):
+        return dtype
+    return np.dtype(np.float64)
+
+# Same summed-area table as in fall_2020/hw7_release/motion.py and
+# fall_2021/hw1_release/filters.py: homework folders do not import each other.
+def integral_image(image):
+    """Summed-area table of an image, with a leading row and column of zeros.
+
+    table[..., i, j] is the sum of image[..., :i, :j]; leading axes are a
+    stack of images.
+    """
+    shape = image.shape[:-2] + (image.shape[-2] + 1, image.shape[-1] + 1)
+    table = np.zeros(shape)
+    np.cumsum(image, axis=-2, out=table[..., 1:, 1:])
+    np.cumsum(table[..., 1:, 1:], axis=-1, out=table[..., 1:, 1:])
+    return table
+
+def box_filter(image, window_size):
+    """Sum of image values over a window_size x window_size box at each pixel.
+
+    Same result as scipy.ndimage.convolve(image, np.ones((window_size,
+    window_size))) with its default 'reflect' boundary, but computed with a
+    summed-area table so the cost does not depend on window_size. The table
+    is accumulated in float64, whose differences keep the precision of small
+    window sums, and the result has the type of image.
+    """
+    before = window_size // 2
+    after = window_size - 1 - before
+    # scipy's 'reflect' mode repeats the edge pixel, which is numpy's 'symmetric'
+    padded = np.pad(image, ((after, before), (after, before)), mode='symmetric')
+    table = integral_image(padded)
+    w = window_size
+    sums = table[w:, w:] - table[:-w, w:] - table[w:, :-w] + table[:-w, :-w]
+    return sums.astype(float_type(image), copy=False)
+
 def plot_matches(ax, image1, image2, keypoints1, keypoints2, matches,
                  keypoints_color='k', matches_color=None, only_matches=False):
     """Plot matched features.
@@ -91,8 +148,8 @@ def get_output_space(img_ref, imgs, transforms):
     Args:
         img_ref: reference image
         imgs: images to be transformed
-        transforms: list of affine transformation matrices. transforms[i] maps
-            points in imgs[i] to the points in img_ref
+        transforms: list of affine or projective transformation matrices.
+            transforms[i] maps points in imgs[i] to the points in img_ref
     Returns:
         output_shape
     """
@@ -107,7 +164,11 @@ def get_output_space(img_ref, imgs, transforms):
         r, c = imgs[i].shape
         H = transforms[i]
         corners = np.array([[0, 0], [r, 0], [0, c], [r, c]])
-        warped_corners = corners.dot(H[:2,:2]) + H[2,:2]
+        if is_affine(H):
+            warped_corners = corners.dot(H[:2,:2]) + H[2,:2]
+        else:
+            warped_corners = pad(corners).dot(H)
+            warped_corners = warped_corners[:, :2] / warped_corners[:, 2:]
         all_corners.append(warped_corners)
 
     # Find the extents of both the reference image and the warped
@@ -125,7 +186,20 @@ def get_output_space(img_ref, imgs, transforms):
 
     return output_shape, offset
 
-def warp_image(img, H, output_shape, offset):
+def is_affine(H, tol=1e-10):
+    """Whether the 3x3 transformation matrix H (acting on row vectors) is affine.
+
+    Affine matrices fitted by least squares have a last column that is only
+    approximately [0, 0, 1], so the perspective terms are compared to tol.
+    """
+    return np.all(np.abs(H[:2, 2]) <= tol)
+
+def warp_image(img, H, output_shape, offset, origin=(0, 0),
+               dtype=FLOAT_DTYPE):
+
+    if not is_affine(H):
+        return warp_image_projective(img, H, output_shape, offset, origin,
+                                     dtype)
 
     # Note about affine_transfomr function:
     # Given an output image pixel index vector o,
@@ -134,10 +208,337 @@ def warp_image(img, H, output_shape, offset):
     Hinv = np.linalg.inv(H)
     m = Hinv.T[:2,:2]
     b = Hinv.T[:2,2]
-    img_warped = affine_transform(img.astype(np.float32),
-                                  m, b+offset,
+    # With an origin, only the window of the output space starting at pixel
+    # origin is computed: its pixel o is the pixel o + origin of the output.
+    # The warped image has type dtype, float32 unless the caller asks for
+    # reference results in float64.
+    img_warped = affine_transform(img.astype(dtype, copy=False),
+                                  m, b+offset+m.dot(origin),
                                   output_shape,
                                   cval=-1)
 
     return img_warped
 
+def warp_image_projective(img, H, output_shape, offset, origin=(0, 0),
+                          dtype=FLOAT_DTYPE):
+    """Warp img with a projective transformation H, like warp_image.
+
+    Each output pixel o is read from the input image at the point
+    [o + origin + offset, 1] @ inv(H), divided by its last coordinate, with
+    the same spline interpolation and cval=-1 as affine_transform, and the
+    warped image has type dtype.
+    """
+    rows, cols = np.indices(output_shape)
+    points = np.stack([rows + origin[0] + offset[0],
+                       cols + origin[1] + offset[1],
+                       np.ones(output_shape)], axis=-1)
+    source = points.dot(np.linalg.inv(H))
+    source = source[..., :2] / source[..., 2:]
+    img_warped = map_coordinates(img.astype(dtype, copy=False),
+                                 [source[..., 0], source[..., 1]],
+                                 cval=-1)
+
+    return img_warped
+
+def warped_box(img_shape, H, output_shape, offset, margin=3):
+    """Bounding box, in the output space, of an image warped by warp_image.
+
+    The box is computed with the same mapping as warp_image, and enlarged by
+    margin pixels for the support of the spline interpolation, so that all the
+    output pixels outside of it are -1.
+
+    Returns:
+        box: (top, left, bottom, right), clipped to the output space
+    """
+    r, c = img_shape
+    corners = np.array([[0, 0], [r, 0], [0, c], [r, c]], dtype=float)
+    if is_affine(H):
+        Hinv = np.linalg.inv(H)
+        m = Hinv.T[:2,:2]
+        b = Hinv.T[:2,2]
+        outputs = np.linalg.solve(m, (corners - b - offset).T).T
+    else:
+        outputs = pad(corners).dot(H)
+        outputs = outputs[:, :2] / outputs[:, 2:] - offset
+    top, left = np.floor(outputs.min(axis=0)).astype(int) - margin
+    bottom, right = np.ceil(outputs.max(axis=0)).astype(int) + margin
+    H_out, W_out = output_shape
+    return (max(top, 0), max(left, 0), min(bottom, H_out), min(right, W_out))
+
+def feather_weights(mask, radius):
+    """
+    Distance of each pixel of mask to the closest pixel outside of it.
+
+    The distance is capped at radius, so it only depends on the mask within
+    radius pixels, and the pixels beyond the borders of the array count as
+    inside the mask.
+    """
+    padded = np.pad(mask, 1, mode='constant', constant_values=True)
+    return np.minimum(distance_transform_edt(padded)[1:-1, 1:-1], radius)
+
+def warp_box(img, H, output_shape, offset, dtype=FLOAT_DTYPE):
+    """Warp img only inside its bounding box in the output space.
+
+    Returns:
+        box: (top, left, bottom, right), see warped_box
+        warped: the pixels of warp_image(img, H, output_shape, offset, dtype=
+            dtype) in box
+    """
+    top, left, bottom, right = warped_box(img.shape, H, output_shape, offset)
+    shape = (max(bottom - top, 0), max(right - left, 0))
+    if shape[0] == 0 or shape[1] == 0:
+        # The image is outside of the output space: there is nothing to warp
+        return (top, left, bottom, right), np.empty(shape, dtype)
+    warped = warp_image(img, H, shape, offset, origin=(top, left), dtype=dtype)
+    return (top, left, bottom, right), warped
+
+def composite_warped(warped_boxes, output_shape, filename=None,
+                     chunk_rows=1024, radius=None, dtype=FLOAT_DTYPE):
+    """Average warped boxes (see warp_box) in a memory-mapped canvas.
+
+    Args:
+        warped_boxes: iterable of (box, warped) pairs
+        output_shape: shape of the output space
+        filename: file of the canvas memmap (default: a temporary file)
+        chunk_rows: number of rows normalized at once at the end
+        radius: if given, feather the images: their pixels are weighted by
+            their distance to the border of the image, capped at radius (see
+            feather_weights). The whole image is in its box, so the weights
+            are those of the whole output space.
+        dtype: floating point type of the canvas
+
+    Returns:
+        panorama: np.memmap of shape output_shape and type dtype
+    """
+    output_shape = tuple(output_shape)
+    if filename is None:
+        filename = tempfile.TemporaryFile()
+    canvas = np.memmap(filename, dtype=dtype, mode='w+',
+                       shape=output_shape)
+    weights = np.memmap(tempfile.TemporaryFile(), dtype=dtype,
+                        mode='w+', shape=output_shape)
+
+    for (top, left, bottom, right), warped in warped_boxes:
+        if warped.size == 0:
+            continue
+        mask = warped != -1
+        if radius is None:
+            weight = mask
+        else:
+            weight = (feather_weights(mask, radius) * mask).astype(dtype)
+        canvas[top:bottom, left:right] += np.where(mask, warped * weight, 0)
+        weights[top:bottom, left:right] += weight
+
+    for start in range(0, output_shape[0], chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        if radius is None:
+            canvas[rows] /= np.maximum(weights[rows], 1)
+        else:
+            canvas[rows] /= np.where(weights[rows] > 0, weights[rows], 1)
+    canvas.flush()
+
+    return canvas
+
+def composite_images(imgs, transforms, output_shape, offset, filename=None,
+                     chunk_rows=1024, radius=None, dtype=FLOAT_DTYPE):
+    """Average warped images in a memory-mapped canvas, one image at a time.
+
+    Gives the same panorama as warping every image in the whole output space
+    and averaging the overlaps, but each image is only warped inside its
+    bounding box (see warp_box) and added to a memory-mapped canvas and
+    weight buffer (see composite_warped). imgs can be a generator, so that
+    only one image and its warped box are in memory at a time.
+
+    Args:
+        imgs: iterable of images
+        transforms: iterable of transformation matrices, transforms[i] maps
+            imgs[i] to the output space (see get_output_space)
+        output_shape: shape of the output space
+        offset: offset of the output space
+        filename: file of the canvas memmap (default: a temporary file)
+        chunk_rows: number of rows normalized at once at the end
+        radius: feathering distance, see composite_warped
+        dtype: floating point type of the warped images and of the canvas
+
+    Returns:
+        panorama: np.memmap of shape output_shape and type dtype
+    """
+    warped_boxes = (warp_box(img, H, output_shape, offset, dtype)
+                    for img, H in zip(imgs, transforms))
+    return composite_warped(warped_boxes, output_shape, filename, chunk_rows,
+                            radius, dtype)
+
+
+class FeatureCache(object):
+    """On-disk cache of the arrays returned by feature functions.
+
+    The cache is a directory with one entry per call, named after a hash of
+    the function name and of its arguments, where array arguments (images)
+    are hashed by content. An entry holds one .npy file per returned array,
+    so that hits are memory-mapped instead of read in memory (the members of
+    a .npz file cannot be memory-mapped). When the entries take more than
+    max_bytes, the least recently used ones are removed.
+
+    Wrap a function with the cache to use it, for instance while tuning the
+    parameters of RANSAC on the same images:
+
+        cache = FeatureCache('features')
+        panorama.harris_corners = cache(panorama.harris_corners)
+        panorama.describe_keypoints = cache(panorama.describe_keypoints)
+
+    The wrapped functions must be deterministic and return an array, a tuple
+    of arrays or None. Cached arrays are read-only. The arguments are
+    identified by value, and functions by their module and name, so calls
+    with a lambda, a nested function, or an object without a stable repr
+    (like a RandomState) raise a TypeError.
+    """
+
+    def __init__(self, directory, max_bytes=2**30):
+        """
+        Args:
+            directory: directory of the cache, created if needed
+            max_bytes: maximum total size of the cached arrays
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, func):
+        """Wrap func so that its results are read from and saved to the cache."""
+        signature = inspect.signature(func)
+        name = '%s.%s' % (func.__module__, func.__qualname__)
+
+        @functools.wraps(func)
+        def cached(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = self.key(name, bound.arguments)
+            result = self.load(key)
+            if result is _MISSING:
+                result = func(*args, **kwargs)
+                self.save(key, result)
+            return result
+        return cached
+
+    def key(self, name, arguments):
+        """Hash of a function name and of the values of its arguments."""
+        digest = hashlib.sha1(name.encode())
+        for arg, value in arguments.items():
+            digest.update(arg.encode())
+            digest.update(_hash_value(value))
+        return digest.hexdigest()
+
+    def load(self, key):
+        """Cached result of key, memory-mapped, or _MISSING if not cached."""
+        path = os.path.join(self.directory, key)
+        try:
+            names = sorted(os.listdir(path))
+            arrays = [np.load(os.path.join(path, name), mmap_mode='r')
+                      for name in names if name.endswith('.npy')]
+            # Mark the entry as recently used
+            _touch(path)
+        except (FileNotFoundError, ValueError):
+            return _MISSING
+        if 'none' in names:
+            return None
+        if 'tuple' in names:
+            return tuple(arrays)
+        return arrays[0]
+
+    def save(self, key, result):
+        """Write result to the cache, then evict old entries if needed."""
+        if result is None:
+            arrays = ()
+        else:
+            arrays = result if isinstance(result, tuple) else (result,)
+        # The entry is written aside and renamed, so that processes sharing the
+        # cache never read a partial entry
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        for i, array in enumerate(arrays):
+            np.save(os.path.join(tmp, '%03d.npy' % i), np.asarray(array))
+        # Marker files of the results that are not a single array
+        if result is None:
+            open(os.path.join(tmp, 'none'), 'w').close()
+        elif isinstance(result, tuple):
+            open(os.path.join(tmp, 'tuple'), 'w').close()
+        _touch(tmp)
+        try:
+            os.rename(tmp, os.path.join(self.directory, key))
+        except OSError:
+            # Already saved by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """List of (last use, size in bytes, path) of the cached entries."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries until max_bytes is met."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Remove all the cached entries."""
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _touch(path):
+    """Set the modification time of path to now, to the nanosecond.
+
+    The times set by the file system are only as precise as its clock tick,
+    which leaves the entries used within a few milliseconds tied for eviction.
+    """
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+# Result of FeatureCache.load for the keys that are not cached, as None is a
+# result that can be cached
+_MISSING = object()
+
+def _hash_value(value):
+    """Bytes identifying an argument of a cached function.
+
+    Raises a TypeError for the values that are not identified across calls:
+    lambdas and nested functions, whose names are not unique, and objects
+    whose repr holds their address.
+    """
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        header = '%s%s' % (value.dtype.str, value.shape)
+        return header.encode() + hashlib.sha1(value.view(np.uint8)).digest()
+    if isinstance(value, functools.partial):
+        return b'partial' + _hash_value((value.func, value.args,
+                                         value.keywords))
+    if callable(value) and hasattr(value, '__qualname__'):
+        name = '%s.%s' % (getattr(value, '__module__', None), value.__qualname__)
+        if '<' in name:
+            raise TypeError('Cannot identify %s: only module-level functions '
+                            'can be arguments of cached functions' % name)
+        # Methods are bound to an object that is part of the argument
+        owner = getattr(value, '__self__', None)
+        if owner is None or isinstance(owner, (type, types.ModuleType)):
+            return name.encode()
+        return name.encode() + _hash_value(owner)
+    if isinstance(value, (tuple, list)):
+        return b'(' + b','.join(_hash_value(v) for v in value) + b')'
+    if isinstance(value, dict):
+        return _hash_value(sorted(value.items()))
+    text = repr(value)
+    if re.search(r' at 0x[0-9a-fA-F]+', text):
+        raise TypeError('Cannot identify %s: its repr changes between runs'
+                        % text)
+    return text.encode()
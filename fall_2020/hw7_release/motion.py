@@ -11,6 +11,46 @@ import numpy as np
 from skimage.transform import pyramid_gaussian
 
 
+# Same summed-area table as in fall_2020/hw3_release/utils.py and
+# fall_2021/hw1_release/filters.py: homework folders do not import each other.
+def integral_image(image):
+    """Summed-area table of an image, or of each image of a stack.
+
+    Args:
+        image - Numpy array of shape (H, W), or (..., H, W).
+    Returns:
+        table - Numpy array of shape (..., H+1, W+1) where table[..., i, j] is
+            the sum of image[..., :i, :j].
+    """
+    shape = image.shape[:-2] + (image.shape[-2] + 1, image.shape[-1] + 1)
+    table = np.zeros(shape)
+    np.cumsum(image, axis=-2, out=table[..., 1:, 1:])
+    np.cumsum(table[..., 1:, 1:], axis=-1, out=table[..., 1:, 1:])
+    return table
+
+
+def _window_sums_at(tables, ys, xs, w):
+    """Sum of each image over the (2w+1, 2w+1) windows centered at (ys, xs).
+
+    Windows are clipped to the image, like the slices
+    image[y - w: y + w + 1, x - w: x + w + 1] of an interior point.
+
+    Args:
+        tables - Summed-area tables of shape (K, H+1, W+1).
+        ys, xs - Integer window centers, numpy arrays of shape (N,).
+        w - Half size of the window.
+    Returns:
+        sums - Numpy array of shape (K, N).
+    """
+    _, H1, W1 = tables.shape
+    y0 = np.clip(ys - w, 0, H1 - 1)
+    y1 = np.clip(ys + w + 1, 0, H1 - 1)
+    x0 = np.clip(xs - w, 0, W1 - 1)
+    x1 = np.clip(xs + w + 1, 0, W1 - 1)
+    return (tables[:, y1, x1] - tables[:, y0, x1]
+            - tables[:, y1, x0] + tables[:, y0, x0])
+
+
 def lucas_kanade(img1, img2, keypoints, window_size=5):
     """Estimate flow vector at each keypoint using Lucas-Kanade method.
 
@@ -26,12 +66,16 @@ def lucas_kanade(img1, img2, keypoints, window_size=5):
         flow_vectors - Estimated flow vectors for keypoints. flow_vectors[i] is
             the flow vector for keypoint[i]. Numpy array of shape (N, 2).
 
+    Windows are clipped at the four image borders. Slicing
+    img[y - w: y + w + 1, x - w: x + w + 1] clips them at the bottom and
+    right only: a window crossing the top or left border was an empty slice,
+    and np.linalg.inv raised on its zero matrix.
+
     Hints:
         - You may use np.linalg.inv to compute inverse matrix
     """
     assert window_size % 2 == 1, "window_size must be an odd number"
 
-    flow_vectors = []
     w = window_size // 2
 
     # Compute partial derivatives
@@ -39,24 +83,28 @@ def lucas_kanade(img1, img2, keypoints, window_size=5):
     It = img2 - img1
 
     # For each [y, x] in keypoints, estimate flow vector [vy, vx]
-    # using Lucas-Kanade method and append it to flow_vectors.
-    for y, x in keypoints:
-        # Keypoints can be located between integer pixels (subpixel locations).
-        # For simplicity, we round the keypoint coordinates to nearest integer.
-        # In order to achieve more accurate results, image brightness at subpixel
-        # locations can be computed using bilinear interpolation.
-        y, x = int(round(y)), int(round(x))
+    # using Lucas-Kanade method; all keypoints are solved at once.
+    # Keypoints can be located between integer pixels (subpixel locations).
+    # For simplicity, we round the keypoint coordinates to nearest integer.
+    # In order to achieve more accurate results, image brightness at subpixel
+    # locations can be computed using bilinear interpolation.
+    keypoints = np.round(np.asarray(keypoints, dtype=float)).astype(int)
+    keypoints = keypoints.reshape(-1, 2)
+    ys, xs = keypoints[:, 0], keypoints[:, 1]
 
-        # YOUR CODE HERE
-        Ax = Ix[y - w: y + w + 1, x - w: x + w + 1].flatten()
-        Ay = Iy[y - w: y + w + 1, x - w: x + w + 1].flatten()
-        b = (-It[y - w: y + w + 1, x - w: x + w + 1].flatten()).T
-        A = np.vstack([Ax, Ay])
-        v = np.linalg.inv(A@A.T)@(A@b).flatten()
-        flow_vectors.append([v[1], v[0]])
-        # END YOUR CODE
-
-    flow_vectors = np.array(flow_vectors)
+    # YOUR CODE HERE
+    # The normal equations only need window sums of gradient products, which
+    # are read in O(1) per keypoint from summed-area tables.
+    products = np.stack([Ix * Ix, Ix * Iy, Iy * Iy, Ix * It, Iy * It])
+    sums = _window_sums_at(integral_image(products), ys, xs, w)
+    Sxx, Sxy, Syy, Sxt, Syt = sums
+
+    ATA = np.stack([np.stack([Sxx, Sxy], axis=-1),
+                    np.stack([Sxy, Syy], axis=-1)], axis=-2)
+    ATb = -np.stack([Sxt, Syt], axis=-1)
+    v = (np.linalg.inv(ATA) @ ATb[:, :, None])[:, :, 0]
+    flow_vectors = v[:, ::-1]
+    # END YOUR CODE
 
     return flow_vectors
 
@@ -0,0 +1,75 @@
+"""
+Checks of motion.py against the per-keypoint loop it replaced.
+
+Usage:
+    python -m pytest test_motion.py
+"""
+
+import numpy as np
+import pytest
+
+from motion import integral_image, lucas_kanade
+
+
+def lucas_kanade_loop(img1, img2, keypoints, window_size=5, clip=False):
+    """The original lucas_kanade: one least squares system per keypoint.
+
+    With clip, the windows start at row and column 0 at the most, instead of
+    wrapping around as negative slice starts.
+    """
+    w = window_size // 2
+    Iy, Ix = np.gradient(img1)
+    It = img2 - img1
+    flow_vectors = []
+    for y, x in keypoints:
+        y, x = int(round(y)), int(round(x))
+        y0, x0 = y - w, x - w
+        if clip:
+            y0, x0 = max(y0, 0), max(x0, 0)
+        Ax = Ix[y0: y + w + 1, x0: x + w + 1].flatten()
+        Ay = Iy[y0: y + w + 1, x0: x + w + 1].flatten()
+        b = (-It[y0: y + w + 1, x0: x + w + 1].flatten()).T
+        A = np.vstack([Ax, Ay])
+        v = np.linalg.inv(A@A.T)@(A@b).flatten()
+        flow_vectors.append([v[1], v[0]])
+    return np.array(flow_vectors)
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.RandomState(0)
+    img1 = rng.rand(40, 50)
+    img2 = np.roll(img1, 1, axis=0) + 0.01 * rng.rand(40, 50)
+    return img1, img2
+
+
+def test_integral_image():
+    rng = np.random.RandomState(1)
+    images = rng.rand(3, 7, 9)
+    table = integral_image(images)
+    assert table.shape == (3, 8, 10)
+    np.testing.assert_allclose(table[:, 4, 6], images[:, :4, :6].sum(axis=(1, 2)))
+    np.testing.assert_array_equal(table[1], integral_image(images[1]))
+
+
+def test_lucas_kanade_matches_loop(frames):
+    # Interior keypoints, sub-pixel ones, and windows crossing the bottom and
+    # right borders, which the loop clips too
+    keypoints = np.array([[20, 20], [10.4, 30.6], [38, 48], [39, 49], [39, 20],
+                          [20, 49]])
+    for window_size in (3, 5, 9):
+        np.testing.assert_allclose(
+            lucas_kanade(*frames, keypoints, window_size),
+            lucas_kanade_loop(*frames, keypoints, window_size),
+            rtol=1e-9, atol=1e-12)
+
+
+def test_lucas_kanade_clips_top_left_windows(frames):
+    # The loop slices an empty window there and raises; the window is clipped
+    keypoints = np.array([[1, 20], [0, 0], [20, 1], [2, 2]])
+    with pytest.raises(np.linalg.LinAlgError):
+        lucas_kanade_loop(*frames, keypoints[:1])
+    np.testing.assert_allclose(
+        lucas_kanade(*frames, keypoints),
+        lucas_kanade_loop(*frames, keypoints, clip=True),
+        rtol=1e-9, atol=1e-12)
@@ -70,6 +70,163 @@ def zero_pad(image, pad_height, pad_width):
     return out
 
 
+# Convolution engine. hw2_release/edge.py has a copy of it, since each
+# homework folder is imported on its own by its notebook; keep the two
+# copies in sync.
+
+
+def _conv_direct(padded, kernel):
+    """ Valid convolution as a weighted sum of shifted views of the image.
+
+    Loops over the Hk*Wk kernel taps instead of the output pixels, so each
+    iteration is a single vectorized multiply-add over the whole image.
+
+    Args:
+        padded: numpy array of shape (Hp, Wp).
+        kernel: numpy array of shape (Hk, Wk).
+
+    Returns:
+        out: numpy array of shape (Hp-Hk+1, Wp-Wk+1).
+    """
+    Hp, Wp = padded.shape
+    Hk, Wk = kernel.shape
+    Ho, Wo = Hp - Hk + 1, Wp - Wk + 1
+    kernel = np.flip(kernel)
+
+    out = np.zeros((Ho, Wo))
+    for m in range(Hk):
+        for n in range(Wk):
+            if kernel[m, n] != 0:
+                out += kernel[m, n] * padded[m:m+Ho, n:n+Wo]
+    return out
+
+
+def _separate_kernel(kernel, tol=1e-10):
+    """ Split a rank-1 kernel into a column and a row vector.
+
+    The rank is detected with an SVD: the kernel is separable when every
+    singular value but the first is negligible.
+
+    Args:
+        kernel: numpy array of shape (Hk, Wk).
+        tol: relative tolerance on the second singular value.
+
+    Returns:
+        (col, row): numpy arrays of shape (Hk,) and (Wk,) such that
+            np.outer(col, row) == kernel, or None if kernel is not rank-1
+            (1D kernels, and kernels with NaN or infinite values, are left to
+            the direct method).
+    """
+    if min(kernel.shape) == 1 or not np.all(np.isfinite(kernel)):
+        return None
+    u, s, vt = np.linalg.svd(kernel)
+    if s[0] == 0 or s[1] > tol * s[0]:
+        return None
+    return u[:, 0] * np.sqrt(s[0]), vt[0] * np.sqrt(s[0])
+
+
+def _conv_separable(padded, col, row):
+    """ Valid convolution with the separable kernel np.outer(col, row).
+
+    Args:
+        padded: numpy array of shape (Hp, Wp).
+        col: numpy array of shape (Hk,).
+        row: numpy array of shape (Wk,).
+
+    Returns:
+        out: numpy array of shape (Hp-Hk+1, Wp-Wk+1).
+    """
+    tmp = _conv_direct(padded, col.reshape(-1, 1))
+    return _conv_direct(tmp, row.reshape(1, -1))
+
+
+def _conv_fft(padded, kernel):
+    """ Valid convolution computed as a product in the frequency domain.
+
+    Args:
+        padded: numpy array of shape (Hp, Wp).
+        kernel: numpy array of shape (Hk, Wk).
+
+    Returns:
+        out: numpy array of shape (Hp-Hk+1, Wp-Wk+1).
+    """
+    Hp, Wp = padded.shape
+    Hk, Wk = kernel.shape
+    shape = (Hp + Hk - 1, Wp + Wk - 1)
+    full = np.fft.irfft2(np.fft.rfft2(padded, shape) * np.fft.rfft2(kernel, shape),
+                         shape)
+    return full[Hk-1:Hp, Wk-1:Wp]
+
+
+def _choose_conv_method(image_shape, kernel):
+    """ choose_conv_method, also returning the factors of a rank-1 kernel.
+
+    Returns:
+        method: one of 'direct', 'separable' or 'fft'.
+        factors: (col, row) from _separate_kernel, or None.
+    """
+    Hp, Wp = image_shape
+    Hk, Wk = kernel.shape
+    factors = _separate_kernel(kernel)
+    costs = {'direct': Hk * Wk}
+    if factors is not None:
+        costs['separable'] = Hk + Wk
+    costs['fft'] = 6 * np.log2((Hp + Hk) * (Wp + Wk))
+    return min(costs, key=costs.get), factors
+
+
+def choose_conv_method(image_shape, kernel):
+    """ Pick the cheapest way to convolve an image with a kernel.
+
+    The estimate counts multiply-adds per output pixel: Hk*Wk for the direct
+    method, Hk+Wk for a rank-1 kernel, and a few log2 of the transform size
+    for the FFT (three transforms of the padded image).
+
+    Args:
+        image_shape: shape (Hp, Wp) of the padded image.
+        kernel: numpy array of shape (Hk, Wk).
+
+    Returns:
+        method: one of 'direct', 'separable' or 'fft'.
+    """
+    return _choose_conv_method(image_shape, kernel)[0]
+
+
+def conv_valid(padded, kernel, method='auto'):
+    """ Convolution engine shared by all the filters in this file.
+
+    Computes the 'valid' part of the convolution of an already padded image,
+    so callers decide on the padding (zeros here, edge values in hw2). The
+    evaluation strategy is chosen by choose_conv_method() unless forced.
+
+    Args:
+        padded: numpy array of shape (Hp, Wp).
+        kernel: numpy array of shape (Hk, Wk).
+        method: 'auto', 'direct', 'separable' or 'fft'.
+
+    Returns:
+        out: numpy array of shape (Hp-Hk+1, Wp-Wk+1).
+    """
+    padded = np.asarray(padded, dtype=float)
+    kernel = np.asarray(kernel, dtype=float)
+
+    factors = None
+    if method == 'auto':
+        method, factors = _choose_conv_method(padded.shape, kernel)
+
+    if method == 'direct':
+        return _conv_direct(padded, kernel)
+    if method == 'separable':
+        if factors is None:
+            factors = _separate_kernel(kernel)
+        if factors is None:
+            raise ValueError('The kernel is not separable (rank-1)')
+        return _conv_separable(padded, *factors)
+    if method == 'fft':
+        return _conv_fft(padded, kernel)
+    raise ValueError('Unknown convolution method: %s' % method)
+
+
 def conv_fast(image, kernel):
     """ An efficient implementation of convolution filter.
 
@@ -94,18 +251,8 @@ def conv_fast(image, kernel):
     out = np.zeros((Hi, Wi))
 
     ### YOUR CODE HERE
-    h_s = Hk//2
-    w_s = Wk//2
-    print(h_s,w_s)
-    print(Hk, Wk)
-    
-    image_with_pad = zero_pad(image, h_s, w_s)
-    kernel = np.flip(kernel)
-
-    for hi in range(h_s,h_s+Hi):
-        for wi in range(w_s,w_s+Wi):
-            out[hi-h_s,wi-w_s] = np.sum(kernel[:,:]*image_with_pad[hi-h_s:hi-h_s+Hk,wi-w_s:wi-w_s+Wk])
-            
+    image_with_pad = zero_pad(image, Hk//2, Wk//2)
+    out = conv_valid(image_with_pad, kernel)[:Hi, :Wi]
     ### END YOUR CODE
 
     return out
@@ -125,21 +272,7 @@ def cross_correlation(f, g):
 
     out = None
     ### YOUR CODE HERE
-    Hi, Wi = f.shape
-    Hk, Wk = g.shape
-    out = np.zeros((Hi, Wi))
-
-    ### YOUR CODE HERE
-    h_s = Hk//2
-    w_s = Wk//2
-    print(h_s,w_s)
-    print(Hk, Wk)
-    
-    image_with_pad = zero_pad(f, h_s, w_s)
-
-    for hi in range(h_s,h_s+Hi):
-        for wi in range(w_s,w_s+Wi):
-            out[hi-h_s,wi-w_s] = np.sum(g[:,:]*image_with_pad[hi-h_s:hi-h_s+Hk,wi-w_s:wi-w_s+Wk])
+    out = conv_fast(f, np.flip(g))
     ### END YOUR CODE
 
     return out
@@ -183,36 +316,179 @@ def normalized_cross_correlation(f, g):
     Returns:
         out: numpy array of shape (Hf, Wf).
     """
-    from matplotlib import pyplot as plt
-
     out = None
     ### YOUR CODE HERE
     g = g.astype(float)
     f = f.astype(float)
     g_norm = (g-np.mean(g))/np.std(g)
-    
-    ### YOUR CODE HERE
+
     Hi, Wi = f.shape
     Hk, Wk = g.shape
-    out = np.zeros((Hi, Wi))
-
-    ### YOUR CODE HERE
-    h_s = Hk//2
-    w_s = Wk//2
-    print(h_s,w_s)
-    print(Hk, Wk)
-    
-    image_with_pad = zero_pad(f, h_s, w_s)
-
-    for hi in range(h_s,h_s+Hi):
-        for wi in range(w_s,w_s+Wi):
-            patch_mean = np.mean(image_with_pad[hi-h_s:hi-h_s+Hk,wi-w_s:wi-w_s+Wk])
-            patch_std = np.std(image_with_pad[hi-h_s:hi-h_s+Hk,wi-w_s:wi-w_s+Wk])
-            out[hi-h_s,wi-w_s] = np.sum(g_norm[:,:]*(image_with_pad[hi-h_s:hi-h_s+Hk,wi-w_s:wi-w_s+Wk]-patch_mean)/patch_std)
+    image_with_pad = zero_pad(f, Hk//2, Wk//2)
+
+    # sum(g_norm * (patch - mean) / std) == sum(g_norm * patch) / std since
+    # g_norm sums to zero, so only the window std is needed.
+    _, patch_std = local_mean_std(image_with_pad, Hk, Wk)
+    patch_std = patch_std[:Hi, :Wi]
+    corr = conv_valid(image_with_pad, np.flip(g_norm))[:Hi, :Wi]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = np.where(patch_std > 0, corr / patch_std, np.nan)
     ### END YOUR CODE
 
     return out
 
-    ### END YOUR CODE
 
-    return out
+# Same summed-area table as in fall_2020/hw3_release/utils.py and
+# fall_2020/hw7_release/motion.py: homework folders do not import each other.
+def integral_image(image):
+    """ Summed-area table of an image.
+
+    table[i, j] holds the sum of image[:i, :j], so the table has an extra
+    row and column of zeros at the top and on the left. Leading axes of
+    image are a stack of images, each with its own table.
+
+    Args:
+        image: numpy array of shape (H, W), or (..., H, W).
+
+    Returns:
+        table: numpy array of shape (H+1, W+1), or (..., H+1, W+1).
+    """
+    shape = image.shape[:-2] + (image.shape[-2] + 1, image.shape[-1] + 1)
+    table = np.zeros(shape)
+    np.cumsum(image, axis=-2, out=table[..., 1:, 1:])
+    np.cumsum(table[..., 1:, 1:], axis=-1, out=table[..., 1:, 1:])
+    return table
+
+
+def window_sums(table, Hw, Ww):
+    """ Sum of every (Hw, Ww) window read from a summed-area table.
+
+    Args:
+        table: numpy array of shape (H+1, W+1) from integral_image().
+        Hw, Ww: size of the window.
+
+    Returns:
+        out: numpy array of shape (H-Hw+1, W-Ww+1) where out[i, j] is the
+            sum of image[i:i+Hw, j:j+Ww].
+    """
+    return (table[Hw:, Ww:] - table[:-Hw, Ww:]
+            - table[Hw:, :-Ww] + table[:-Hw, :-Ww])
+
+
+def local_mean_std(image, Hw, Ww):
+    """ Mean and standard deviation of every (Hw, Ww) window of an image.
+
+    Uses the summed-area tables of image and image**2, so each window costs
+    O(1) regardless of its size. Variances below the rounding error of the
+    tables are clamped to exactly zero, so flat windows report a std of 0
+    like np.std.
+
+    Args:
+        image: numpy array of shape (H, W).
+        Hw, Ww: size of the window.
+
+    Returns:
+        mean: numpy array of shape (H-Hw+1, W-Ww+1).
+        std: numpy array of shape (H-Hw+1, W-Ww+1).
+    """
+    n = Hw * Ww
+    # Variance is shift invariant; centering limits cancellation in
+    # E[x^2] - E[x]^2. The shift is added back to the means.
+    shift = image.mean()
+    image = image - shift
+    table = integral_image(image)
+    sq_table = integral_image(image**2)
+    mean = window_sums(table, Hw, Ww) / n
+    var = window_sums(sq_table, Hw, Ww) / n - mean**2
+    var[var <= 16 * np.finfo(float).eps * sq_table[-1, -1] / n] = 0
+    return mean + shift, np.sqrt(var)
+
+
+def _top_k_peaks(response, k, min_distance):
+    """ Greedily pick the k highest responses that are far enough apart.
+
+    Args:
+        response: numpy array of shape (H, W).
+        k: number of peaks to return.
+        min_distance: half size (dy, dx) of the box suppressed around a peak.
+
+    Returns:
+        peaks: int numpy array of shape (k, 2) with (y, x) locations. Rows
+            are -1 when fewer than k peaks could be found.
+    """
+    response = np.where(np.isfinite(response), response, -np.inf)
+    dy, dx = min_distance
+    peaks = -np.ones((k, 2), dtype=int)
+    for i in range(k):
+        y, x = np.unravel_index(np.argmax(response), response.shape)
+        if response[y, x] == -np.inf:
+            break
+        peaks[i] = y, x
+        response[max(y-dy, 0):y+dy+1, max(x-dx, 0):x+dx+1] = -np.inf
+    return peaks
+
+
+def match_templates(f, templates, method='normalized', top_k=1, batch_size=16):
+    """ Match a stack of templates against one image.
+
+    Batched version of zero_mean_cross_correlation and
+    normalized_cross_correlation. The work that only depends on the image is
+    done once: its FFT, and for the normalized method the integral images of
+    f and f**2 giving the mean and standard deviation of every window. Each
+    template then only costs one FFT and one inverse FFT. Templates are
+    processed batch_size at a time to bound the memory used by the spectra.
+
+    Args:
+        f: numpy array of shape (Hf, Wf).
+        templates: numpy array of shape (T, Hg, Wg).
+        method: 'zero_mean' or 'normalized'.
+        top_k: number of peaks to extract per template.
+        batch_size: number of templates transformed together.
+
+    Returns:
+        out: numpy array of shape (T, Hf, Wf); out[t] is the response of
+            templates[t], as computed by the single-template function.
+        peaks: int numpy array of shape (T, top_k, 2) with the (y, x)
+            locations of the strongest responses, suppressing a template-sized
+            box around each peak.
+    """
+    if method not in ('zero_mean', 'normalized'):
+        raise ValueError('Unknown matching method: %s' % method)
+
+    f = f.astype(float)
+    templates = np.asarray(templates, dtype=float)
+    T, Hg, Wg = templates.shape
+    Hf, Wf = f.shape
+
+    padded = zero_pad(f, Hg//2, Wg//2)
+    Hp, Wp = padded.shape
+    shape = (Hp + Hg - 1, Wp + Wg - 1)
+
+    # Zero-mean templates make the response invariant to a constant shift of
+    # the image, so centering the padded image is free and improves the
+    # accuracy of the FFT.
+    padded -= padded.mean()
+    F = np.fft.rfft2(padded, shape)
+
+    templates = templates - templates.mean(axis=(1, 2), keepdims=True)
+    if method == 'normalized':
+        templates /= templates.std(axis=(1, 2), keepdims=True)
+
+        _, std = local_mean_std(padded, Hg, Wg)
+        std = std[:Hf, :Wf]
+
+    out = np.empty((T, Hf, Wf))
+    for start in range(0, T, batch_size):
+        batch = np.flip(templates[start:start+batch_size], axis=(1, 2))
+        G = np.fft.rfft2(batch, shape, axes=(1, 2))
+        full = np.fft.irfft2(F * G, shape, axes=(1, 2))
+        out[start:start+batch_size] = full[:, Hg-1:Hg-1+Hf, Wg-1:Wg-1+Wf]
+
+    if method == 'normalized':
+        # Flat windows are undefined, as in normalized_cross_correlation
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out = np.where(std > 0, out / std, np.nan)
+
+    peaks = np.stack([_top_k_peaks(response, top_k, (Hg//2, Wg//2))
+                      for response in out])
+    return out, peaks
@@ -0,0 +1,184 @@
+"""
+Checks of the convolution engine of filters.py against the loops it replaced.
+
+Usage:
+    python -m pytest test_filters.py
+"""
+
+import numpy as np
+import pytest
+from skimage import io
+
+import filters
+
+
+def conv_fast_loop(image, kernel):
+    """The original conv_fast: one window of the padded image per pixel."""
+    Hi, Wi = image.shape
+    Hk, Wk = kernel.shape
+    out = np.zeros((Hi, Wi))
+    h_s = Hk//2
+    w_s = Wk//2
+    image_with_pad = filters.zero_pad(image, h_s, w_s)
+    kernel = np.flip(kernel)
+    for hi in range(h_s, h_s+Hi):
+        for wi in range(w_s, w_s+Wi):
+            out[hi-h_s, wi-w_s] = np.sum(
+                kernel*image_with_pad[hi-h_s:hi-h_s+Hk, wi-w_s:wi-w_s+Wk])
+    return out
+
+
+
+def normalized_cross_correlation_loop(f, g):
+    """The original normalized_cross_correlation: statistics of each window."""
+    g = g.astype(float)
+    f = f.astype(float)
+    g_norm = (g-np.mean(g))/np.std(g)
+    Hi, Wi = f.shape
+    Hk, Wk = g.shape
+    out = np.zeros((Hi, Wi))
+    h_s = Hk//2
+    w_s = Wk//2
+    image_with_pad = filters.zero_pad(f, h_s, w_s)
+    for hi in range(h_s, h_s+Hi):
+        for wi in range(w_s, w_s+Wi):
+            patch = image_with_pad[hi-h_s:hi-h_s+Hk, wi-w_s:wi-w_s+Wk]
+            out[hi-h_s, wi-w_s] = np.sum(
+                g_norm*(patch-np.mean(patch))/np.std(patch))
+    return out
+
+def gaussian(size, sigma):
+    """Separable Gaussian kernel of shape (size, size)."""
+    x = np.arange(size) - (size - 1) / 2
+    g = np.exp(-x**2 / (2 * sigma**2))
+    return np.outer(g, g) / g.sum()**2
+
+
+@pytest.fixture(scope='module')
+def img():
+    return io.imread('dog.jpg', as_gray=True)[100:160, 120:200]
+
+
+@pytest.mark.parametrize('shape', [(3, 3), (5, 7), (4, 4), (6, 3), (1, 5)])
+def test_conv_fast_matches_loop(img, shape):
+    rng = np.random.RandomState(0)
+    for kernel in (rng.randn(*shape),
+                   gaussian(max(shape), 1.0)[:shape[0], :shape[1]]):
+        np.testing.assert_allclose(filters.conv_fast(img, kernel),
+                                   conv_fast_loop(img, kernel),
+                                   rtol=1e-10, atol=1e-10)
+    if shape[0] % 2 and shape[1] % 2:
+        np.testing.assert_allclose(filters.conv_nested(img, kernel),
+                                   conv_fast_loop(img, kernel),
+                                   rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('shape', [(3, 3), (4, 6), (9, 9), (10, 7)])
+def test_conv_methods_agree(img, shape):
+    padded = filters.zero_pad(img, shape[0]//2, shape[1]//2)
+    kernel = gaussian(max(shape), 1.5)[:shape[0], :shape[1]]
+    expected = filters.conv_valid(padded, kernel, method='direct')
+    assert expected.shape == (padded.shape[0] - shape[0] + 1,
+                              padded.shape[1] - shape[1] + 1)
+    # The FFT is cropped to the valid part of the full convolution
+    for method in ('separable', 'fft', 'auto'):
+        np.testing.assert_allclose(filters.conv_valid(padded, kernel, method),
+                                   expected, rtol=1e-10, atol=1e-10)
+    # Random kernels are not separable
+    kernel = np.random.RandomState(1).randn(*shape)
+    np.testing.assert_allclose(filters.conv_valid(padded, kernel, 'fft'),
+                               filters.conv_valid(padded, kernel, 'direct'),
+                               rtol=1e-10, atol=1e-10)
+    with pytest.raises(ValueError):
+        filters.conv_valid(padded, kernel, 'separable')
+
+
+def test_choose_conv_method():
+    rng = np.random.RandomState(2)
+    assert filters.choose_conv_method((100, 100), rng.randn(3, 3)) == 'direct'
+    assert filters.choose_conv_method((100, 100), gaussian(15, 3)) == 'separable'
+    assert filters.choose_conv_method((100, 100), rng.randn(15, 15)) == 'fft'
+    with pytest.raises(ValueError):
+        filters.conv_valid(np.zeros((10, 10)), np.ones((3, 3)), 'winograd')
+
+
+@pytest.fixture(scope='module')
+def shelf():
+    return io.imread('shelf.jpg', as_gray=True)[::4, ::4]
+
+
+@pytest.mark.parametrize('method, single', [
+    ('zero_mean', filters.zero_mean_cross_correlation),
+    ('normalized', filters.normalized_cross_correlation)])
+def test_match_templates_matches_single_template(shelf, method, single):
+    # Odd and even sizes, one template per batch or all of them at once
+    for Hg, Wg in ((11, 15), (12, 16)):
+        corners = [(10, 20), (40, 90), (60, 30)]
+        templates = np.stack([shelf[r:r+Hg, c:c+Wg] for r, c in corners])
+        for batch_size in (1, 16):
+            out, peaks = filters.match_templates(
+                shelf, templates, method, top_k=2, batch_size=batch_size)
+            assert out.shape == (len(templates),) + shelf.shape
+            assert peaks.shape == (len(templates), 2, 2)
+            for t, template in enumerate(templates):
+                np.testing.assert_allclose(out[t], single(shelf, template),
+                                           rtol=1e-8, atol=1e-8)
+        if method == 'normalized':
+            # The best match of a template cut out of the image is itself
+            centers = [(r + Hg//2, c + Wg//2) for r, c in corners]
+            np.testing.assert_array_equal(peaks[:, 0], centers)
+
+    with pytest.raises(ValueError):
+        filters.match_templates(shelf, templates, 'cross')
+
+
+def test_top_k_peaks_suppresses_neighbours():
+    response = np.zeros((20, 30))
+    response[5, 5] = 10
+    # Inside the box around the first peak
+    response[7, 8] = 9
+    response[15, 20] = 8
+    # Just outside of it
+    response[5, 9] = 7
+    response[0, 0] = np.nan
+    peaks = filters._top_k_peaks(response, 4, (2, 3))
+    np.testing.assert_array_equal(peaks, [[5, 5], [15, 20], [5, 9], [0, 1]])
+    assert response[7, 8] == 9
+
+    # Fewer than k peaks left
+    response = np.full((5, 5), -np.inf)
+    response[2, 2] = 1
+    np.testing.assert_array_equal(filters._top_k_peaks(response, 3, (1, 1)),
+                                  [[2, 2], [-1, -1], [-1, -1]])
+
+
+def test_local_mean_std_matches_windows(img):
+    mean, std = filters.local_mean_std(img, 5, 4)
+    assert mean.shape == (img.shape[0] - 4, img.shape[1] - 3)
+    for i, j in ((0, 0), (10, 33), (55, 76)):
+        window = img[i:i+5, j:j+4]
+        assert abs(mean[i, j] - window.mean()) < 1e-12
+        assert abs(std[i, j] - window.std()) < 1e-12
+
+
+@pytest.mark.parametrize('shape', [(7, 9), (6, 8)])
+def test_normalized_cross_correlation_matches_loop(img, shape):
+    # A flat region wider than the template: its windows have a std of 0.
+    # Its value 0.5 is exact, so that np.std of these windows is 0 too.
+    f = img.copy()
+    f[20:40, 10:40] = 0.5
+    g = img[5:5+shape[0], 50:50+shape[1]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = normalized_cross_correlation_loop(f, g)
+        out = filters.normalized_cross_correlation(f, g)
+    # The flat windows are undefined
+    assert np.isnan(out[30, 25])
+    np.testing.assert_array_equal(np.isnan(out), np.isnan(expected))
+    np.testing.assert_allclose(out, expected, rtol=1e-9, atol=1e-9)
+
+    # A flat template is undefined everywhere
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = filters.normalized_cross_correlation(f, np.ones(shape))
+        expected = normalized_cross_correlation_loop(f, np.ones(shape))
+    assert np.all(np.isnan(out))
+    assert np.all(np.isnan(expected))
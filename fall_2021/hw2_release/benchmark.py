@@ -0,0 +1,173 @@
+"""
+Timing of the Canny detector and of the Hough transforms in edge.py.
+
+Usage:
+    python benchmark.py [image]
+
+Reports the time per frame of `canny` and of `CannyDetector` in float64 and
+float32 on the image resized to 1080p, 720p and 540p, and how many pixels of
+the float32 edge maps differ from `canny`. Then detects the edges of a road image in the triangular region of interest of
+the notebook, then reports the time of `hough_transform` voting for every
+theta, for chunks of edge pixels of several sizes, and voting only around
+the gradient direction, with the strongest lines found by `hough_peaks`.
+Then reports the time and segments of `probabilistic_hough`, for all the
+segments and for the first few ones. Finally runs `LaneTracker` on a clip
+panning over the image, and reports the latency percentiles of its stages
+against `canny` and `hough_transform` run on every frame independently, and
+how often both find the same lanes.
+"""
+
+import sys
+import time
+
+import numpy as np
+from skimage import io, transform
+
+import edge
+
+
+def lane_roi(edges):
+    """Edges below the two diagonals of the image, as in the notebook."""
+    return edges & edge.lane_roi(edges.shape)
+
+
+def timed(func, *args, **kwargs):
+    """Runs func and returns its output and the elapsed seconds."""
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def median_time(func, *args, repeat=7):
+    """Median of the elapsed seconds of repeat runs of func."""
+    return np.median([timed(func, *args)[1] for _ in range(repeat)])
+
+
+def benchmark_canny(img, shapes=((1080, 1920), (720, 1280), (540, 960)),
+                    high=0.03, low=0.02):
+    """Prints time per frame of canny and CannyDetector against frame size."""
+    print('%12s %10s %20s %20s %13s' % ('frame', 'canny', 'detector float64',
+                                         'detector float32', 'float32 diff'))
+    for shape in shapes:
+        frame = transform.resize(img, shape)
+        expected, elapsed = timed(edge.canny, frame, high=high, low=low)
+        columns = ['%8.1fms' % (1e3 * elapsed)]
+        for dtype in (np.float64, np.float32):
+            detector = edge.CannyDetector(shape, high=high, low=low,
+                                          dtype=dtype)
+            n_diff = np.sum(detector(frame) != expected)
+            elapsed = median_time(detector, frame)
+            columns.append('%8.1fms %5.1f fps' % (1e3 * elapsed, 1 / elapsed))
+        print('%12s %s %13d' % ('%dx%d' % shape, ' '.join(columns), n_diff))
+
+
+def format_peaks(acc, rhos, thetas, num_peaks=4):
+    """The strongest lines of acc as (rho, theta in degrees) pairs."""
+    _, peak_rhos, peak_thetas = edge.hough_peaks(acc, rhos, thetas,
+                                                 num_peaks=num_peaks,
+                                                 threshold=0)
+    return ' '.join('(%g, %g)' % (rho, round(np.rad2deg(theta), 1))
+                    for rho, theta in zip(peak_rhos, peak_thetas))
+
+
+def benchmark_hough(img, chunk_sizes=(256, 4096, 65536), window=10):
+    """Prints time and peaks of hough_transform with and without orientation."""
+    smoothed = edge.conv(img, edge.gaussian_kernel(5, 1.4))
+    _, theta = edge.gradient(smoothed)
+    roi = lane_roi(edge.canny(img, kernel_size=5, sigma=1.4,
+                              high=0.03, low=0.02))
+    print('%d edge pixels in the region of interest' % roi.sum())
+
+    print('%12s %10s %10s  %s' % ('votes', 'chunk', 'time', 'peaks (rho, theta)'))
+    for chunk_size in chunk_sizes:
+        (acc, rhos, thetas), elapsed = timed(edge.hough_transform, roi,
+                                             chunk_size=chunk_size)
+        print('%12s %10d %8.1fms  %s' % ('all thetas', chunk_size,
+                                          1e3 * elapsed,
+                                          format_peaks(acc, rhos, thetas)))
+
+    (acc, rhos, thetas), elapsed = timed(edge.hough_transform, roi,
+                                         orientation=theta, window=window)
+    print('%12s %10d %8.1fms  %s' % ('+-%d degrees' % window, 4096,
+                                      1e3 * elapsed,
+                                      format_peaks(acc, rhos, thetas)))
+
+
+def benchmark_probabilistic(img, max_lines=(None, 4, 2), threshold=30,
+                            line_length=60, line_gap=10):
+    """Prints time and segments of probabilistic_hough against max_lines."""
+    roi = lane_roi(edge.canny(img, kernel_size=5, sigma=1.4,
+                              high=0.03, low=0.02))
+    print('%10s %10s %9s  %s' % ('max lines', 'time', 'segments',
+                                 'first segments (x0, y0, x1, y1)'))
+    for n in max_lines:
+        segments, elapsed = timed(edge.probabilistic_hough, roi,
+                                  threshold=threshold,
+                                  line_length=line_length,
+                                  line_gap=line_gap, max_lines=n, seed=0)
+        print('%10s %8.1fms %9d  %s' % (
+            'all' if n is None else n, 1e3 * elapsed, len(segments),
+            ' '.join('(%d, %d, %d, %d)' % tuple(seg.ravel())
+                     for seg in segments[:2])))
+
+
+def pan(image, n_frames, width, step=2):
+    """Yields the frames of a clip panning step pixels per frame over image."""
+    for t in range(n_frames):
+        yield image[:, t * step:t * step + width]
+
+
+def independent_lanes(frame, theta_range=None):
+    """Lanes of frame with canny and hough_transform, as in the notebook."""
+    edges = lane_roi(edge.canny(frame, kernel_size=5, sigma=1.4,
+                                high=0.03, low=0.02))
+    acc, rhos, thetas = edge.hough_transform(edges, theta_range=theta_range)
+    _, peak_rhos, peak_thetas = edge.hough_peaks(acc, rhos, thetas,
+                                                 num_peaks=10, threshold=0)
+    lanes = {'left': None, 'right': None}
+    for rho, theta in zip(peak_rhos, peak_thetas):
+        side = 'left' if np.cos(theta) * np.sin(theta) > 0 else 'right'
+        if lanes[side] is None:
+            lanes[side] = (rho, theta)
+    return lanes
+
+
+def benchmark_tracker(img, n_frames=30, step=2, theta_range=(-80, 80),
+                      percentiles=(50, 90, 99)):
+    """Prints latency percentiles of LaneTracker and of independent frames."""
+    width = img.shape[1] - n_frames * step
+    tracker = edge.LaneTracker((img.shape[0], width),
+                               theta_range=theta_range)
+
+    times = []
+    n_same = 0
+    for frame, lanes in zip(pan(img, n_frames, width, step),
+                            tracker.track(pan(img, n_frames, width, step))):
+        start = time.perf_counter()
+        n_same += independent_lanes(frame, theta_range) == lanes
+        times.append(time.perf_counter() - start)
+
+    print('%d frames of %dx%d, same lanes in %d' % (
+        n_frames, img.shape[0], width, n_same))
+    print('%12s' % 'stage' + ''.join('%10s' % ('p%d' % p)
+                                     for p in percentiles))
+    latencies = tracker.latency_percentiles(percentiles)
+    latencies['independent'] = 1e3 * np.percentile(times, percentiles)
+    for stage, values in latencies.items():
+        print('%12s' % stage + ''.join('%8.1fms' % v for v in values))
+    for side, lane in sorted(tracker.lanes.items()):
+        if lane is not None:
+            print('last %s lane: rho %g, theta %g' % (
+                side, lane[0], round(np.rad2deg(lane[1]), 1)))
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else 'lane1.png'
+    img = io.imread(path, as_gray=True)
+    benchmark_canny(img)
+    print()
+    benchmark_hough(img)
+    print()
+    benchmark_probabilistic(img)
+    print()
+    benchmark_tracker(img)
@@ -0,0 +1,307 @@
+"""
+Checks of the vectorized paths of edge.py against the loops they replaced.
+
+Usage:
+    python -m pytest test_edge.py
+"""
+
+import queue
+
+import numpy as np
+import pytest
+from skimage import io
+
+import edge
+
+
+def non_maximum_suppression_loop(G, theta):
+    """The original non_maximum_suppression: one pixel at a time."""
+    H, W = G.shape
+    out = np.zeros((H, W))
+    theta = np.floor((theta + 22.5) / 45) * 45
+    theta = (theta % 360.0).astype(np.int32)
+    G_pad = np.pad(G, ((1, 1), (1, 1)))
+    for i in range(1, H+1):
+        for j in range(1, W+1):
+            angle = theta[i-1, j-1]
+            if (angle == 0) or (angle == 180):
+                q = G_pad[i, j+1]
+                r = G_pad[i, j-1]
+            elif angle == 45 or angle == 225:
+                q = G_pad[i-1, j-1]
+                r = G_pad[i+1, j+1]
+            elif angle == 90 or angle == 270:
+                q = G_pad[i+1, j]
+                r = G_pad[i-1, j]
+            elif angle == 135 or angle == 315:
+                q = G_pad[i+1, j-1]
+                r = G_pad[i-1, j+1]
+            if G_pad[i, j] >= q and G_pad[i, j] >= r:
+                out[i-1, j-1] = G_pad[i, j]
+    return out
+
+
+def link_edges_bfs(strong_edges, weak_edges):
+    """The original link_edges: a breadth first search from every strong pixel."""
+    indices = np.stack(np.nonzero(strong_edges)).T
+    edges = np.copy(strong_edges)
+    weak_edges_pad = np.pad(weak_edges, ((1, 1), (1, 1)))
+    passed = np.zeros_like(weak_edges_pad)
+    for pt in indices + [1, 1]:
+        go = queue.Queue()
+        go.put(pt)
+        while not go.empty():
+            s = go.get()
+            edges[s[0]-1, s[1]-1] = True
+            passed[s[0], s[1]] = True
+            for k in range(-1, 2):
+                for l in range(-1, 2):
+                    ny, nx = s[0]+k, s[1]+l
+                    if not passed[ny, nx] and weak_edges_pad[ny, nx]:
+                        go.put([ny, nx])
+    return edges
+
+
+def hough_transform_loop(img, rho_res=1.0, theta_res=1.0, orientation=None,
+                         window=10.0):
+    """The original hough_transform, one vote at a time, at any resolution.
+
+    With an orientation, a pixel only votes for the thetas within
+    window // theta_res bins of the bin nearest to its gradient direction,
+    modulo 180 degrees.
+    """
+    rhos, thetas = edge.hough_bins(img.shape, rho_res, theta_res)
+    degrees = np.rad2deg(thetas)
+    n_half = len(rhos) // 2
+    accumulator = np.zeros((len(rhos), len(thetas)), dtype=np.uint64)
+    reach = int(np.floor(window / theta_res + 1e-9))
+    ys, xs = np.nonzero(img)
+    for y, x in zip(ys, xs):
+        if orientation is None:
+            voted = range(len(thetas))
+        else:
+            base = round((orientation[y, x] - degrees[0]) / theta_res)
+            voted = set()
+            for step in range(-reach, reach + 1):
+                angle = (degrees[0] + (base + step) * theta_res + 90) % 180 - 90
+                j = int(round((angle - degrees[0]) / theta_res))
+                if 0 <= j < len(thetas):
+                    voted.add(j)
+        for j in voted:
+            rho = np.cos(thetas[j]) * x + np.sin(thetas[j]) * y
+            accumulator[int(rho / rho_res) + n_half, j] += 1
+    return accumulator, rhos, thetas
+
+
+@pytest.fixture(scope='module')
+def iguana():
+    return io.imread('iguana.png', as_gray=True)
+
+
+@pytest.fixture(scope='module')
+def gradient(iguana):
+    smoothed = edge.conv(iguana, edge.gaussian_kernel(5, 1.4))
+    return edge.gradient(smoothed)
+
+
+def test_non_maximum_suppression_matches_loop(gradient):
+    G, theta = gradient
+    np.testing.assert_array_equal(edge.non_maximum_suppression(G, theta),
+                                  non_maximum_suppression_loop(G, theta))
+    # Directions on the boundaries of the rounding, and around 360 degrees
+    rng = np.random.RandomState(0)
+    G = np.round(4 * rng.rand(40, 50)) / 4
+    theta = rng.choice([0, 22.5, 67.5, 112.5, 157.5, 202.5, 337.5, 359.9],
+                       size=(40, 50))
+    np.testing.assert_array_equal(edge.non_maximum_suppression(G, theta),
+                                  non_maximum_suppression_loop(G, theta))
+
+
+@pytest.mark.parametrize('high, low', [(0.03, 0.02), (0.05, 0.01)])
+def test_link_edges_matches_bfs(gradient, high, low):
+    # The search queues a pixel once per neighbour reaching it: a crop
+    nms = edge.non_maximum_suppression(*gradient)[:80, :100]
+    strong, weak = edge.double_thresholding(nms, high, low)
+    edges = edge.link_edges(strong, weak)
+    np.testing.assert_array_equal(edges, link_edges_bfs(strong, weak))
+    assert edges.sum() > strong.sum()
+    # Components touching the border
+    rng = np.random.RandomState(1)
+    weak = rng.rand(30, 40) < 0.3
+    strong = rng.rand(30, 40) < 0.02
+    np.testing.assert_array_equal(edge.link_edges(strong, weak),
+                                  link_edges_bfs(strong, weak))
+    # Binary images of integers
+    np.testing.assert_array_equal(
+        edge.link_edges(strong.astype(int), weak.astype(np.uint8)),
+        link_edges_bfs(strong, weak))
+
+
+@pytest.mark.parametrize('band', [1, 7, 32, 400])
+def test_canny_detector_matches_canny(iguana, band):
+    detector = edge.CannyDetector(iguana.shape, high=0.03, low=0.02,
+                                  band=band)
+    for img in (iguana, iguana[::-1], iguana):
+        np.testing.assert_array_equal(detector(img),
+                                      edge.canny(img, high=0.03, low=0.02))
+    # The stages one after the other, over the whole image
+    smoothed = edge.conv(iguana, edge.gaussian_kernel(5, 1.4))
+    np.testing.assert_array_equal(detector.smooth(iguana), smoothed)
+    G, theta = edge.gradient(smoothed)
+    np.testing.assert_array_equal(detector.gradient(detector.smoothed)[0], G)
+    np.testing.assert_array_equal(detector.theta, theta)
+    nms = edge.non_maximum_suppression(G, theta)
+    np.testing.assert_array_equal(detector.non_maximum_suppression(), nms)
+    strong, weak = edge.double_thresholding(nms, 0.03, 0.02)
+    np.testing.assert_array_equal(detector.double_thresholding()[1], weak)
+    np.testing.assert_array_equal(detector.link_edges(),
+                                  edge.link_edges(strong, weak))
+
+
+def test_canny_detector_in_float32(iguana):
+    detector = edge.CannyDetector(iguana.shape, high=0.03, low=0.02,
+                                  dtype=np.float32)
+    edges = detector(iguana)
+    assert detector.G.dtype == np.float32
+    G, _ = edge.gradient(edge.conv(iguana, edge.gaussian_kernel(5, 1.4)))
+    np.testing.assert_allclose(detector.G, G, rtol=1e-4, atol=1e-6)
+    # Only the pixels within rounding of a threshold or of a neighbour differ
+    expected = edge.canny(iguana, high=0.03, low=0.02)
+    assert np.sum(edges != expected) <= 1e-3 * edges.size
+
+
+@pytest.fixture(scope='module')
+def edges(iguana):
+    return edge.canny(iguana[:120, :160], high=0.03, low=0.02)
+
+
+@pytest.mark.parametrize('rho_res, theta_res', [(1.0, 1.0), (2.0, 0.5)])
+def test_hough_transform_matches_loop(edges, rho_res, theta_res):
+    expected = hough_transform_loop(edges, rho_res, theta_res)
+    for chunk_size in (7, 4096):
+        accumulator, rhos, thetas = edge.hough_transform(
+            edges, rho_res, theta_res, chunk_size=chunk_size)
+        np.testing.assert_array_equal(accumulator, expected[0])
+        np.testing.assert_array_equal(rhos, expected[1])
+        np.testing.assert_array_equal(thetas, expected[2])
+
+
+def test_oriented_hough_transform_matches_loop(edges):
+    rng = np.random.RandomState(2)
+    orientation = 360 * rng.rand(*edges.shape)
+    for theta_res, window in ((1.0, 10.0), (2.0, 5.0)):
+        expected, _, _ = hough_transform_loop(edges, 1.0, theta_res,
+                                              orientation, window)
+        accumulator, _, _ = edge.hough_transform(
+            edges, 1.0, theta_res, orientation=orientation, window=window,
+            chunk_size=100)
+        np.testing.assert_array_equal(accumulator, expected)
+
+
+def test_hough_transform_of_theta_range(edges):
+    full, _, thetas = edge.hough_transform(edges)
+    degrees = np.rad2deg(thetas)
+    part, _, part_thetas = edge.hough_transform(edges, theta_range=(-30, 45))
+    keep = (degrees >= -30) & (degrees < 45)
+    np.testing.assert_array_equal(part_thetas, thetas[keep])
+    np.testing.assert_array_equal(part, full[:, keep])
+
+
+def draw_lines(shape, segments):
+    """Binary image of the segments ((x0, y0), (x1, y1))."""
+    img = np.zeros(shape, dtype=bool)
+    for (x0, y0), (x1, y1) in segments:
+        n = max(abs(x1 - x0), abs(y1 - y0)) + 1
+        img[np.rint(np.linspace(y0, y1, n)).astype(int),
+            np.rint(np.linspace(x0, x1, n)).astype(int)] = True
+    return img
+
+
+LINES = [((10, 20), (150, 20)), ((30, 10), (30, 110)), ((50, 100), (140, 40))]
+
+
+def test_hough_peaks():
+    img = draw_lines((120, 160), LINES)
+    accumulator, rhos, thetas = edge.hough_transform(img)
+    votes, peak_rhos, peak_thetas = edge.hough_peaks(accumulator, rhos, thetas,
+                                                     num_peaks=5)
+    assert len(votes) == 3
+    assert np.all(np.diff(votes.astype(float)) <= 0)
+    # Each line has a peak close to its rho and theta
+    for (x0, y0), (x1, y1) in LINES:
+        normal = np.arctan2(x1 - x0, -(y1 - y0))
+        normal = (normal + np.pi / 2) % np.pi - np.pi / 2
+        rho = x0 * np.cos(normal) + y0 * np.sin(normal)
+        distance = np.abs(peak_rhos - rho) + 100 * np.abs(peak_thetas - normal)
+        assert distance.min() < 3
+
+
+def distance_to_line(points, line):
+    """Distances of points (x, y) to the segment line ((x0, y0), (x1, y1))."""
+    start, stop = np.asarray(line, dtype=float)
+    direction = stop - start
+    t = np.clip(np.dot(points - start, direction) / np.dot(direction, direction),
+                0, 1)
+    return np.linalg.norm(points - start - t[:, None] * direction, axis=1)
+
+
+def test_probabilistic_hough():
+    img = draw_lines((120, 160), LINES)
+    segments = edge.probabilistic_hough(img, threshold=10, line_length=30,
+                                        line_gap=3, seed=0)
+    np.testing.assert_array_equal(
+        segments, edge.probabilistic_hough(img, threshold=10, line_length=30,
+                                           line_gap=3, seed=0))
+    # Every line is found, and every segment lies on a line: the line
+    # followed has the slope of a theta bin, so it may leave a few pixels
+    # of a line that make another piece of it
+    for line in LINES:
+        distances = [distance_to_line(segment, line).max()
+                     for segment in segments]
+        found = segments[np.argmin(distances)]
+        assert min(distances) < 2
+        np.testing.assert_allclose(np.sort(found[:, 0]),
+                                   np.sort(np.array(line)[:, 0]), atol=2)
+        np.testing.assert_allclose(np.sort(found[:, 1]),
+                                   np.sort(np.array(line)[:, 1]), atol=2)
+
+    assert len(edge.probabilistic_hough(img, threshold=10, line_length=30,
+                                        line_gap=3, max_lines=2, seed=0)) == 2
+    # The gap is not crossed, and both pieces are long enough
+    gapped = img.copy()
+    gapped[20, 60:70] = False
+    segments = edge.probabilistic_hough(gapped, threshold=10, line_length=30,
+                                        line_gap=3, seed=0)
+    pieces = sorted(tuple(sorted(segment[:, 0])) for segment in segments
+                    if distance_to_line(segment, LINES[0]).max() < 2)
+    np.testing.assert_allclose(pieces, [(10, 59), (70, 150)], atol=2)
+
+
+def lanes_of_frame(frame, tracker):
+    """Lanes of a frame with all the thetas voting, as in the notebook."""
+    edges = edge.canny(frame, high=0.03, low=0.02) & tracker.roi
+    accumulator, rhos, thetas = edge.hough_transform(edges)
+    _, rhos, thetas = edge.hough_peaks(accumulator, rhos, thetas,
+                                       tracker.num_peaks, 0)
+    lanes = {'left': None, 'right': None}
+    for rho, theta in zip(rhos, thetas):
+        side = 'left' if np.cos(theta) * np.sin(theta) > 0 else 'right'
+        if lanes[side] is None:
+            lanes[side] = (rho, theta)
+    return lanes
+
+
+def test_lane_tracker_matches_full_votes():
+    frame = io.imread('lane1.png', as_gray=True)
+    rng = np.random.RandomState(3)
+    frames = [frame, frame, np.clip(frame + 0.01 * rng.rand(*frame.shape), 0, 1)]
+    tracker = edge.LaneTracker(frame.shape)
+    for i, lanes in enumerate(tracker.track(frames)):
+        assert lanes == lanes_of_frame(frames[i], tracker)
+        assert lanes['left'] is not None and lanes['right'] is not None
+        if i > 0:
+            # Only the thetas around the lanes vote after the first frame
+            assert len(tracker.theta_window()) < len(tracker.thetas) / 4
+    percentiles = tracker.latency_percentiles((50, 90))
+    assert set(percentiles) == set(edge.LaneTracker.STAGES)
+    assert percentiles['total'].shape == (2,)
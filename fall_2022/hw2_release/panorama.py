@@ -7,11 +7,15 @@ Last modified: 10/12/2022
 Python Version: 3.5+
 """
 
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from skimage import filters
 from skimage.feature import corner_peaks
 from skimage.util.shape import view_as_blocks
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
+from scipy.ndimage import maximum_filter
 from scipy.ndimage.filters import convolve
 
 from utils import pad, unpad, get_output_space, warp_image
@@ -72,6 +76,132 @@ def harris_corners(img, window_size=3, k=0.04):
     return response
 
 
+def _tile_slices(H, W, tile_size, halo):
+    """Splits an (H, W) image into tiles extended by a halo.
+
+    Returns:
+        tiles: list of (outer, inner) pairs. outer is the (row, col) slice
+            pair of the tile with its halo, clipped to the image, and inner the
+            slice pair of the tile itself inside outer.
+    """
+    tiles = []
+    for top in range(0, H, tile_size):
+        for left in range(0, W, tile_size):
+            bottom, right = min(top + tile_size, H), min(left + tile_size, W)
+            y0, x0 = max(top - halo, 0), max(left - halo, 0)
+            y1, x1 = min(bottom + halo, H), min(right + halo, W)
+            outer = (slice(y0, y1), slice(x0, x1))
+            inner = (slice(top - y0, bottom - y0), slice(left - x0, right - x0))
+            tiles.append((outer, inner))
+    return tiles
+
+
+def _harris_tile(task):
+    """Harris response and local maxima of one tile (run in a worker process).
+
+    The halo of the tile is large enough for the response and the maximum
+    filter of the tile itself to be exactly those of the whole image.
+
+    Returns:
+        response: response of the tile, without the halo
+        peaks: (N, 2) coordinates of the local maxima, relative to the tile
+    """
+    tile, inner, window_size, k, min_distance = task
+    response = harris_corners(tile, window_size, k)
+    size = 2 * min_distance + 1
+    is_peak = response == maximum_filter(response, size=size, mode='nearest')
+    response, is_peak = response[inner], is_peak[inner]
+    return response, np.argwhere(is_peak)
+
+
+def _map_tiles(func, tasks, n_jobs):
+    """Maps func over tasks, in a pool of n_jobs processes (None: all CPUs)."""
+    if n_jobs == 1 or len(tasks) == 1:
+        return list(map(func, tasks))
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return list(pool.map(func, tasks))
+
+
+def harris_corners_tiled(img, window_size=3, k=0.04, tile_size=1024,
+                         n_jobs=None, min_distance=1, threshold_rel=0.05,
+                         exclude_border=8):
+    """
+    Compute the Harris response and its peaks tile by tile, in parallel.
+
+    The image is split in tiles of tile_size x tile_size pixels, each extended
+    by a halo of window_size + 1 + min_distance pixels so that the response
+    (see harris_corners) and the local maxima of a tile do not depend on its
+    neighbours. The tiles are processed in a pool of n_jobs processes. The
+    local maxima are only kept in the tile they belong to, then thresholded
+    and spaced like corner_peaks does over the whole image.
+
+    The results are identical to:
+
+        response = harris_corners(img, window_size, k)
+        keypoints = corner_peaks(response, min_distance=min_distance,
+                                 threshold_rel=threshold_rel,
+                                 exclude_border=exclude_border)
+
+    Args:
+        img: Grayscale image of shape (H, W)
+        window_size: size of the window function
+        k: sensitivity parameter
+        tile_size: size of the tiles, without their halo
+        n_jobs: number of worker processes (default: number of CPUs)
+        min_distance: minimum distance between two keypoints
+        threshold_rel: minimum response of a keypoint, relative to the
+            maximum response
+        exclude_border: width of the image border without keypoints
+
+    Returns:
+        response: Harris response image of shape (H, W)
+        keypoints: array of shape (N, 2) of (row, col) coordinates
+    """
+    H, W = img.shape
+    halo = window_size + 1 + min_distance
+    tiles = _tile_slices(H, W, tile_size, halo)
+    tasks = [(img[outer], inner, window_size, k, min_distance)
+             for outer, inner in tiles]
+    results = _map_tiles(_harris_tile, tasks, n_jobs)
+
+    response = np.empty((H, W))
+    peaks = []
+    for (outer, inner), (tile_response, tile_peaks) in zip(tiles, results):
+        top = outer[0].start + inner[0].start
+        left = outer[1].start + inner[1].start
+        response[top:top + tile_response.shape[0],
+                 left:left + tile_response.shape[1]] = tile_response
+        peaks.append(tile_peaks + [top, left])
+    peaks = np.concatenate(peaks)
+
+    # No peak for a constant image
+    if len(peaks) == H * W:
+        return response, np.empty((0, 2), dtype=int)
+
+    # Threshold and border, in the row-major order of np.nonzero
+    threshold = max(response.min(), threshold_rel * response.max())
+    border = exclude_border if exclude_border is not True else min_distance
+    inside = np.all((peaks >= border) & (peaks < [H - border, W - border]),
+                    axis=1)
+    peaks = peaks[inside & (response[peaks[:, 0], peaks[:, 1]] > threshold)]
+    peaks = peaks[np.lexsort((peaks[:, 1], peaks[:, 0]))]
+
+    # Highest peaks first, rejecting the peaks too close to a kept one
+    order = np.argsort(-response[peaks[:, 0], peaks[:, 1]], kind='stable')
+    peaks = peaks[order]
+    if len(peaks):
+        tree = cKDTree(peaks)
+        rejected = set()
+        for i, point in enumerate(peaks):
+            if i not in rejected:
+                close = tree.query_ball_point(point, r=min_distance, p=np.inf)
+                close.remove(i)
+                rejected.update(close)
+        peaks = np.delete(peaks, list(rejected), axis=0)
+
+    return response, peaks
+
+
 def simple_descriptor(patch):
     """
     Describe the patch by normalizing the image values into a standard
@@ -0,0 +1,49 @@
+"""
+Checks of the tiled Harris detector of panorama.py against the untiled one.
+
+Usage:
+    python -m pytest test_panorama.py
+"""
+
+import numpy as np
+import pytest
+from skimage import io
+from skimage.feature import corner_peaks
+
+from panorama import harris_corners, harris_corners_tiled
+
+
+@pytest.fixture(scope='module')
+def img():
+    return io.imread('uttower1.jpg', as_gray=True)[100:260, 200:420]
+
+
+@pytest.mark.parametrize('window_size, min_distance, exclude_border', [
+    (3, 1, 8), (5, 1, 8), (3, 4, 8), (5, 3, 0), (3, 2, True)])
+@pytest.mark.parametrize('tile_size', [37, 64, 1024])
+def test_tiled_harris_matches_untiled(img, window_size, min_distance,
+                                      exclude_border, tile_size):
+    response = harris_corners(img, window_size)
+    keypoints = corner_peaks(response, min_distance=min_distance,
+                             threshold_rel=0.05, exclude_border=exclude_border)
+
+    tiled_response, tiled_keypoints = harris_corners_tiled(
+        img, window_size, tile_size=tile_size, n_jobs=1,
+        min_distance=min_distance, exclude_border=exclude_border)
+    np.testing.assert_array_equal(tiled_response, response)
+    np.testing.assert_array_equal(tiled_keypoints, keypoints)
+
+
+def test_tiled_harris_in_worker_processes(img):
+    response, keypoints = harris_corners_tiled(img, tile_size=64, n_jobs=1)
+    pooled_response, pooled_keypoints = harris_corners_tiled(img, tile_size=64,
+                                                             n_jobs=2)
+    np.testing.assert_array_equal(pooled_response, response)
+    np.testing.assert_array_equal(pooled_keypoints, keypoints)
+
+
+def test_tiled_harris_of_constant_image():
+    response, keypoints = harris_corners_tiled(np.ones((50, 70)), tile_size=32,
+                                               n_jobs=1)
+    np.testing.assert_array_equal(response, harris_corners(np.ones((50, 70))))
+    assert keypoints.shape == (0, 2)